@@ -1,18 +1,35 @@
+import time
+_process_start = time.perf_counter()
+
 from dotenv import load_dotenv
 load_dotenv() 
+import asyncio
+from typing import Dict
 from fastapi import FastAPI, Request, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 
 # Import routes and services
 from app.routes.auth import router as auth_router, create_default_admin, create_default_employee, active_sessions, get_user_session
 from app.routes.admin import router as admin_router
 from app.routes.attendance import router as attendance_router
-from app.services.db import client
+from app.services.db import client, db
+from app.services.face_service import load_employee_gallery, model_registry, embedding_cache, cascade_matcher, ann_index_manager, employee_gallery, gallery_partitions, frame_quality_gate, legacy_user_gate
+from app.services.inference_pool import inference_executor, embedding_scheduler
+from app.services.gallery_sync import gallery_sync
+from app.services.gallery_snapshot import gallery_snapshots
+from app.services.gallery_shards import ShardedGallery
+from app.services.attendance_roster import attendance_roster
+from app.services.face_tracking import stream_stats
+from app.services.recent_identities import recent_identities
+from datetime import datetime, timezone
+
+# Wall time of each startup phase in ms, reported by /ready
+startup_timings: Dict[str, float] = {"imports": round((time.perf_counter() - _process_start) * 1000, 1)}
 
 
 # --- Authentication dependencies ---
@@ -29,27 +46,97 @@ def require_admin(request: Request):
     return user
 
 
+# --- Startup phases ---
+@contextmanager
+def startup_phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round((time.perf_counter() - start) * 1000, 1)
+        print(f"⏱️ {name}: {startup_timings[name]} ms")
+
+
+async def warm_up_models(app: FastAPI):
+    """Import DeepFace/TensorFlow and warm the face models off the event loop"""
+    try:
+        with startup_phase("model_warm_up"):
+            await asyncio.to_thread(model_registry.preload)
+        app.state.models_ready = True
+        startup_timings["ready"] = round((time.perf_counter() - _process_start) * 1000, 1)
+        print(f"🧠 Face models ready: {model_registry.loaded()}")
+    except Exception as e:
+        app.state.model_error = str(e)
+        print(f"❌ Face model warm-up failed: {e}")
+
+
 # --- Lifespan context manager ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("🚀 Starting Attendance System...")
+    app.state.models_ready = False
+    app.state.model_error = None
+    app.state.gallery_loaded = False
+
+    # Load and warm each face model exactly once for the whole process, in the
+    # background so /login and /health are served while TensorFlow starts
+    app.state.model_registry = model_registry
+    app.state.warm_up_task = asyncio.create_task(warm_up_models(app))
+
+    # Face inference runs on a worker pool, never on the event loop
+    with startup_phase("inference_executor"):
+        inference_executor.start()
+    app.state.inference_executor = inference_executor
 
     try:
-        await client.admin.command("ping")
+        with startup_phase("database"):
+            await client.admin.command("ping")
         print("✅ Database connection successful")
 
         # Run startup tasks
         print("⚡ Running startup tasks...")
-        await create_default_admin()
-        await create_default_employee()
+        with startup_phase("default_users"):
+            await create_default_admin()
+            await create_default_employee()
+        # Map the host's gallery snapshot if there is one, else do the one full
+        # load; from here on the gallery only applies incremental changes
+        if isinstance(employee_gallery, ShardedGallery):
+            with startup_phase("gallery_shards"):
+                employee_gallery.start()
+        with startup_phase("gallery"):
+            snapshot_time = gallery_snapshots.restore()
+            if snapshot_time is not None:
+                await gallery_sync.mark(since=datetime.fromtimestamp(snapshot_time, timezone.utc))
+            else:
+                await gallery_sync.mark()
+                await load_employee_gallery(db.users)
+        with startup_phase("ann_index"):
+            await asyncio.to_thread(ann_index_manager.restore)
+        app.state.gallery_loaded = True
+        gallery_sync.start()
+        gallery_snapshots.start()
+        ann_index_manager.start()
     except Exception as e:
         print(f"❌ Database connection failed: {e}")
 
+    startup_timings["serving"] = round((time.perf_counter() - _process_start) * 1000, 1)
+    print(f"✅ Serving after {startup_timings['serving']} ms (models warming in background)")
+
     yield
 
     # Shutdown
     print("🔴 Shutting down Attendance System...")
+    app.state.warm_up_task.cancel()
+    await gallery_sync.stop()
+    await gallery_snapshots.stop()
+    await ann_index_manager.stop()
+    # Let check-ins already batched finish before the pool goes away
+    await embedding_scheduler.stop()
+    if isinstance(employee_gallery, ShardedGallery):
+        employee_gallery.stop()
+    inference_executor.shutdown()
+    model_registry.clear()
     client.close()
 
 
@@ -98,7 +185,7 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
 
-# --- Health check ---
+# --- Health check (liveness) ---
 @app.get("/health")
 async def health_check():
     try:
@@ -108,6 +195,47 @@ async def health_check():
         return {"status": "unhealthy", "database": "disconnected", "error": str(e)}
 
 
+# --- Readiness: models warmed and gallery loaded ---
+@app.get("/ready")
+async def readiness_check(request: Request):
+    state = request.app.state
+    ready = state.models_ready and state.gallery_loaded
+    body = {
+        "status": "ready" if ready else "starting",
+        "models_ready": state.models_ready,
+        "models": [list(key) for key in model_registry.loaded()],
+        "gallery_loaded": state.gallery_loaded,
+        "startup_ms": startup_timings,
+    }
+    if state.model_error:
+        body["status"] = "failed"
+        body["error"] = state.model_error
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+# --- Metrics ---
+@app.get("/metrics")
+async def metrics():
+    return {
+        "inference": inference_executor.metrics(),
+        "batching": embedding_scheduler.metrics(),
+        "embedding_cache": embedding_cache.metrics(),
+        "cascade": cascade_matcher.metrics(),
+        "gallery_sync": gallery_sync.metrics(),
+        "gallery_snapshot": gallery_snapshots.metrics(),
+        "ann_index": ann_index_manager.metrics(),
+        "checkout_roster": attendance_roster.metrics(),
+        "gallery_partitions": gallery_partitions.metrics(),
+        "kiosk_streams": stream_stats.metrics(),
+        "quality_gate": frame_quality_gate.metrics(),
+        "recent_identities": recent_identities.metrics(),
+        "legacy_fallback": legacy_user_gate.metrics(),
+        "gallery_shards": (
+            employee_gallery.metrics() if isinstance(employee_gallery, ShardedGallery) else {"enabled": False}
+        ),
+    }
+
+
 # --- API Info ---
 @app.get("/api/info")
 async def api_info():
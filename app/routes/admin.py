@@ -1,10 +1,25 @@
 from fastapi import APIRouter, Request, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from app.services.db import db
-from app.services.face_service import quick_face_verify as verify_faces
+from app.services.face_service import (
+    template_fields,
+    employee_gallery,
+    gallery_metadata,
+    gallery_partitions,
+    index_employee,
+    unindex_employee,
+    compute_shortlist_embedding,
+    encode_embedding,
+    CASCADE_ENABLED,
+    MAX_REFERENCE_TEMPLATES,
+)
+from app.services.inference_pool import inference_executor
+from app.services.gallery_sync import record_deletion
 from datetime import datetime, timezone, timedelta
+from typing import Optional, List, Tuple
 from bson import ObjectId
+import asyncio
 import pytz
 import csv
 import io
@@ -54,12 +69,45 @@ async def register_page(request: Request):
         "user_type": user_session["type"]
     })
 
+async def embed_captures(uploads: List[UploadFile]) -> Tuple[Optional[bytes], List[List[float]]]:
+    """
+    Read up to MAX_REFERENCE_TEMPLATES reference captures and embed them in one batch
+
+    Captures in which no face is detected are dropped rather than embedded as a
+    whole frame.
+
+    Returns:
+        The first usable capture (kept as face_image) and one embedding per usable capture
+    """
+    captures = []
+    for upload in uploads[:MAX_REFERENCE_TEMPLATES]:
+        if not upload.filename:
+            continue
+        image_data = await upload.read()
+        if not image_data or len(image_data) < 1000:
+            continue
+        if not upload.content_type or not upload.content_type.startswith('image/'):
+            continue
+        captures.append(image_data)
+    if not captures:
+        return None, []
+
+    embeddings = await inference_executor.embed_batch(captures, require_face=True)
+    usable = [(image_data, embedding) for image_data, embedding in zip(captures, embeddings) if embedding is not None]
+    if not usable:
+        return captures[0], []
+    print(f"📸 Embedded {len(usable)}/{len(captures)} reference captures")
+    return usable[0][0], [embedding for _, embedding in usable]
+
+
 @router.post("/admin/register")
 async def register_employee(
     request: Request,
     name: str = Form(...),
     email: str = Form(...),
-    image: UploadFile = File(...)
+    image: List[UploadFile] = File(...),
+    site: str = Form(""),
+    department: str = Form("")
 ):
     # Check authentication
     session_id = request.cookies.get("session_id")
@@ -75,23 +123,41 @@ async def register_employee(
             # Return JSON error response instead of redirect for AJAX handling
             return {"status": "error", "message": "Email already registered."}
 
-        # Read and validate image
-        image_data = await image.read()
-        if not image_data or len(image_data) < 1000:
-            return {"status": "error", "message": "Invalid or empty image. Please upload a valid image file."}
+        # Read, validate and embed every reference capture once so check-ins only
+        # compare vectors (one template per capture plus their centroid)
+        image_data, embeddings = await embed_captures(image)
+        if image_data is None:
+            return JSONResponse(
+                {"status": "error", "message": "Invalid or empty image. Please upload a valid image file."},
+                status_code=400
+            )
+        if not embeddings:
+            return JSONResponse(
+                {"status": "error", "message": "No face detected in the captured photos. Please capture a clearer photo."},
+                status_code=400
+            )
 
-        # Validate image type (optional but recommended)
-        if not image.content_type or not image.content_type.startswith('image/'):
-            return {"status": "error", "message": "Please upload a valid image file."}
+        # SFace embedding for the cascade shortlist
+        sface_embedding = None
+        if CASCADE_ENABLED:
+            sface_embedding = await inference_executor.run(compute_shortlist_embedding, image_data)
 
         pakistan_time = datetime.now(pytz.timezone("Asia/Karachi"))
 
         user = {
             "name": name.strip(),  # Remove extra whitespace
             "email": email.strip().lower(),  # Normalize email
+            # Kiosks search their own site/department partition first
+            "site": site.strip() or None,
+            "department": department.strip() or None,
             "face_image": image_data,
-            "created_at": pakistan_time
+            **template_fields(embeddings),
+            "created_at": pakistan_time,
+            # Watermark for workers that sync the gallery by polling
+            "updated_at": datetime.now(timezone.utc)
         }
+        if sface_embedding is not None:
+            user["sface_embedding"] = encode_embedding(sface_embedding)
 
         # Insert the user into database
         result = await db.users.insert_one(user)
@@ -99,6 +165,7 @@ async def register_employee(
         # Verify the insertion was successful
         if result.inserted_id:
             print(f"✅ Employee {name} registered successfully with ID: {result.inserted_id}")
+            await asyncio.to_thread(index_employee, str(result.inserted_id), user)
             
             # Return success response for both Admin and User
             return {
@@ -135,7 +202,15 @@ async def update_employee_page(user_id: str, request: Request):
     })
 
 @router.post("/admin/update/{user_id}")
-async def update_employee(user_id: str, request: Request, name: str = Form(...), email: str = Form(...)):
+async def update_employee(
+    user_id: str,
+    request: Request,
+    name: str = Form(...),
+    email: str = Form(...),
+    image: Optional[List[UploadFile]] = File(None),
+    site: str = Form(""),
+    department: str = Form("")
+):
     # Check authentication - only Admin can update
     session_id = request.cookies.get("session_id")
     if not session_id or session_id not in active_sessions:
@@ -145,10 +220,42 @@ async def update_employee(user_id: str, request: Request, name: str = Form(...),
     if user_session["type"] != "Admin":
         return RedirectResponse(url="/user-dashboard", status_code=302)
     
-    await db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"name": name, "email": email}}
-    )
+    update = {
+        "name": name,
+        "email": email,
+        "site": site.strip() or None,
+        "department": department.strip() or None,
+        "updated_at": datetime.now(timezone.utc)
+    }
+    changes = {"$set": update}
+
+    # Optional new face photos: replace the templates and re-derive the centroid
+    if image:
+        image_data, embeddings = await embed_captures(image)
+        if embeddings:
+            update["face_image"] = image_data
+            update.update(template_fields(embeddings))
+            sface_embedding = None
+            if CASCADE_ENABLED:
+                sface_embedding = await inference_executor.run(compute_shortlist_embedding, image_data)
+            if sface_embedding is not None:
+                update["sface_embedding"] = encode_embedding(sface_embedding)
+            else:
+                changes["$unset"] = {"sface_embedding": ""}
+        elif image_data is not None:
+            print(f"⚠️ No face detected in the new photos for {user_id}")
+            return JSONResponse(
+                {"status": "error", "message": "No face detected in the captured photos. Please capture a clearer photo."},
+                status_code=400
+            )
+
+    await db.users.update_one({"_id": ObjectId(user_id)}, changes)
+
+    if "face_embedding" in update:
+        await asyncio.to_thread(index_employee, user_id, update)
+    else:
+        if employee_gallery.update(user_id, metadata=gallery_metadata(update)):
+            gallery_partitions.assign(user_id, update)
     return RedirectResponse("/admin", status_code=302)
 
 @router.get("/admin/delete/{user_id}")
@@ -163,6 +270,9 @@ async def delete_employee(user_id: str, request: Request):
         return RedirectResponse(url="/user-dashboard", status_code=302)
     
     await db.users.delete_one({"_id": ObjectId(user_id)})
+    await record_deletion(db, user_id)
+    # Off the event loop: removing from a sharded gallery may rebalance the shards
+    await asyncio.to_thread(unindex_employee, user_id)
     return RedirectResponse("/admin", status_code=302)
 
 @router.get("/admin/export")
@@ -294,6 +404,8 @@ async def delete_selected_employees(request: Request):
     ids = form.getlist("user_ids")
     for uid in ids:
         await db.users.delete_one({"_id": ObjectId(uid)})
+        await record_deletion(db, uid)
+        await asyncio.to_thread(unindex_employee, uid)
     return RedirectResponse(url="/admin", status_code=302)
 
 # Handle Users and Admin routes - Only for Admin
@@ -179,11 +179,28 @@
 #         "status": "error",
 #         "message": "❌ Face not recognized in the system."
 #     }
-from fastapi import APIRouter, UploadFile, File, Request, Form, BackgroundTasks
+from fastapi import APIRouter, UploadFile, File, Request, Form, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from app.services.db import db
-from app.services.face_service import quick_face_verify as verify_faces
+from app.services.face_service import (
+    employee_gallery,
+    verify_embeddings,
+    MATCH_THRESHOLD,
+    LEGACY_EMBEDDING_QUERY,
+    legacy_user_gate,
+    CASCADE_ENABLED,
+    TEMPLATE_RERANK_K,
+    CLAIMED_IDENTITY_VERIFICATION,
+    QUALITY_GATE_ENABLED,
+    cascade_matcher,
+    frame_quality_gate,
+    gallery_partitions,
+)
+from app.services.inference_pool import inference_executor, embedding_scheduler
+from app.services.attendance_roster import attendance_roster
+from app.services.recent_identities import recent_identities
+from app.services.face_tracking import FaceTracker, track_frame, stream_stats, STREAM_MAX_FRAME_BYTES
 try:
     from app.services.emailservice import send_late_checkin_email
 except Exception as e:
@@ -193,6 +210,11 @@ except Exception as e:
         print("⚠️ Email service not configured - skipping email")
         return False
 from datetime import datetime
+import asyncio
+import json
+import time
+from typing import Optional, Set, Tuple
+from bson import ObjectId
 import pytz
 from app.routes.auth import active_sessions
 from fastapi.responses import RedirectResponse
@@ -201,20 +223,58 @@ router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
 
 @router.get("/attendance", response_class=HTMLResponse)
-async def attendance_form(request: Request, msg: str = ""):
+async def attendance_form(request: Request, msg: str = "", site: str = "", department: str = ""):
     session_id = request.cookies.get("session_id")
     if not session_id or session_id not in active_sessions:
         return RedirectResponse(url="/login", status_code=302)
 
     user_session = active_sessions[session_id]
-    return templates.TemplateResponse("user_attendance.html", {"request": request, "msg": msg})
+    # A kiosk opened as /attendance?site=... sends its site with every capture
+    return templates.TemplateResponse("user_attendance.html", {
+        "request": request,
+        "msg": msg,
+        "site": site,
+        "department": department
+    })
+
+
+def identify_narrowed(live_embedding,
+                      checkout_candidates: Optional[Set[str]],
+                      partition: Optional[Set[str]]) -> Optional[Tuple[str, float]]:
+    """
+    Search the narrowest plausible candidate set first and widen only on a miss:
+    today's checked-in employees (checkout), then the kiosk's partition, then everyone
+    """
+    def search(candidates=None):
+        return employee_gallery.best_match(
+            live_embedding,
+            threshold=MATCH_THRESHOLD,
+            candidates=candidates,
+            rerank_k=TEMPLATE_RERANK_K
+        )
+
+    match = None
+    if checkout_candidates:
+        narrowed = checkout_candidates & partition if partition else checkout_candidates
+        if narrowed:
+            match = search(narrowed)
+            attendance_roster.record_search(len(narrowed), matched=match is not None)
+    if partition and match is None:
+        match = search(partition)
+        gallery_partitions.record_search(len(partition), matched=match is not None)
+    if match is None:
+        # Whole gallery, e.g. a checkout without a check-in or a visitor from another site
+        match = search()
+    return match
 
 @router.post("/attendance")
 async def mark_attendance(
     request: Request,
     background_tasks: BackgroundTasks,  # Add this parameter
     image: UploadFile = File(...),
-    action: str = Form(...)
+    action: str = Form(...),
+    site: Optional[str] = Form(None),
+    department: Optional[str] = Form(None)
 ):
     # Session validation
     session_id = request.cookies.get("session_id")
@@ -231,108 +291,311 @@ async def mark_attendance(
             "message": "❌ Invalid or empty image uploaded."
         }
 
-    # Face recognition process
-    users = await db.users.find().to_list(100)
-    for user in users:
-        if "face_image" not in user:
-            continue
+    # A kiosk names its site/department in the form, or with X-Kiosk-* headers
+    return await identify_and_record(
+        image_data,
+        action,
+        user_session,
+        background_tasks,
+        site=site or request.headers.get("X-Kiosk-Site"),
+        department=department or request.headers.get("X-Kiosk-Department"),
+        kiosk=session_id
+    )
 
-        is_verified, distance = verify_faces(user["face_image"], image_data)
 
-        if is_verified:
-            # Get Pakistan timezone
-            pakistan_time = datetime.now(pytz.timezone("Asia/Karachi"))
-            date_str = pakistan_time.strftime("%Y-%m-%d")
-            time_str = pakistan_time.strftime("%H:%M:%S")
+async def identify_and_record(image_data: bytes,
+                              action: str,
+                              user_session: dict,
+                              background_tasks: BackgroundTasks,
+                              site: Optional[str] = None,
+                              department: Optional[str] = None,
+                              kiosk: Optional[str] = None) -> dict:
+    """Identify the face in a capture and record the check-in/check-out (HTTP and streaming kiosks)"""
+    # Reject dark, blurry, faceless or crowded frames before any model runs
+    if QUALITY_GATE_ENABLED:
+        accepted, reason, _ = await asyncio.to_thread(frame_quality_gate.check, image_data)
+        if not accepted:
+            return {"status": "error", "reason": reason, "message": frame_quality_gate.message(reason)}
+    pipeline_start = time.perf_counter()
 
-            # Check for existing attendance record
-            existing_record = await db.attendance.find_one({
-                "user_id": str(user["_id"]),
-                "date": date_str
-            })
+    # A double tap or resend from the same kiosk gets the answer it just got,
+    # without matching or touching the attendance collection again
+    live_embedding = None
+    embedded = recent_identities.active(kiosk)
+    if embedded:
+        live_embedding = await embedding_scheduler.embed(image_data)
+        cached = recent_identities.lookup(kiosk, action, live_embedding)
+        if cached is not None:
+            return cached
 
-            # ✅ CHECK-IN LOGIC WITH EMAIL
-            if action == "checkin":
-                # Check if user is late (after 9:00 AM)
-                is_late = pakistan_time.time() > datetime.strptime("09:00:00", "%H:%M:%S").time()
-
-                if existing_record:
-                    if existing_record.get("checkin"):
-                        # Already checked in - don't overwrite
-                        return {
-                            "status": "info",
-                            "message": f"✅ Already checked in at {existing_record['checkin']}."
-                        }
-                    else:
-                        # Update existing record with check-in
-                        await db.attendance.update_one(
-                            {"_id": existing_record["_id"]},
-                            {"$set": {
-                                "checkin": time_str,
-                                "late": is_late,
-                                "status": "Present" + (" (Late)" if is_late else "")
-                            }}
-                        )
-                else:
-                    # Create new attendance record
-                    await db.attendance.insert_one({
-                        "user_id": str(user["_id"]),
-                        "name": user["name"],
-                        "email": user["email"],
-                        "date": date_str,
-                        "checkin": time_str,
-                        "checkout": None,
-                        "late": is_late,
-                        "status": "Present" + (" (Late)" if is_late else "")
-                    })
-
-                # 📧 SEND LATE CHECK-IN EMAIL IN BACKGROUND (USER WON'T SEE STATUS)
-                if is_late:
-                    background_tasks.add_task(
-                        send_late_checkin_email,
-                        user["email"], 
-                        user["name"], 
-                        time_str
-                    )
-                    # Email is sent in background, no status shown to user
+    # Personal employee logins are in the gallery and only need a 1:1 check
+    # against their own templates; shared kiosk accounts are not, and identify 1:N
+    claimed_id = user_session.get("user_id")
+    verify_claim = (
+        CLAIMED_IDENTITY_VERIFICATION
+        and user_session.get("type") == "Employee"
+        and claimed_id in employee_gallery
+    )
 
-                return {
-                    "status": "success",
-                    "message": f"✅ Check-In marked for {user['name']}{' (Late)' if is_late else ''}"
-                }
+    # Only people who checked in today can check out, and a kiosk only sees its
+    # own site's staff
+    checkout_candidates = None
+    partition = None
+    if not verify_claim:
+        if action == "checkout":
+            checkout_candidates = await attendance_roster.checked_in()
+        partition = gallery_partitions.members(site=site, department=department)
+
+    # Face recognition process: embed the live capture once, then search the gallery
+    # (concurrent check-ins are micro-batched and run on the worker pool)
+    if verify_claim:
+        if not embedded:
+            live_embedding = await embedding_scheduler.embed(image_data)
+        match = None
+        if live_embedding is not None:
+            # Off the event loop: a sharded gallery waits on its shard processes
+            match = await asyncio.to_thread(
+                employee_gallery.best_match,
+                live_embedding,
+                threshold=MATCH_THRESHOLD,
+                candidates=[claimed_id],
+                rerank_k=TEMPLATE_RERANK_K
+            )
+        if match is None:
+            return {
+                "status": "error",
+                "message": "❌ Face does not match the logged-in employee."
+            }
+    elif (CASCADE_ENABLED and inference_executor.mode == "thread" and not embedded
+          and not checkout_candidates and not partition):
+        # SFace shortlist, then Facenet512 on the shortlisted employees only. The
+        # galleries live in this process, so process workers use the full path.
+        cascade = await inference_executor.run(cascade_matcher.identify, image_data)
+        live_embedding, match = cascade["embedding"], cascade["match"]
+    else:
+        if not embedded:
+            live_embedding = await embedding_scheduler.embed(image_data)
+        match = None
+        if live_embedding is not None:
+            match = await asyncio.to_thread(identify_narrowed, live_embedding, checkout_candidates, partition)
 
-            # ✅ CHECK-OUT LOGIC
-            elif action == "checkout":
-                if existing_record:
-                    await db.attendance.update_one(
-                        {"_id": existing_record["_id"]},
-                        {"$set": {
-                            "checkout": time_str
-                        }}
-                    )
-                    return {
-                        "status": "success",
-                        "message": f"✅ Check-Out updated for {user['name']} at {time_str}"
-                    }
-                else:
-                    # Insert checkout-only entry
-                    await db.attendance.insert_one({
-                        "user_id": str(user["_id"]),
-                        "name": user["name"],
-                        "email": user["email"],
-                        "date": date_str,
-                        "checkin": None,
-                        "checkout": time_str,
-                        "late": False,
-                        "status": "-"
-                    })
-                    return {
-                        "status": "success",
-                        "message": f"⚠️ No Check-In found. Check-Out recorded for {user['name']}."
-                    }
+    if QUALITY_GATE_ENABLED and live_embedding is not None:
+        frame_quality_gate.record_pipeline(time.perf_counter() - pipeline_start)
+
+    user = None
+    if match:
+        user = await db.users.find_one({"_id": ObjectId(match[0])}, {"face_image": 0})
+
+    if user is None and live_embedding is not None and await legacy_user_gate.pending(db.users):
+        # Legacy documents without a current embedding: embed their photos in one
+        # batch and compare against the live embedding computed above
+        legacy_users = [
+            legacy_user
+            for legacy_user in await db.users.find(LEGACY_EMBEDDING_QUERY).to_list(100)
+            if "face_image" in legacy_user
+        ]
+        if legacy_users:
+            reference_embeddings = await inference_executor.embed_batch(
+                [legacy_user["face_image"] for legacy_user in legacy_users]
+            )
+            best_distance = MATCH_THRESHOLD
+            for legacy_user, reference_embedding in zip(legacy_users, reference_embeddings):
+                if reference_embedding is None:
+                    continue
+                is_verified, distance = verify_embeddings(reference_embedding, live_embedding)
+                if is_verified and distance <= best_distance:
+                    best_distance = distance
+                    user = legacy_user
+
+    if user is not None:
+        result = await record_attendance(user, action, background_tasks)
+        if result is not None:
+            recent_identities.remember(kiosk, action, live_embedding, result)
+            return result
 
     # Face not recognized
     return {
         "status": "error",
         "message": "❌ Face not recognized in the system."
-    }
\ No newline at end of file
+    }
+
+
+async def record_attendance(user: dict, action: str, background_tasks: BackgroundTasks):
+    """Write the check-in/check-out for an identified user and build the response"""
+    # Get Pakistan timezone
+    pakistan_time = datetime.now(pytz.timezone("Asia/Karachi"))
+    date_str = pakistan_time.strftime("%Y-%m-%d")
+    time_str = pakistan_time.strftime("%H:%M:%S")
+
+    # Check for existing attendance record
+    existing_record = await db.attendance.find_one({
+        "user_id": str(user["_id"]),
+        "date": date_str
+    })
+
+    # ✅ CHECK-IN LOGIC WITH EMAIL
+    if action == "checkin":
+        # Check if user is late (after 9:00 AM)
+        is_late = pakistan_time.time() > datetime.strptime("09:00:00", "%H:%M:%S").time()
+
+        if existing_record:
+            if existing_record.get("checkin"):
+                # Already checked in - don't overwrite
+                return {
+                    "status": "info",
+                    "message": f"✅ Already checked in at {existing_record['checkin']}."
+                }
+            else:
+                # Update existing record with check-in
+                await db.attendance.update_one(
+                    {"_id": existing_record["_id"]},
+                    {"$set": {
+                        "checkin": time_str,
+                        "late": is_late,
+                        "status": "Present" + (" (Late)" if is_late else "")
+                    }}
+                )
+                attendance_roster.add(str(user["_id"]))
+        else:
+            # Create new attendance record
+            await db.attendance.insert_one({
+                "user_id": str(user["_id"]),
+                "name": user["name"],
+                "email": user["email"],
+                "date": date_str,
+                "checkin": time_str,
+                "checkout": None,
+                "late": is_late,
+                "status": "Present" + (" (Late)" if is_late else "")
+            })
+            attendance_roster.add(str(user["_id"]))
+
+        # 📧 SEND LATE CHECK-IN EMAIL IN BACKGROUND (USER WON'T SEE STATUS)
+        if is_late:
+            background_tasks.add_task(
+                send_late_checkin_email,
+                user["email"], 
+                user["name"], 
+                time_str
+            )
+            # Email is sent in background, no status shown to user
+
+        return {
+            "status": "success",
+            "message": f"✅ Check-In marked for {user['name']}{' (Late)' if is_late else ''}"
+        }
+
+    # ✅ CHECK-OUT LOGIC
+    elif action == "checkout":
+        if existing_record:
+            await db.attendance.update_one(
+                {"_id": existing_record["_id"]},
+                {"$set": {
+                    "checkout": time_str
+                }}
+            )
+            return {
+                "status": "success",
+                "message": f"✅ Check-Out updated for {user['name']} at {time_str}"
+            }
+        else:
+            # Insert checkout-only entry
+            await db.attendance.insert_one({
+                "user_id": str(user["_id"]),
+                "name": user["name"],
+                "email": user["email"],
+                "date": date_str,
+                "checkin": None,
+                "checkout": time_str,
+                "late": False,
+                "status": "-"
+            })
+            attendance_roster.add(str(user["_id"]))
+            return {
+                "status": "success",
+                "message": f"⚠️ No Check-In found. Check-Out recorded for {user['name']}."
+            }
+
+
+@router.websocket("/attendance/stream")
+async def attendance_stream(websocket: WebSocket):
+    """
+    Hands-free kiosk mode: the page streams small JPEG frames (binary messages),
+    the server tracks the face and identifies it once it is stable and large
+    enough, then pushes the result back. Text messages change the options,
+    e.g. {"action": "checkout", "site": "..."}.
+    """
+    session_id = websocket.cookies.get("session_id")
+    if not session_id or session_id not in active_sessions:
+        await websocket.close(code=1008)
+        return
+    user_session = active_sessions[session_id]
+    await websocket.accept()
+
+    options = {
+        "action": websocket.query_params.get("action", "checkin"),
+        "site": websocket.query_params.get("site") or websocket.headers.get("X-Kiosk-Site"),
+        "department": websocket.query_params.get("department") or websocket.headers.get("X-Kiosk-Department"),
+    }
+    tracker = FaceTracker()
+    pending: Optional[asyncio.Task] = None
+    last_state = None
+    stream_stats.opened()
+
+    async def identify(frame: bytes, track_id: int):
+        background_tasks = BackgroundTasks()
+        stream_stats.identified()
+        try:
+            result = await identify_and_record(
+                frame, options["action"], user_session, background_tasks,
+                site=options["site"], department=options["department"], kiosk=session_id
+            )
+        except Exception as e:
+            print(f"❌ Stream identification error: {e}")
+            result = {"status": "error", "message": "❌ Recognition failed, please try again."}
+        if tracker.track_id == track_id:
+            tracker.mark_attempt(result.get("status") in ("success", "info"))
+        try:
+            await websocket.send_json({"type": "result", "track_id": track_id, **result})
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # Kiosk went away; the attendance is recorded regardless
+        # Late check-in emails etc. run after the kiosk has its answer
+        await background_tasks()
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("text"):
+                try:
+                    update = json.loads(message["text"])
+                except ValueError:
+                    continue
+                options.update({key: update[key] for key in ("action", "site", "department") if key in update})
+                # Someone checked in may stay in front of the kiosk to check out
+                tracker = FaceTracker()
+                continue
+
+            frame = message.get("bytes")
+            if not frame or len(frame) > STREAM_MAX_FRAME_BYTES:
+                continue
+            stream_stats.frame()
+            state = await asyncio.to_thread(track_frame, tracker, frame)
+            if state is None:
+                continue
+            if state["ready"] and (pending is None or pending.done()):
+                tracker.decided = True  # until the attempt is recorded
+                pending = asyncio.create_task(identify(frame, state["track_id"]))
+            # Only push tracking changes, not one message per frame
+            summary = {key: state[key] for key in ("faces", "track_id", "stable", "large_enough")}
+            if summary != last_state:
+                last_state = summary
+                await websocket.send_json({"type": "tracking", **summary})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Let an identification in progress finish recording the attendance
+        if pending is not None:
+            await pending
+        stream_stats.closed()
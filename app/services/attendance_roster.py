@@ -0,0 +1,114 @@
+"""
+Today's attendance roster: who already has an attendance row for today
+
+Only someone who checked in today can plausibly check out, so checkout
+identification searches this (usually much smaller) set first and the whole
+gallery only on a miss. The set is kept in memory, updated on every check-in
+this worker records, and merged with the attendance collection every
+ROSTER_REFRESH_SECONDS so check-ins recorded by other workers show up too.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, Set
+
+import pytz
+
+from app.services.db import db
+
+logger = logging.getLogger(__name__)
+
+ROSTER_REFRESH_SECONDS = float(os.getenv("ROSTER_REFRESH_SECONDS", 30.0))
+ATTENDANCE_TIMEZONE = pytz.timezone("Asia/Karachi")
+
+
+def attendance_date() -> str:
+    """The attendance 'date' field for today, as record_attendance writes it"""
+    return datetime.now(ATTENDANCE_TIMEZONE).strftime("%Y-%m-%d")
+
+
+class AttendanceRoster:
+    def __init__(self, db, refresh_interval: float = ROSTER_REFRESH_SECONDS):
+        """
+        In-memory set of user ids with an attendance row for today
+
+        Args:
+            db: Motor database holding the attendance collection
+            refresh_interval: Seconds between merges with the database
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self._date: Optional[str] = None
+        self._user_ids: Set[str] = set()
+        self._refreshed_at = 0.0
+        self._index_ready = False
+        self._refresh_lock = asyncio.Lock()
+
+        self._lock = threading.Lock()
+        self._narrowed_matches = 0
+        self._fallbacks = 0
+        self._candidates_total = 0
+
+    def _roll_over(self, date: str):
+        if self._date != date:
+            # New day: nobody has checked in yet
+            self._date = date
+            self._user_ids = set()
+            self._refreshed_at = 0.0
+
+    def add(self, user_id: str):
+        """Record a user who now has an attendance row for today"""
+        self._roll_over(attendance_date())
+        self._user_ids.add(user_id)
+
+    async def checked_in(self) -> Set[str]:
+        """
+        User ids with an attendance row for today, refreshed from the database when stale
+        """
+        self._roll_over(attendance_date())
+        if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            async with self._refresh_lock:
+                if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+                    await self._refresh()
+        return set(self._user_ids)
+
+    async def _refresh(self):
+        date = self._date
+        try:
+            if not self._index_ready:
+                await self.db.attendance.create_index([("date", 1), ("user_id", 1)])
+                self._index_ready = True
+            user_ids = await self.db.attendance.distinct("user_id", {"date": date})
+        except Exception as e:
+            logger.warning(f"⚠️ Attendance roster refresh failed: {e}")
+            return
+        finally:
+            self._refreshed_at = time.monotonic()
+        if self._date == date:
+            self._user_ids.update(user_ids)
+
+    def record_search(self, candidates: int, matched: bool):
+        with self._lock:
+            self._candidates_total += candidates
+            if matched:
+                self._narrowed_matches += 1
+            else:
+                self._fallbacks += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            searches = self._narrowed_matches + self._fallbacks
+            return {
+                "date": self._date,
+                "checked_in": len(self._user_ids),
+                "narrowed_matches": self._narrowed_matches,
+                "fallbacks": self._fallbacks,
+                "avg_candidates": (self._candidates_total / searches) if searches else None,
+            }
+
+
+# Narrows checkout identification to people who checked in today
+attendance_roster = AttendanceRoster(db)
@@ -0,0 +1,282 @@
+"""
+Backfill face embeddings for users that only have a stored face_image
+
+Streams every user whose embedding is missing or was produced by another
+model, pipeline version, inference backend or detector, embeds the photos in parallel worker processes and
+writes the results back with unordered bulk writes. Progress is checkpointed
+after every write, so an interrupted run resumes after the last user whose
+batch (and every batch before it) was written. A checkpoint written for another
+model, EMBEDDING_VERSION, inference backend or detector is ignored.
+
+    python -m app.services.backfill_embeddings
+    python -m app.services.backfill_embeddings --workers 8 --batch-size 32
+    python -m app.services.backfill_embeddings --reset   # ignore the checkpoint
+    python -m app.services.backfill_embeddings --shortlist-only
+
+With CASCADE_ENABLED a second pass gives employees that already have a current
+embedding but no SFace shortlist embedding one (--shortlist-only runs just
+that pass); without it they would always fall through to the cascade's
+stage 2. Each pass keeps its own checkpoint.
+
+Images in which no face can be detected are skipped and counted; they are
+left untouched so the legacy check-in path still covers those users.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Tuple, Optional, Dict, Any, List
+
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+from app.services.db import MONGO_URI
+from app.services.face_service import (
+    FastAttendanceVerifier,
+    embedding_fields,
+    encode_embedding,
+    get_shortlist_model,
+    LEGACY_EMBEDDING_QUERY,
+    CASCADE_ENABLED,
+    embedding_pipeline,
+)
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATH = os.getenv("BACKFILL_CHECKPOINT", ".backfill_checkpoint.json")
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+# (user id, embedding fields to $set or None, skip reason or None)
+BackfillResult = Tuple[str, Optional[Dict[str, Any]], Optional[str]]
+
+_verifier: Optional[FastAttendanceVerifier] = None
+
+
+def _worker_init():
+    """Load and warm the model once per worker; the embedding cache is useless here"""
+    global _verifier
+    _verifier = FastAttendanceVerifier(cache=None)
+
+
+def _embed_users(batch: List[Tuple[str, bytes]], shortlist_only: bool = False) -> List[BackfillResult]:
+    """
+    Decode and detect each photo, then embed the detected faces in one forward pass
+
+    Args:
+        batch: (user id, stored photo) pairs
+        shortlist_only: Only compute the SFace shortlist embedding
+    """
+    results: List[BackfillResult] = []
+    faces, ids = [], []
+    for user_id, image_bytes in batch:
+        try:
+            img = _verifier.decode(image_bytes)
+            if img is None:
+                results.append((user_id, None, "decode_failed"))
+                continue
+            face = _verifier.detect(img)
+        except Exception as e:
+            results.append((user_id, None, f"detect_failed: {e}"))
+            continue
+        # With enforce_detection disabled DeepFace falls back to the whole frame
+        # with zero confidence; never store an embedding of that
+        if not face.get('confidence'):
+            results.append((user_id, None, "no_face"))
+            continue
+        faces.append(face)
+        ids.append(user_id)
+
+    if faces and shortlist_only:
+        for user_id, sface_embedding in zip(ids, get_shortlist_model().embed(faces)):
+            results.append((user_id, {'sface_embedding': encode_embedding(sface_embedding)}, None))
+    elif faces:
+        embeddings = _verifier.embed(faces)
+        sface_embeddings = get_shortlist_model().embed(faces) if CASCADE_ENABLED else [None] * len(faces)
+        for user_id, embedding, sface_embedding in zip(ids, embeddings, sface_embeddings):
+            fields = embedding_fields(embedding)
+            if sface_embedding is not None:
+                fields['sface_embedding'] = encode_embedding(sface_embedding)
+            results.append((user_id, fields, None))
+    return results
+
+
+def shortlist_query() -> Dict[str, Any]:
+    """
+    Users with a current embedding but no SFace shortlist embedding
+    """
+    return {'$and': [
+        {'face_embedding': {'$exists': True}},
+        {'$nor': [LEGACY_EMBEDDING_QUERY]},
+        {'sface_embedding': {'$exists': False}},
+    ]}
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    """
+    Progress of an earlier run, or nothing if it targeted another embedding pipeline
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("pipeline") != embedding_pipeline():
+        # Users before last_id were embedded for another pipeline and need it again
+        logger.info(f"🔄 Ignoring checkpoint for {checkpoint.get('pipeline')}; starting over")
+        return {}
+    return checkpoint
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def backfill(collection,
+             workers: int,
+             batch_size: int,
+             checkpoint_path: str = CHECKPOINT_PATH,
+             reset: bool = False,
+             shortlist_only: bool = False) -> Dict[str, Any]:
+    """
+    Embed every user matching LEGACY_EMBEDDING_QUERY (or shortlist_query)
+
+    Args:
+        collection: pymongo users collection
+        workers: Worker processes (one model copy each)
+        batch_size: Users per worker task and per forward pass
+        checkpoint_path: JSON file holding progress between runs
+        reset: Start from the beginning instead of resuming
+        shortlist_only: Only add missing SFace shortlist embeddings
+
+    Returns:
+        Final checkpoint (counts and last fully written user id)
+    """
+    checkpoint = {} if reset else load_checkpoint(checkpoint_path)
+    checkpoint["pipeline"] = embedding_pipeline()
+    checkpoint.setdefault("embedded", 0)
+    checkpoint.setdefault("skipped", 0)
+    selection = shortlist_query() if shortlist_only else LEGACY_EMBEDDING_QUERY
+    query = {'$and': [selection, {'face_image': {'$exists': True}}]}
+    if checkpoint.get("last_id"):
+        query['$and'].append({'_id': {'$gt': ObjectId(checkpoint["last_id"])}})
+        logger.info(f"⏩ Resuming after {checkpoint['last_id']}")
+
+    cursor = collection.find(query, {'face_image': 1}).sort('_id', 1).batch_size(batch_size)
+    # Batches in submission order; the checkpoint only advances past a batch
+    # once it and all earlier batches have been written
+    pending = deque()
+    in_flight = set()
+    processed = 0
+    start = last_report = time.perf_counter()
+
+    def write(results: List[BackfillResult]):
+        nonlocal processed
+        # updated_at lets polling app workers pick the new embeddings up. Templates
+        # from an older pipeline are dropped; the centroid is the stored photo's embedding
+        now = datetime.now(timezone.utc)
+        changes = {} if shortlist_only else {'$unset': {'face_templates': ''}}
+        updates = [UpdateOne({'_id': ObjectId(user_id)}, {'$set': {**fields, 'updated_at': now}, **changes})
+                   for user_id, fields, _ in results if fields is not None]
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        for user_id, _, reason in results:
+            if reason is not None:
+                logger.warning(f"⚠️ Skipped {user_id}: {reason}")
+        checkpoint["embedded"] += len(updates)
+        checkpoint["skipped"] += len(results) - len(updates)
+        processed += len(results)
+
+    def drain():
+        nonlocal last_report
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            in_flight.discard(future)
+            write(future.result())
+        # Written batches have left in_flight; advance over the written prefix
+        while pending and pending[0][0] not in in_flight:
+            _, last_id = pending.popleft()
+            checkpoint["last_id"] = last_id
+        save_checkpoint(checkpoint_path, checkpoint)
+
+        now = time.perf_counter()
+        if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+            last_report = now
+            logger.info(f"📈 {processed} images, {processed / (now - start):.1f} images/s "
+                        f"({checkpoint['embedded']} embedded, {checkpoint['skipped']} skipped in total)")
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        # Never fork a process that may already have loaded TensorFlow
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_worker_init
+    )
+    try:
+        batch: List[Tuple[str, bytes]] = []
+        for user in cursor:
+            batch.append((str(user['_id']), user['face_image']))
+            if len(batch) < batch_size:
+                continue
+            future = executor.submit(_embed_users, batch, shortlist_only)
+            in_flight.add(future)
+            pending.append((future, batch[-1][0]))
+            batch = []
+            # Bound memory: keep at most two batches per worker outstanding
+            while len(in_flight) >= workers * 2:
+                drain()
+        if batch:
+            future = executor.submit(_embed_users, batch, shortlist_only)
+            in_flight.add(future)
+            pending.append((future, batch[-1][0]))
+        while in_flight:
+            drain()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    logger.info(f"✅ Backfill finished: {processed} images in {elapsed:.1f}s ({rate:.1f} images/s), "
+                f"{checkpoint['embedded']} embedded, {checkpoint['skipped']} skipped in total")
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--reset", action="store_true", help="Ignore the checkpoint and start over")
+    parser.add_argument("--database", default="attendance_db")
+    parser.add_argument("--shortlist-only", action="store_true",
+                        help="Only add SFace shortlist embeddings to users that lack one")
+    args = parser.parse_args()
+
+    passes = []
+    if not args.shortlist_only:
+        passes.append(False)
+    if CASCADE_ENABLED or args.shortlist_only:
+        passes.append(True)
+    client = MongoClient(MONGO_URI)
+    try:
+        for shortlist_only in passes:
+            backfill(
+                client[args.database].users,
+                workers=max(1, args.workers),
+                batch_size=max(1, args.batch_size),
+                checkpoint_path=f"{args.checkpoint}.shortlist" if shortlist_only else args.checkpoint,
+                reset=args.reset,
+                shortlist_only=shortlist_only
+            )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,205 @@
+"""
+Embedding inference backends for FastAttendanceVerifier
+
+Every backend takes a batch of preprocessed face crops (N, H, W, 3 float32,
+shaped exactly as DeepFace.represent prepares them) and returns an (N, D)
+embedding matrix.
+
+    tensorflow  DeepFace's Keras model (default)
+    onnx        ONNX Runtime session of the same weights
+    onnx-int8   Dynamically int8-quantized variant of the ONNX export
+
+Export the ONNX models once, then check they agree with TensorFlow:
+
+    python -m app.services.face_backends export --quantize
+    python -m app.services.face_backends parity --backend onnx-int8
+"""
+import argparse
+import logging
+import os
+from typing import Tuple, Dict, Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "tensorflow")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "models")
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", 0))  # 0 lets ONNX Runtime decide
+
+# Largest cosine distance tolerated between a backend's embedding and TensorFlow's
+# for the same face (the match threshold is 0.30)
+PARITY_TOLERANCE = 0.02
+
+BACKENDS = ("tensorflow", "onnx", "onnx-int8")
+
+
+def onnx_model_path(model_name: str, quantized: bool = False) -> str:
+    suffix = ".int8" if quantized else ""
+    return os.path.join(ONNX_MODEL_DIR, f"{model_name}{suffix}.onnx")
+
+
+class TensorFlowBackend:
+    name = "tensorflow"
+
+    def __init__(self, model_name: str):
+        from deepface import DeepFace
+
+        self.model_name = model_name
+        self._model = DeepFace.build_model(model_name)
+        self.input_shape: Tuple[int, int] = self._model.input_shape
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        if hasattr(self._model, "model") and callable(self._model.model):
+            return np.asarray(self._model.model(batch, training=False))
+        return np.asarray([self._model.forward(face[np.newaxis]) for face in batch])
+
+
+class OnnxBackend:
+    def __init__(self, model_name: str, quantized: bool = False, model_path: str = None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("The onnx backends need onnxruntime (pip install onnxruntime)") from e
+
+        self.name = "onnx-int8" if quantized else "onnx"
+        self.model_name = model_name
+        self.model_path = model_path or onnx_model_path(model_name, quantized)
+        if not os.path.exists(self.model_path):
+            raise RuntimeError(
+                f"{self.model_path} not found; run `python -m app.services.face_backends export"
+                f"{' --quantize' if quantized else ''}` first"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_THREADS:
+            options.intra_op_num_threads = ONNX_THREADS
+        self._session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        model_input = self._session.get_inputs()[0]
+        self._input_name = model_input.name
+        # NHWC input; input_shape follows DeepFace's (width, height) convention
+        self.input_shape = (int(model_input.shape[2]), int(model_input.shape[1]))
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        return self._session.run(None, {self._input_name: batch.astype(np.float32, copy=False)})[0]
+
+
+def build_backend(backend: str, model_name: str):
+    """
+    Instantiate an embedding backend by name
+    """
+    if backend == "tensorflow":
+        return TensorFlowBackend(model_name)
+    if backend == "onnx":
+        return OnnxBackend(model_name)
+    if backend == "onnx-int8":
+        return OnnxBackend(model_name, quantized=True)
+    raise ValueError(f"Unknown inference backend: {backend} (expected one of {BACKENDS})")
+
+
+def export_onnx(model_name: str = "Facenet512", quantize: bool = False, opset: int = 13) -> str:
+    """
+    Export DeepFace's Keras weights to ONNX (and optionally an int8 copy)
+
+    Returns:
+        Path of the last model written
+    """
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    os.makedirs(ONNX_MODEL_DIR, exist_ok=True)
+    client = DeepFace.build_model(model_name)
+    height, width = client.input_shape[1], client.input_shape[0]
+    signature = (tf.TensorSpec((None, height, width, 3), tf.float32, name="input"),)
+
+    path = onnx_model_path(model_name)
+    tf2onnx.convert.from_keras(client.model, input_signature=signature, opset=opset, output_path=path)
+    logger.info(f"✅ Exported {model_name} to {path}")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantized_path = onnx_model_path(model_name, quantized=True)
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+        logger.info(f"✅ Wrote int8-quantized {model_name} to {quantized_path}")
+        path = quantized_path
+    return path
+
+
+def parity_check(candidate, reference, faces: np.ndarray, tolerance: float = PARITY_TOLERANCE) -> Dict[str, Any]:
+    """
+    Compare two backends on the same preprocessed faces
+
+    Returns:
+        Worst/mean cosine distance between paired embeddings and whether the
+        worst case is within tolerance
+    """
+    a = candidate.forward(faces).astype(np.float64)
+    b = reference.forward(faces).astype(np.float64)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    distances = 1.0 - np.sum(a * b, axis=1)
+    return {
+        "backend": candidate.name,
+        "reference": reference.name,
+        "faces": len(faces),
+        "max_distance": float(distances.max()),
+        "mean_distance": float(distances.mean()),
+        "within_tolerance": bool(distances.max() <= tolerance),
+    }
+
+
+def load_faces(directory: str, model_name: str = "Facenet512") -> np.ndarray:
+    """
+    Preprocess every image in a directory into a batch of face crops
+    """
+    from app.services.face_service import FastAttendanceVerifier
+
+    verifier = FastAttendanceVerifier(model_name=model_name, warm_up=False)
+    tensors = []
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), "rb") as f:
+            img = verifier.decode(f.read())
+        if img is not None:
+            tensors.append(verifier.face_tensor(verifier.detect(img)))
+    return np.concatenate(tensors, axis=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and validate face embedding backends")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export Keras weights to ONNX")
+    export_parser.add_argument("--model", default="Facenet512")
+    export_parser.add_argument("--quantize", action="store_true", help="Also write an int8 model")
+
+    parity_parser = subparsers.add_parser("parity", help="Compare a backend against TensorFlow")
+    parity_parser.add_argument("--model", default="Facenet512")
+    parity_parser.add_argument("--backend", default="onnx", choices=BACKENDS[1:])
+    parity_parser.add_argument("--images", help="Directory of face photos (random crops if omitted)")
+    parity_parser.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_onnx(args.model, quantize=args.quantize)
+        return
+
+    reference = build_backend("tensorflow", args.model)
+    candidate = build_backend(args.backend, args.model)
+    if args.images:
+        faces = load_faces(args.images, args.model)
+    else:
+        height, width = reference.input_shape[1], reference.input_shape[0]
+        # Crops are RGB scaled to [0, 1] before 'base' normalization
+        faces = np.random.default_rng(0).random((32, height, width, 3), dtype=np.float32)
+    result = parity_check(candidate, reference, faces, tolerance=args.tolerance)
+    print(result)
+    if not result["within_tolerance"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
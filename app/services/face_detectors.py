@@ -0,0 +1,241 @@
+"""
+Face detector backends for FastAttendanceVerifier
+
+Every detector takes a decoded HxWx3 uint8 frame (as fast_preprocess returns
+it) and returns DeepFace-style face objects: 'face' (crop, channels reversed
+and scaled to [0, 1] exactly as DeepFace.extract_faces does), 'facial_area'
+(x, y, w, h, left_eye, right_eye) and 'confidence'. When no face is found the
+whole frame comes back with confidence 0, like extract_faces with
+enforce_detection disabled.
+
+    opencv      DeepFace's Haar cascade (default, no alignment)
+    yunet       OpenCV's DNN detector (cv2.FaceDetectorYN) run on a frame
+                downscaled to YUNET_INPUT_WIDTH; its eye landmarks level the
+                face before it is cropped
+    other       Any other DeepFace detector_backend (ssd, mtcnn, retinaface, ...)
+
+YuNet needs the model from the OpenCV model zoo:
+
+    python -m app.services.face_detectors download
+
+Switching detectors shifts embeddings slightly. Stored embeddings record the
+detector that produced them, so after changing DETECTOR_BACKEND employees
+embedded with another detector drop out of the gallery onto the legacy path
+until `python -m app.services.backfill_embeddings` re-embeds them.
+"""
+import argparse
+import logging
+import math
+import os
+import threading
+import urllib.request
+from typing import Optional, Dict, Any, List, Tuple
+
+import cv2
+import numpy as np
+
+from app.services.face_backends import ONNX_MODEL_DIR
+
+logger = logging.getLogger(__name__)
+
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "opencv")
+YUNET_MODEL_PATH = os.getenv("YUNET_MODEL_PATH", os.path.join(ONNX_MODEL_DIR, "face_detection_yunet_2023mar.onnx"))
+YUNET_MODEL_URL = (
+    "https://github.com/opencv/opencv_zoo/raw/main/models/"
+    "face_detection_yunet/face_detection_yunet_2023mar.onnx"
+)
+# Frames are detected at this width; boxes and landmarks are scaled back
+YUNET_INPUT_WIDTH = int(os.getenv("YUNET_INPUT_WIDTH", 320))
+YUNET_SCORE_THRESHOLD = float(os.getenv("YUNET_SCORE_THRESHOLD", 0.8))
+YUNET_NMS_THRESHOLD = 0.3
+
+# Detectors the benchmark tries by default; any DeepFace name also works
+DETECTORS = ("opencv", "yunet")
+
+
+def whole_frame(img: np.ndarray) -> Dict[str, Any]:
+    """The face object for a frame in which no face was found"""
+    height, width = img.shape[:2]
+    return {
+        'face': img[:, :, ::-1].astype(np.float32) / 255,
+        'facial_area': {'x': 0, 'y': 0, 'w': width, 'h': height, 'left_eye': None, 'right_eye': None},
+        'confidence': 0,
+    }
+
+
+class DeepFaceDetector:
+    def __init__(self, name: str, align: bool = False):
+        """
+        A DeepFace detector_backend, called through DeepFace.extract_faces
+
+        Args:
+            name: DeepFace detector backend
+            align: Let DeepFace rotate the face upright using its eye detection
+        """
+        self.name = name
+        self.align = align
+
+    def detect(self, img: np.ndarray) -> List[Dict[str, Any]]:
+        from deepface import DeepFace
+
+        return DeepFace.extract_faces(
+            img_path=img,
+            detector_backend=self.name,
+            enforce_detection=False,
+            align=self.align
+        )
+
+
+class YuNetDetector:
+    name = "yunet"
+
+    def __init__(self,
+                 model_path: str = YUNET_MODEL_PATH,
+                 input_width: int = YUNET_INPUT_WIDTH,
+                 score_threshold: float = YUNET_SCORE_THRESHOLD,
+                 align: bool = True):
+        """
+        OpenCV's YuNet face detector
+
+        Args:
+            model_path: face_detection_yunet ONNX model
+            input_width: Width frames are downscaled to before detection
+            score_threshold: Minimum face score
+            align: Rotate each crop so the eyes are level
+        """
+        if not os.path.exists(model_path):
+            raise RuntimeError(f"{model_path} not found; run `python -m app.services.face_detectors download` first")
+        self.model_path = model_path
+        self.input_width = input_width
+        self.score_threshold = score_threshold
+        self.align = align
+        # FaceDetectorYN keeps per-call state (input size), so one per thread
+        self._local = threading.local()
+
+    def _detector(self, size: Tuple[int, int]):
+        detector = getattr(self._local, "detector", None)
+        if detector is None:
+            detector = cv2.FaceDetectorYN.create(
+                self.model_path, "", size, self.score_threshold, YUNET_NMS_THRESHOLD
+            )
+            self._local.detector = detector
+        else:
+            detector.setInputSize(size)
+        return detector
+
+    def boxes(self, img: np.ndarray) -> np.ndarray:
+        """
+        Raw detections in frame coordinates
+
+        Returns:
+            (N, 15) float32: x, y, w, h, five (x, y) landmarks (right eye, left
+            eye, nose tip, right and left mouth corner), score
+        """
+        height, width = img.shape[:2]
+        scale = min(1.0, self.input_width / width)
+        small = img if scale == 1.0 else cv2.resize(
+            img, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA
+        )
+        if small.ndim == 2:
+            small = cv2.cvtColor(small, cv2.COLOR_GRAY2BGR)
+        else:
+            # fast_preprocess decodes to RGB; the network was trained on BGR
+            small = cv2.cvtColor(small, cv2.COLOR_RGB2BGR)
+        _, faces = self._detector((small.shape[1], small.shape[0])).detect(small)
+        if faces is None:
+            return np.empty((0, 15), dtype=np.float32)
+        faces = faces.copy()
+        faces[:, :14] /= scale
+        return faces
+
+    def detect(self, img: np.ndarray) -> List[Dict[str, Any]]:
+        faces = []
+        for row in self.boxes(img):
+            x, y, w, h = (int(round(v)) for v in row[:4])
+            right_eye = (int(round(row[4])), int(round(row[5])))
+            left_eye = (int(round(row[6])), int(round(row[7])))
+            crop = align_crop(img, (x, y, w, h), left_eye, right_eye) if self.align else clip_crop(img, (x, y, w, h))
+            if crop.size == 0:
+                continue
+            faces.append({
+                'face': crop[:, :, ::-1].astype(np.float32) / 255,
+                'facial_area': {'x': x, 'y': y, 'w': w, 'h': h, 'left_eye': left_eye, 'right_eye': right_eye},
+                'confidence': float(row[14]),
+            })
+        return faces or [whole_frame(img)]
+
+
+def clip_crop(img: np.ndarray, box: Tuple[int, int, int, int]) -> np.ndarray:
+    x, y, w, h = box
+    x0, y0 = max(0, x), max(0, y)
+    return img[y0:max(y0, y + h), x0:max(x0, x + w)]
+
+
+def align_crop(img: np.ndarray,
+               box: Tuple[int, int, int, int],
+               left_eye: Tuple[int, int],
+               right_eye: Tuple[int, int]) -> np.ndarray:
+    """
+    Crop a face box rotated about its centre so the eyes are level
+
+    A single warpAffine straight into a box-sized output, so only the face is
+    resampled rather than the whole frame.
+    """
+    x, y, w, h = box
+    if w <= 0 or h <= 0:
+        return img[:0, :0]
+    # The subject's right eye is on the left of the image
+    angle = math.degrees(math.atan2(left_eye[1] - right_eye[1], left_eye[0] - right_eye[0]))
+    centre = (x + w / 2, y + h / 2)
+    matrix = cv2.getRotationMatrix2D(centre, angle, 1.0)
+    matrix[0, 2] += w / 2 - centre[0]
+    matrix[1, 2] += h / 2 - centre[1]
+    return cv2.warpAffine(img, matrix, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def build_detector(name: str):
+    """
+    Instantiate a face detector by name
+    """
+    if name == "yunet":
+        return YuNetDetector()
+    return DeepFaceDetector(name)
+
+
+_shared_yunet: Optional[YuNetDetector] = None
+_shared_yunet_lock = threading.Lock()
+
+
+def shared_yunet() -> YuNetDetector:
+    """Process-wide YuNet detector for callers that only need boxes"""
+    global _shared_yunet
+    if _shared_yunet is None:
+        with _shared_yunet_lock:
+            if _shared_yunet is None:
+                _shared_yunet = YuNetDetector(align=False)
+    return _shared_yunet
+
+
+def download_yunet(path: str = YUNET_MODEL_PATH, url: str = YUNET_MODEL_URL) -> str:
+    """
+    Fetch the YuNet model from the OpenCV model zoo
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    urllib.request.urlretrieve(url, path)
+    logger.info(f"✅ Downloaded YuNet to {path}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage face detector models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    download_parser = subparsers.add_parser("download", help="Download the YuNet model")
+    download_parser.add_argument("--path", default=YUNET_MODEL_PATH)
+    args = parser.parse_args()
+    if args.command == "download":
+        download_yunet(args.path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,549 @@
+import numpy as np
+import mmap
+import tempfile
+import threading
+import logging
+import time
+from typing import Tuple, Optional, Dict, Any, List, Sequence, Iterable
+
+logger = logging.getLogger(__name__)
+
+SCAN_DTYPES = ("float32", "float16", "int8")
+# Rows converted to float32 at a time when scanning a compact matrix
+SCAN_BLOCK_ROWS = 256
+
+
+class FaceGallery:
+    def __init__(self,
+                 dimension: Optional[int] = None,
+                 initial_capacity: int = 256,
+                 scan_dtype: str = "float32",
+                 rescore_k: int = 32,
+                 rows_dir: Optional[str] = None):
+        """
+        In-memory 1:N identification engine over employee embeddings
+
+        All embeddings live in one contiguous, L2-normalized float32 matrix so a
+        probe is scored against the whole gallery with a single matrix-vector
+        product. Rows are kept dense: removing an identity moves the last row
+        into the freed slot.
+
+        An identity may also carry several per-capture templates. The main row
+        is then their centroid: probes are scored against centroids first and
+        only the closest few identities have their templates compared, so extra
+        templates cost O(rerank_k * templates) rather than O(N * templates).
+
+        The matrix may be a read-only memory map of a published snapshot (see
+        load_state); the first local change then copies it into private memory
+        (or the rows file of a compact gallery, below).
+
+        With a compact scan_dtype the full scan runs over a float16 or per-row
+        int8-quantized copy of the matrix and only the rescore_k best rows are
+        re-scored exactly in float32. The float32 rows then live in an unlinked
+        file under rows_dir (or the snapshot they were mapped from) instead of
+        process memory: only the rows a probe re-scores are paged in, so the
+        gallery's resident size is the compact copy, 1/2 (float16) or ~1/4
+        (int8) of float32. The scan itself is slower than the float32 BLAS
+        scan, since NumPy converts each block to float32 first.
+        An attached ANN index (attach_index) replaces the full scan altogether
+        for large galleries; its candidates are re-scored the same way.
+
+        Args:
+            dimension: Embedding size; inferred from the first embedding if None
+            initial_capacity: Rows pre-allocated before the first resize
+            scan_dtype: 'float32', 'float16' or 'int8'
+            rescore_k: Rows re-scored exactly after a compact scan
+            rows_dir: Directory for the float32 rows of a compact gallery (system temp dir if None)
+        """
+        if scan_dtype not in SCAN_DTYPES:
+            raise ValueError(f"Unknown scan dtype: {scan_dtype} (expected one of {SCAN_DTYPES})")
+        self.dimension = dimension
+        self.scan_dtype = scan_dtype
+        self.rescore_k = max(1, rescore_k)
+        self.rows_dir = rows_dir
+        # Compact copy of the matrix (and int8 row scales); rebuilt lazily when stale
+        self._scan: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._scan_stale = True
+        # Optional ANN index (see face_index) used for full scans of large galleries
+        self._index = None
+        self._index_min_size = 0
+        self._initial_capacity = max(1, initial_capacity)
+        self._matrix = self._allocate(self._initial_capacity)
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._templates: Dict[str, np.ndarray] = {}
+        self._lock = threading.RLock()
+        # Bumped on every local change; snapshot publishers compare it
+        self.generation = 0
+        self.modified_at = 0.0
+        # Generation at which each identity's row last changed, and of the
+        # last wholesale load_state; attach_index uses them to find rows an
+        # index built from an older export holds stale vectors for
+        self._changed: Dict[str, int] = {}
+        self._loaded_generation = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, identity: str) -> bool:
+        return identity in self._rows
+
+    @property
+    def ids(self) -> List[str]:
+        return list(self._ids)
+
+    def _normalize(self, embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self.dimension is None:
+            self.dimension = vector.shape[0]
+            self._matrix = self._allocate(self._initial_capacity)
+            self._scan_stale = True
+        if vector.shape[0] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-d embedding, got {vector.shape[0]}")
+        norm = np.linalg.norm(vector)
+        return vector if norm == 0 else vector / norm
+
+    def _normalize_templates(self, templates: Sequence[Sequence[float]]) -> np.ndarray:
+        matrix = np.asarray(templates, dtype=np.float32).reshape(len(templates), -1)
+        if matrix.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-d templates, got {matrix.shape[1]}")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+    def _allocate(self, capacity: int) -> np.ndarray:
+        """Zeroed float32 rows: in memory, or file-backed for a compact scan"""
+        if self.scan_dtype == "float32" or not self.dimension:
+            return np.zeros((capacity, self.dimension or 0), dtype=np.float32)
+        return np.memmap(tempfile.TemporaryFile(dir=self.rows_dir), dtype=np.float32, mode="w+",
+                         shape=(capacity, self.dimension))
+
+    def _release_rows(self):
+        """
+        Drop the pages of file-backed rows after touching all of them (bulk
+        copies, scan rebuilds, exports); the file keeps the data and only the
+        rows re-scored later are paged back in
+        """
+        rows_map = getattr(self._matrix, "_mmap", None)
+        if rows_map is not None and self.scan_dtype != "float32" and hasattr(mmap, "MADV_DONTNEED"):
+            rows_map.madvise(mmap.MADV_DONTNEED)
+
+    def _touch(self):
+        self.generation += 1
+        self.modified_at = time.time()
+
+    def _quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if self.scan_dtype == "float16":
+            return vectors.astype(np.float16), None
+        # Symmetric per-row scale so every row uses the full int8 range
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _rebuild_scan(self):
+        capacity, count = self._matrix.shape[0], len(self._ids)
+        dtype = np.float16 if self.scan_dtype == "float16" else np.int8
+        self._scan = np.zeros((capacity, self.dimension or 0), dtype=dtype)
+        self._scales = np.ones(capacity, dtype=np.float32)
+        for start in range(0, count, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, count)
+            quantized, scales = self._quantize(np.asarray(self._matrix[start:stop], dtype=np.float32))
+            self._scan[start:stop] = quantized
+            if scales is not None:
+                self._scales[start:stop] = scales
+        self._scan_stale = False
+        self._release_rows()
+
+    def _write_scan(self, row: int):
+        if self.scan_dtype == "float32" or self._scan_stale:
+            return
+        quantized, scales = self._quantize(np.asarray(self._matrix[row:row + 1], dtype=np.float32))
+        self._scan[row] = quantized[0]
+        if scales is not None:
+            self._scales[row] = scales[0]
+
+    def _approximate_similarities(self, query: np.ndarray, count: int) -> np.ndarray:
+        if self._scan_stale:
+            self._rebuild_scan()
+        similarities = np.empty(count, dtype=np.float32)
+        # One small float32 block reused for every conversion stays in cache
+        block = np.empty((SCAN_BLOCK_ROWS, self.dimension), dtype=np.float32)
+        for start in range(0, count, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, count)
+            rows = block[:stop - start]
+            np.copyto(rows, self._scan[start:stop], casting="unsafe")
+            np.dot(rows, query, out=similarities[start:stop])
+        if self.scan_dtype == "int8":
+            similarities *= self._scales[:count]
+        return similarities
+
+    def _ensure_writable(self):
+        if self._matrix.flags.writeable:
+            return
+        count = len(self._ids)
+        writable = self._allocate(max(self._initial_capacity, count * 2, 1))
+        writable[:count] = self._matrix[:count]
+        self._matrix = writable
+        self._scan_stale = True
+        self._release_rows()
+
+    def _ensure_capacity(self, rows: int):
+        if rows <= self._matrix.shape[0]:
+            return
+        capacity = self._matrix.shape[0]
+        while capacity < rows:
+            capacity *= 2
+        grown = self._allocate(capacity)
+        grown[:len(self._ids)] = self._matrix[:len(self._ids)]
+        self._matrix = grown
+        self._scan_stale = True
+        self._release_rows()
+
+    def add(self,
+            identity: str,
+            embedding: Sequence[float],
+            metadata: Optional[Dict[str, Any]] = None,
+            templates: Optional[Sequence[Sequence[float]]] = None):
+        """
+        Add an identity, or replace its embedding if it is already present
+
+        Args:
+            identity: Identity key
+            embedding: Single embedding, or the centroid of templates
+            metadata: Extra fields returned by get_metadata
+            templates: Optional per-capture embeddings re-ranked after the centroid scan
+        """
+        with self._lock:
+            # _normalize allocates the matrix on the first add, so it must run
+            # under the lock like every other write to _matrix
+            vector = self._normalize(embedding)
+            self._ensure_writable()
+            if templates is not None and len(templates):
+                self._templates[identity] = self._normalize_templates(templates)
+            else:
+                self._templates.pop(identity, None)
+            row = self._rows.get(identity)
+            if row is None:
+                row = len(self._ids)
+                self._ensure_capacity(row + 1)
+                self._ids.append(identity)
+                self._rows[identity] = row
+            self._matrix[row] = vector
+            self._write_scan(row)
+            if self._index is not None:
+                self._index.add(identity, vector)
+            self._metadata[identity] = dict(metadata or {})
+            self._touch()
+            self._changed[identity] = self.generation
+
+    def update(self,
+               identity: str,
+               embedding: Optional[Sequence[float]] = None,
+               metadata: Optional[Dict[str, Any]] = None,
+               templates: Optional[Sequence[Sequence[float]]] = None) -> bool:
+        """
+        Update an identity's embedding, templates and/or metadata in place
+
+        Returns:
+            False if the identity is not in the gallery
+        """
+        with self._lock:
+            row = self._rows.get(identity)
+            if row is None:
+                return False
+            self._ensure_writable()
+            if embedding is not None:
+                self._matrix[row] = self._normalize(embedding)
+                self._write_scan(row)
+                if self._index is not None:
+                    self._index.add(identity, self._matrix[row])
+            if templates is not None:
+                self._templates[identity] = self._normalize_templates(templates)
+            if metadata is not None:
+                self._metadata[identity].update(metadata)
+            self._touch()
+            if embedding is not None:
+                self._changed[identity] = self.generation
+            return True
+
+    def remove(self, identity: str) -> bool:
+        """
+        Remove an identity, keeping the matrix rows contiguous
+        """
+        with self._lock:
+            if identity not in self._rows:
+                return False
+            self._ensure_writable()
+            row = self._rows.pop(identity)
+            last = len(self._ids) - 1
+            if row != last:
+                moved = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._write_scan(row)
+                self._ids[row] = moved
+                self._rows[moved] = row
+            self._ids.pop()
+            self._matrix[last] = 0
+            self._write_scan(last)
+            self._metadata.pop(identity, None)
+            self._templates.pop(identity, None)
+            self._changed.pop(identity, None)
+            if self._index is not None:
+                self._index.remove(identity)
+            self._touch()
+            return True
+
+    def clear(self):
+        with self._lock:
+            if self._index is not None:
+                for identity in self._ids:
+                    self._index.remove(identity)
+            self._ids.clear()
+            self._rows.clear()
+            self._metadata.clear()
+            self._templates.clear()
+            self._changed.clear()
+            if self._matrix.flags.writeable:
+                self._matrix[:] = 0
+                self._release_rows()
+            else:
+                self._matrix = self._allocate(self._initial_capacity)
+            self._scan_stale = True
+            self._touch()
+
+    def _stale_in_index(self, index, indexed: set, since_generation: Optional[int]) -> List[str]:
+        # Caller holds the lock
+        if since_generation is not None and since_generation > self._loaded_generation:
+            return [identity for identity, generation in self._changed.items()
+                    if generation > since_generation and identity in indexed]
+        # Loaded from disk, or the rows were replaced wholesale since the
+        # export: compare every indexed vector with its row
+        identities = [identity for identity in self._ids if identity in indexed]
+        stale = []
+        for start in range(0, len(identities), SCAN_BLOCK_ROWS):
+            block = identities[start:start + SCAN_BLOCK_ROWS]
+            rows = np.asarray(self._matrix[[self._rows[identity] for identity in block]], dtype=np.float32)
+            changed = np.abs(index.vectors(block) - rows).max(axis=1) > 1e-5
+            stale.extend(identity for identity, flag in zip(block, changed) if flag)
+        return stale
+
+    def attach_index(self, index, min_size: int = 0, since_generation: Optional[int] = None):
+        """
+        Use an ANN index for full scans once the gallery has min_size rows
+
+        The index is first reconciled with the current rows, since it may have
+        been built from an older export or loaded from disk: missing ids are
+        added, departed ones removed and ids whose row changed re-added. Its
+        candidates are always re-scored exactly against this gallery's rows.
+
+        Args:
+            index: IVFIndex or HnswIndex (see face_index)
+            min_size: Below this many rows the exact scan is used
+            since_generation: Generation of the export the index was built
+                from; None (e.g. loaded from disk) compares every vector
+
+        Returns:
+            Number of ids re-added because their row had changed
+        """
+        with self._lock:
+            indexed = index.identities()
+            for identity in indexed - self._rows.keys():
+                index.remove(identity)
+            stale = self._stale_in_index(index, indexed, since_generation)
+            for identity in (self._rows.keys() - indexed).union(stale):
+                index.add(identity, np.asarray(self._matrix[self._rows[identity]], dtype=np.float32))
+            self._release_rows()
+            self._index = index
+            self._index_min_size = min_size
+            return len(stale)
+
+    def save_index(self, directory: str):
+        with self._lock:
+            if self._index is not None:
+                self._index.save(directory)
+
+    def export_state(self) -> Tuple[np.ndarray, List[str], Dict[str, Dict[str, Any]], Dict[str, np.ndarray], int]:
+        """
+        Consistent copy of the gallery for publishing a snapshot
+
+        Returns:
+            (matrix, ids, metadata, templates, generation); matrix has one row per id
+        """
+        with self._lock:
+            count = len(self._ids)
+            matrix = np.array(self._matrix[:count], dtype=np.float32)
+            self._release_rows()
+            return (
+                matrix,
+                list(self._ids),
+                {identity: dict(meta) for identity, meta in self._metadata.items()},
+                dict(self._templates),
+                self.generation
+            )
+
+    def load_state(self,
+                   matrix: np.ndarray,
+                   ids: List[str],
+                   metadata: Dict[str, Dict[str, Any]],
+                   templates: Optional[Dict[str, np.ndarray]] = None,
+                   if_generation: Optional[int] = None) -> bool:
+        """
+        Atomically replace the whole gallery, e.g. with a memory-mapped snapshot
+
+        The arrays are used as-is (no copy), so read-only maps stay shared
+        between processes until the next local change. Rows must already be
+        L2-normalized, as export_state produces them.
+
+        Args:
+            if_generation: Only replace if no local change happened since this generation
+
+        Returns:
+            False if skipped because of a newer local change
+        """
+        if matrix.shape[0] != len(ids):
+            raise ValueError(f"Snapshot has {matrix.shape[0]} rows for {len(ids)} ids")
+        with self._lock:
+            if if_generation is not None and self.generation != if_generation:
+                return False
+            if self._index is not None:
+                # Ids present on both sides were already updated in the index
+                # when the change was applied locally
+                for identity in self._rows.keys() - set(ids):
+                    self._index.remove(identity)
+                for row, identity in enumerate(ids):
+                    if identity not in self._rows:
+                        self._index.add(identity, np.asarray(matrix[row], dtype=np.float32))
+            if matrix.shape[0]:
+                self.dimension = matrix.shape[1]
+            self._matrix = matrix if matrix.shape[0] else self._allocate(self._initial_capacity)
+            self._ids = list(ids)
+            self._rows = {identity: row for row, identity in enumerate(self._ids)}
+            self._metadata = {identity: dict(metadata.get(identity) or {}) for identity in self._ids}
+            self._templates = dict(templates or {})
+            self._changed = {}
+            self._loaded_generation = self.generation
+            self._scan_stale = True
+            return True
+
+    def get_metadata(self, identity: str) -> Optional[Dict[str, Any]]:
+        return self._metadata.get(identity)
+
+    def get_embedding(self, identity: str) -> Optional[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """
+        Copy of an identity's normalized row and templates, or None if absent
+        """
+        with self._lock:
+            row = self._rows.get(identity)
+            if row is None:
+                return None
+            templates = self._templates.get(identity)
+            return (
+                np.array(self._matrix[row], dtype=np.float32),
+                None if templates is None else np.array(templates, dtype=np.float32)
+            )
+
+    def search(self,
+               probe: Sequence[float],
+               top_k: int = 5,
+               candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        Score a probe against the whole gallery, or only against candidates
+
+        Args:
+            probe: Live embedding (normalized here)
+            top_k: Number of candidates to return
+            candidates: Optional identities to restrict the scan to (unknown ones are ignored)
+
+        Returns:
+            List of (identity, cosine_distance) sorted by ascending distance
+        """
+        with self._lock:
+            count = len(self._ids)
+            if count == 0 or top_k <= 0:
+                return []
+            query = self._normalize(probe)
+
+            shortlist = max(top_k, self.rescore_k)
+            rows = None
+            if candidates is None and self._index is not None and self._index.trained \
+                    and count >= self._index_min_size:
+                # ANN candidates, re-scored exactly in float32
+                hits = self._index.search(query, shortlist)
+                rows = np.fromiter((self._rows[i] for i, _ in hits if i in self._rows), dtype=np.int64)
+                if rows.size == 0:
+                    rows = None
+            if rows is not None:
+                distances = 1.0 - self._matrix[rows] @ query
+            elif candidates is None and self.scan_dtype != "float32" and count > shortlist:
+                # Compact scan of every row, then exact float32 scores for the best few
+                similarities = self._approximate_similarities(query, count)
+                rows = np.argpartition(-similarities, shortlist - 1)[:shortlist]
+                distances = 1.0 - self._matrix[rows] @ query
+            elif candidates is None:
+                distances = 1.0 - self._matrix[:count] @ query
+            else:
+                rows = np.fromiter(
+                    (self._rows[c] for c in candidates if c in self._rows),
+                    dtype=np.int64
+                )
+                if rows.size == 0:
+                    return []
+                distances = 1.0 - self._matrix[rows] @ query
+            # Keep only the compact copy resident; the re-scored rows stay in
+            # the page cache should the next probe need them again
+            self._release_rows()
+
+            k = min(top_k, distances.shape[0])
+            if k < distances.shape[0]:
+                order = np.argpartition(distances, k - 1)[:k]
+            else:
+                order = np.arange(distances.shape[0])
+            order = order[np.argsort(distances[order])]
+            row_ids = order if rows is None else rows[order]
+            return [(self._ids[row], float(distances[i])) for row, i in zip(row_ids, order)]
+
+    def search_templates(self,
+                         probe: Sequence[float],
+                         top_k: int = 5,
+                         rerank_k: int = 5,
+                         candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        Centroid scan, then per-template re-rank of the closest rerank_k identities
+
+        An identity's distance is the smallest over its centroid and templates.
+
+        Returns:
+            List of (identity, cosine_distance) sorted by ascending distance
+        """
+        with self._lock:
+            shortlist = self.search(probe, top_k=max(top_k, rerank_k), candidates=candidates)
+            if not shortlist or not self._templates:
+                return shortlist[:top_k]
+            query = self._normalize(probe)
+            reranked = []
+            for identity, distance in shortlist:
+                templates = self._templates.get(identity)
+                if templates is not None:
+                    distance = min(distance, float(1.0 - np.max(templates @ query)))
+                reranked.append((identity, distance))
+        reranked.sort(key=lambda item: item[1])
+        return reranked[:top_k]
+
+    def best_match(self,
+                   probe: Sequence[float],
+                   threshold: Optional[float] = None,
+                   candidates: Optional[Iterable[str]] = None,
+                   rerank_k: int = 5) -> Optional[Tuple[str, float]]:
+        """
+        Closest identity, or None if the gallery is empty or the distance exceeds threshold
+
+        Identities with templates are re-ranked among the rerank_k closest centroids.
+        """
+        results = self.search_templates(probe, top_k=1, rerank_k=rerank_k, candidates=candidates)
+        if not results:
+            return None
+        identity, distance = results[0]
+        if threshold is not None and distance > threshold:
+            return None
+        return identity, distance
@@ -0,0 +1,495 @@
+"""
+Approximate nearest-neighbour indexes for large face galleries
+
+Below a few tens of thousands of employees the exact FaceGallery scan is fast
+enough. Past that, a FaceGallery with an attached index asks it for the
+closest identities instead of scoring every row:
+
+    ivf   Inverted file index in NumPy: k-means coarse centroids, each list
+          holding its members' normalized float32 vectors. A probe is scored
+          exactly against the IVF_NPROBE lists whose centroids are closest.
+    hnsw  hnswlib graph index (pip install hnswlib), cosine space.
+
+Both support incremental add/remove (registrations and deletions in the admin
+routes go through the gallery) and save/load to ANN_INDEX_DIR. A saved index
+records the embedding pipeline it was built for and is discarded (then rebuilt)
+under any other; one that is loaded is checked vector by vector against the
+gallery, so rows re-embedded while it was on disk are re-indexed.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Tuple, Optional, Dict, Any, List, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANN_INDEX = os.getenv("ANN_INDEX", "none")  # none | ivf | hnsw
+ANN_INDEX_DIR = os.getenv("ANN_INDEX_DIR") or None
+# Galleries smaller than this are scanned exactly even when an index exists
+ANN_MIN_SIZE = int(os.getenv("ANN_MIN_SIZE", 20000))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", 32))
+HNSW_EF = int(os.getenv("HNSW_EF", 64))
+# How often the app checks whether the index must be (re)built
+ANN_MAINTAIN_INTERVAL = float(os.getenv("ANN_MAINTAIN_INTERVAL", 60.0))
+
+ANN_INDEXES = ("none", "ivf", "hnsw")
+# Written next to a saved index: its kind and the embedding pipeline of its vectors
+MANIFEST_FILE = "manifest.json"
+
+
+def _write_atomic(path: str, write):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def spherical_kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    k-means on the unit sphere (cosine), returning normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.bincount(assignment, minlength=clusters) == 0
+        # Re-seed empty clusters from random points
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = _normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    name = "ivf"
+
+    def __init__(self, dimension: int, nprobe: int = IVF_NPROBE):
+        """
+        Inverted file index with exact (flat) scoring inside the probed lists
+
+        Args:
+            dimension: Embedding size
+            nprobe: Lists scored per query; higher is slower but more accurate
+        """
+        self.dimension = dimension
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self._vectors: List[np.ndarray] = []
+        self._sizes: List[int] = []
+        self._ids: List[List[str]] = []
+        self._where: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def identities(self) -> set:
+        return set(self._where)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def needs_training(self, retrain_factor: float = 4.0) -> bool:
+        """True if the index was never trained or has grown well past its training set"""
+        return not self.trained or len(self) > retrain_factor * max(self.trained_size, 1)
+
+    def train(self, vectors: np.ndarray, ids: Sequence[str], sample: int = 64):
+        """
+        Learn ~sqrt(N) coarse centroids from a sample and (re)assign every vector
+        """
+        vectors = _normalize_rows(vectors)
+        lists = int(np.clip(np.sqrt(len(vectors)), 1, 65536))
+        rng = np.random.default_rng(0)
+        training = vectors
+        if len(vectors) > lists * sample:
+            training = vectors[rng.choice(len(vectors), lists * sample, replace=False)]
+        self.centroids = spherical_kmeans(training, lists)
+        self.trained_size = len(vectors)
+
+        self._where.clear()
+        assignment = self._assign(vectors)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(lists + 1))
+        self._vectors, self._sizes, self._ids = [], [], []
+        for list_no in range(lists):
+            members = order[bounds[list_no]:bounds[list_no + 1]]
+            self._vectors.append(vectors[members].copy() if len(members) else np.zeros((4, self.dimension), np.float32))
+            self._sizes.append(len(members))
+            self._ids.append([ids[i] for i in members])
+            for position, i in enumerate(members):
+                self._where[ids[i]] = (list_no, position)
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), 65536):
+            assignment[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ self.centroids.T, axis=1)
+        return assignment
+
+    def add(self, identity: str, vector: np.ndarray):
+        if not self.trained:
+            return
+        self.remove(identity)
+        vector = _normalize_rows(vector.reshape(1, -1))[0]
+        list_no = int(np.argmax(self.centroids @ vector))
+        size = self._sizes[list_no]
+        if size == len(self._vectors[list_no]):
+            grown = np.zeros((max(4, size * 2), self.dimension), dtype=np.float32)
+            grown[:size] = self._vectors[list_no][:size]
+            self._vectors[list_no] = grown
+        self._vectors[list_no][size] = vector
+        self._ids[list_no].append(identity)
+        self._sizes[list_no] = size + 1
+        self._where[identity] = (list_no, size)
+
+    def remove(self, identity: str) -> bool:
+        location = self._where.pop(identity, None)
+        if location is None:
+            return False
+        list_no, position = location
+        last = self._sizes[list_no] - 1
+        if position != last:
+            moved = self._ids[list_no][last]
+            self._vectors[list_no][position] = self._vectors[list_no][last]
+            self._ids[list_no][position] = moved
+            self._where[moved] = (list_no, position)
+        self._ids[list_no].pop()
+        self._sizes[list_no] = last
+        return True
+
+    def vectors(self, identities: Sequence[str]) -> np.ndarray:
+        """Indexed (normalized) vectors of identities already in the index"""
+        if not identities:
+            return np.zeros((0, self.dimension), np.float32)
+        return np.stack([self._vectors[list_no][position] for list_no, position in
+                         (self._where[identity] for identity in identities)])
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        if not self.trained or not self._where:
+            return []
+        nprobe = min(self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        ids, scores = [], []
+        for list_no in probed:
+            size = self._sizes[list_no]
+            if size:
+                scores.append(self._vectors[list_no][:size] @ query)
+                ids.extend(self._ids[list_no])
+        if not ids:
+            return []
+        distances = 1.0 - np.concatenate(scores)
+        k = min(k, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(ids[i], float(distances[i])) for i in top]
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        sizes = np.asarray(self._sizes, dtype=np.int64)
+        vectors = np.concatenate([v[:s] for v, s in zip(self._vectors, self._sizes)]) if len(self) else \
+            np.zeros((0, self.dimension), np.float32)
+        _write_atomic(os.path.join(directory, "ivf.npz"),
+                      lambda f: np.savez(f, centroids=self.centroids, sizes=sizes, vectors=vectors))
+        meta = {"dimension": self.dimension, "trained_size": self.trained_size,
+                "ids": [identity for ids in self._ids for identity in ids]}
+        _write_atomic(os.path.join(directory, "ivf.json"), lambda f: f.write(json.dumps(meta).encode()))
+
+    @classmethod
+    def load(cls, directory: str, nprobe: int = IVF_NPROBE) -> "IVFIndex":
+        with open(os.path.join(directory, "ivf.json")) as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(directory, "ivf.npz"))
+        index = cls(meta["dimension"], nprobe=nprobe)
+        index.centroids = arrays["centroids"]
+        index.trained_size = meta["trained_size"]
+        vectors, ids, offset = arrays["vectors"], meta["ids"], 0
+        for list_no, size in enumerate(arrays["sizes"].tolist()):
+            index._vectors.append(vectors[offset:offset + size].copy() if size else np.zeros((4, index.dimension), np.float32))
+            index._sizes.append(size)
+            index._ids.append(ids[offset:offset + size])
+            for position, identity in enumerate(index._ids[-1]):
+                index._where[identity] = (list_no, position)
+            offset += size
+        return index
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"type": self.name, "size": len(self), "lists": len(self._sizes),
+                "nprobe": self.nprobe, "trained_size": self.trained_size}
+
+
+class HnswIndex:
+    name = "hnsw"
+
+    def __init__(self, dimension: int, ef: int = HNSW_EF, m: int = 16, ef_construction: int = 200):
+        """
+        hnswlib graph index keyed by identity (hnswlib itself uses int labels)
+        """
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise RuntimeError("ANN_INDEX=hnsw needs hnswlib (pip install hnswlib)") from e
+        self.dimension = dimension
+        self.ef = ef
+        self._hnswlib = hnswlib
+        self._index = hnswlib.Index(space="cosine", dim=dimension)
+        self._index.init_index(max_elements=1024, ef_construction=ef_construction, M=m, allow_replace_deleted=True)
+        self._index.set_ef(ef)
+        self._labels: Dict[str, int] = {}
+        self._identities: Dict[int, str] = {}
+        self._next_label = 0
+        self.trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def identities(self) -> set:
+        return set(self._labels)
+
+    @property
+    def trained(self) -> bool:
+        return True
+
+    def needs_training(self, retrain_factor: float = 4.0) -> bool:
+        return False
+
+    def _reserve(self, extra: int):
+        needed = self._index.get_current_count() + extra
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, self._index.get_max_elements() * 2))
+
+    def train(self, vectors: np.ndarray, ids: Sequence[str]):
+        """Bulk insert into an empty index (HNSW needs no training)"""
+        labels = np.arange(self._next_label, self._next_label + len(ids))
+        for identity, label in zip(ids, labels.tolist()):
+            self._labels[identity] = label
+            self._identities[label] = identity
+        self._next_label += len(ids)
+        self._reserve(len(ids))
+        self._index.add_items(_normalize_rows(vectors), labels)
+        self.trained_size = len(self)
+
+    def add(self, identity: str, vector: np.ndarray):
+        label = self._labels.get(identity)
+        if label is None:
+            label = self._next_label
+            self._next_label += 1
+            self._labels[identity] = label
+            self._identities[label] = identity
+            self._reserve(1)
+            self._index.add_items(vector.reshape(1, -1), np.asarray([label]), replace_deleted=True)
+        else:
+            # Re-adding an existing label replaces its vector
+            self._index.add_items(vector.reshape(1, -1), np.asarray([label]))
+
+    def remove(self, identity: str) -> bool:
+        label = self._labels.pop(identity, None)
+        if label is None:
+            return False
+        del self._identities[label]
+        self._index.mark_deleted(label)
+        return True
+
+    def vectors(self, identities: Sequence[str]) -> np.ndarray:
+        """Indexed vectors of identities already in the index (the cosine space stores them normalized)"""
+        if not identities:
+            return np.zeros((0, self.dimension), np.float32)
+        labels = [self._labels[identity] for identity in identities]
+        return np.asarray(self._index.get_items(labels), dtype=np.float32).reshape(len(labels), self.dimension)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        k = min(k, len(self))
+        if k == 0:
+            return []
+        self._index.set_ef(max(self.ef, k))
+        labels, distances = self._index.knn_query(query.reshape(1, -1), k=k)
+        return [(self._identities[int(label)], float(distance))
+                for label, distance in zip(labels[0], distances[0]) if int(label) in self._identities]
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "hnsw.bin")
+        self._index.save_index(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        meta = {"dimension": self.dimension, "labels": self._labels, "next_label": self._next_label}
+        _write_atomic(os.path.join(directory, "hnsw.json"), lambda f: f.write(json.dumps(meta).encode()))
+
+    @classmethod
+    def load(cls, directory: str, ef: int = HNSW_EF) -> "HnswIndex":
+        with open(os.path.join(directory, "hnsw.json")) as f:
+            meta = json.load(f)
+        index = cls(meta["dimension"], ef=ef)
+        index._index.load_index(os.path.join(directory, "hnsw.bin"), allow_replace_deleted=True)
+        index._index.set_ef(ef)
+        index._labels = {identity: int(label) for identity, label in meta["labels"].items()}
+        index._identities = {label: identity for identity, label in index._labels.items()}
+        index._next_label = meta["next_label"]
+        index.trained_size = len(index._labels)
+        return index
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"type": self.name, "size": len(self), "ef": self.ef}
+
+
+INDEX_TYPES = {"ivf": IVFIndex, "hnsw": HnswIndex}
+
+
+def build_index(kind: str, vectors: np.ndarray, ids: Sequence[str]):
+    """
+    Build and populate an index of the given kind from gallery rows
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown ANN index: {kind} (expected one of {ANN_INDEXES})")
+    start = time.perf_counter()
+    index = INDEX_TYPES[kind](vectors.shape[1])
+    index.train(vectors, ids)
+    logger.info(f"🧭 Built {kind} index over {len(ids)} faces in {time.perf_counter() - start:.1f}s")
+    return index
+
+
+def load_index(kind: str, directory: str):
+    """
+    Load a persisted index, or None if there is none
+    """
+    if kind not in INDEX_TYPES or not os.path.exists(os.path.join(directory, f"{kind}.json")):
+        return None
+    return INDEX_TYPES[kind].load(directory)
+
+
+class AnnIndexManager:
+    def __init__(self,
+                 gallery,
+                 kind: str = ANN_INDEX,
+                 directory: Optional[str] = ANN_INDEX_DIR,
+                 min_size: int = ANN_MIN_SIZE,
+                 interval: float = ANN_MAINTAIN_INTERVAL,
+                 pipeline: Optional[Dict[str, Any]] = None):
+        """
+        Builds, attaches, persists and retrains the ANN index of a FaceGallery
+
+        Args:
+            gallery: FaceGallery to index
+            kind: 'none', 'ivf' or 'hnsw'
+            directory: Where the index is saved (None keeps it in memory only)
+            min_size: Gallery size from which the index is used
+            interval: Seconds between maintenance checks
+            pipeline: Embedding pipeline of the gallery's rows; a saved index
+                built under another one is not loaded
+        """
+        if kind not in ANN_INDEXES:
+            raise ValueError(f"Unknown ANN index: {kind} (expected one of {ANN_INDEXES})")
+        self.gallery = gallery
+        self.kind = kind
+        self.directory = directory
+        self.min_size = min_size
+        self.interval = interval
+        self.pipeline = pipeline or {}
+        self.index = None
+        self._builds = 0
+        self._reindexed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.kind != "none"
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def restore(self) -> bool:
+        """
+        Attach the persisted index, reconciled with the gallery's current rows
+        """
+        if not self.enabled or self.directory is None:
+            return False
+        manifest = self._read_manifest()
+        if manifest is not None and (manifest.get("kind"), manifest.get("pipeline")) != (self.kind, self.pipeline):
+            logger.warning(f"⚠️ Saved {self.kind} index was built for {manifest.get('pipeline')}; rebuilding")
+            return False
+        try:
+            index = load_index(self.kind, self.directory) if manifest is not None else None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Could not load {self.kind} index: {e}")
+            return False
+        if index is None:
+            return False
+        reindexed = self.gallery.attach_index(index, min_size=self.min_size)
+        self.index = index
+        self._reindexed += reindexed
+        logger.info(f"🧭 Loaded {self.kind} index ({len(index)} faces, {reindexed} re-indexed)")
+        return True
+
+    def maintain(self):
+        """
+        (Re)build the index when the gallery is large enough and the index is
+        missing or has outgrown its training set
+        """
+        if not self.enabled or len(self.gallery) < self.min_size:
+            return
+        if self.index is not None and not self.index.needs_training():
+            return
+        matrix, ids, _, _, generation = self.gallery.export_state()
+        index = build_index(self.kind, matrix, ids)
+        # Changes made while building are picked up by the attach-time reconcile
+        self._reindexed += self.gallery.attach_index(index, min_size=self.min_size, since_generation=generation)
+        self.index = index
+        self._builds += 1
+        self.save()
+
+    def save(self):
+        if self.index is None or self.directory is None:
+            return
+        self.gallery.save_index(self.directory)
+        # After the index files: a crash in between leaves the old manifest,
+        # which at worst rejects a good index
+        manifest = {"kind": self.kind, "pipeline": self.pipeline, "saved_at": time.time()}
+        _write_atomic(os.path.join(self.directory, MANIFEST_FILE), lambda f: f.write(json.dumps(manifest).encode()))
+
+    # --- Background loop ---
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(self.save)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.maintain)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ ANN index maintenance error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = {"enabled": self.enabled, "active": self.index is not None, "builds": self._builds,
+                   "reindexed": self._reindexed}
+        if self.index is not None:
+            metrics.update(self.index.metrics())
+        return metrics
@@ -1,54 +1,435 @@
-from deepface import DeepFace
-from deepface.commons import image_utils
+# DeepFace (and TensorFlow behind it) is imported lazily inside the methods that
+# need it, so importing this module stays cheap and the app can serve requests
+# while the model loads in the background
 from PIL import Image
 import numpy as np
+import cv2
 import io
 import logging
-from typing import Tuple, Optional, Dict, Any
+from typing import Tuple, Optional, Dict, Any, List, Sequence, Callable, Awaitable, Set
 import warnings
 import time
+import os
+import asyncio
+import threading
+import hashlib
+from collections import OrderedDict
+from bson.binary import Binary, BinaryVectorDtype, VECTOR_SUBTYPE, USER_DEFINED_SUBTYPE
+from app.services.face_gallery import FaceGallery
+from app.services.face_index import AnnIndexManager, ANN_INDEX
+from app.services.gallery_shards import ShardedGallery, GALLERY_SHARDS
+from app.services.face_tracking import detect_face_boxes
+from app.services.face_backends import build_backend, INFERENCE_BACKEND
+from app.services.face_detectors import build_detector, DETECTOR_BACKEND
 
 # Suppress warnings for cleaner output
 warnings.filterwarnings("ignore")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Embeddings persisted on user documents are tagged with the model and pipeline
+# version that produced them. Bump EMBEDDING_VERSION whenever preprocessing or
+# detection settings change so stale vectors are never compared with fresh ones.
+EMBEDDING_MODEL_NAME = 'Facenet512'
+EMBEDDING_VERSION = 2
+
+# Cosine distance at or below which two Facenet512 embeddings are the same person
+MATCH_THRESHOLD = 0.30
+
+# 'opencv' (Haar), 'yunet' or any DeepFace detector; see face_detectors
+DEFAULT_DETECTOR_BACKEND = DETECTOR_BACKEND
+
+# Micro-batching of concurrent check-ins: frames arriving within the window share
+# one forward pass, up to the maximum batch size
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", 5))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 16))
+
+# Embedding cache: in-memory LRU bounded in bytes, plus an optional on-disk tier
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR") or None
+
+# Embeddings are stored in MongoDB as BSON binary: 'float32' uses the standard
+# vector subtype (2 KiB for 512-d, vs ~6 KiB as an array of doubles), 'float16'
+# halves that again at ~1e-3 precision. Reads accept every format, including
+# legacy arrays, so the setting can change at any time.
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32")
+FLOAT16_SUBTYPE = USER_DEFINED_SUBTYPE
+
+# In-memory gallery scan precision ('float32', 'float16' or 'int8'); compact scans
+# re-score the GALLERY_RESCORE_K best rows exactly in float32, read from a file
+# under GALLERY_ROWS_DIR (system temp dir by default) rather than kept in memory
+GALLERY_SCAN_DTYPE = os.getenv("GALLERY_SCAN_DTYPE", "float32")
+GALLERY_RESCORE_K = int(os.getenv("GALLERY_RESCORE_K", 32))
+GALLERY_ROWS_DIR = os.getenv("GALLERY_ROWS_DIR") or None
+
+# Employees may register several reference captures; each gets its own template
+# and matching re-ranks templates for the TEMPLATE_RERANK_K closest centroids
+MAX_REFERENCE_TEMPLATES = int(os.getenv("MAX_REFERENCE_TEMPLATES", 5))
+TEMPLATE_RERANK_K = int(os.getenv("TEMPLATE_RERANK_K", 5))
+
+# Employees logged in with their own account are verified 1:1 against their own
+# templates instead of being identified against the whole gallery
+CLAIMED_IDENTITY_VERIFICATION = os.getenv("CLAIMED_IDENTITY_VERIFICATION", "true").lower() == "true"
+
+# Two-stage cascade: a cheap SFace shortlist (OpenCV's FaceRecognizerSF, 128-d)
+# followed by Facenet512 confirmation of the shortlisted employees only
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "false").lower() == "true"
+SFACE_MODEL_PATH = os.getenv("SFACE_MODEL_PATH", "models/face_recognition_sface_2021dec.onnx")
+CASCADE_SHORTLIST_K = int(os.getenv("CASCADE_SHORTLIST_K", 5))
+# SFace's published cosine-similarity threshold is 0.363 (distance 0.637); the
+# shortlist stage is deliberately looser so true matches are not dropped early
+CASCADE_STAGE1_THRESHOLD = float(os.getenv("CASCADE_STAGE1_THRESHOLD", 0.75))
+
+# Frame-quality gate: live frames failing these cheap OpenCV checks are rejected
+# before any model runs
+QUALITY_GATE_ENABLED = os.getenv("QUALITY_GATE_ENABLED", "true").lower() == "true"
+QUALITY_MIN_BRIGHTNESS = float(os.getenv("QUALITY_MIN_BRIGHTNESS", 40))
+QUALITY_MAX_BRIGHTNESS = float(os.getenv("QUALITY_MAX_BRIGHTNESS", 220))
+# Spread between the 5th and 95th luminance percentiles
+QUALITY_MIN_CONTRAST = float(os.getenv("QUALITY_MIN_CONTRAST", 30))
+QUALITY_MIN_FACE_PX = int(os.getenv("QUALITY_MIN_FACE_PX", 60))
+QUALITY_MAX_FACES = int(os.getenv("QUALITY_MAX_FACES", 1))
+# Variance of the Laplacian of the face crop resized to 112x112
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", 25))
+# Frames are measured at this width (detections are scaled back)
+QUALITY_ANALYSIS_WIDTH = 320
+
+
+def cosine_distance(reference_embedding: Sequence[float], live_embedding: Sequence[float]) -> float:
+    """
+    Cosine distance between two embeddings (same formula DeepFace.verify uses)
+    """
+    a = np.asarray(reference_embedding, dtype=np.float64)
+    b = np.asarray(live_embedding, dtype=np.float64)
+    denominator = np.linalg.norm(a) * np.linalg.norm(b)
+    if denominator == 0:
+        return 1.0
+    return float(1 - np.dot(a, b) / denominator)
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES, disk_dir: Optional[str] = EMBEDDING_CACHE_DIR):
+        """
+        Content-addressed cache of computed embeddings
+        
+        Keys hash the image bytes together with the settings that produced the
+        embedding, so identical uploads (stored reference photos, kiosk retries)
+        are never embedded twice.
+        
+        Args:
+            max_bytes: Memory budget; least recently used entries are evicted beyond it
+            disk_dir: Optional directory for a write-through on-disk tier
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+    
+    @staticmethod
+    def key(image_bytes: bytes, settings: str) -> str:
+        digest = hashlib.blake2b(image_bytes, digest_size=16)
+        digest.update(settings.encode())
+        return digest.hexdigest()
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+    
+    def _store(self, key: str, vector: np.ndarray):
+        # Caller holds the lock
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        size = vector.nbytes + len(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = vector
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes + len(evicted_key)
+            self._evictions += 1
+    
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return vector.tolist()
+        
+        if self.disk_dir:
+            try:
+                vector = np.load(self._disk_path(key))
+            except (OSError, ValueError):
+                vector = None
+            if vector is not None:
+                with self._lock:
+                    self._store(key, vector)
+                    self._disk_hits += 1
+                return vector.tolist()
+        
+        with self._lock:
+            self._misses += 1
+        return None
+    
+    def put(self, key: str, embedding: Sequence[float]):
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._store(key, vector)
+        
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, vector)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Embedding cache disk write failed: {e}")
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._disk_hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': (self._hits + self._disk_hits) / lookups if lookups else 0.0,
+                'disk_tier': bool(self.disk_dir)
+            }
+
+
+# Shared by every verifier in this process
+embedding_cache = EmbeddingCache()
+
+
+class FrameQualityGate:
+    # Reason -> message shown to the person at the kiosk
+    MESSAGES = {
+        'unreadable': "❌ Could not read the image. Please try again.",
+        'too_dark': "❌ Image is too dark. Please improve the lighting.",
+        'too_bright': "❌ Image is overexposed. Please avoid direct light behind or on the camera.",
+        'low_contrast': "❌ Image is washed out. Please improve the lighting.",
+        'no_face': "❌ No face detected. Please look at the camera.",
+        'multiple_faces': "❌ More than one face detected. Please step up one at a time.",
+        'face_too_small': "❌ Face is too small. Please move closer to the camera.",
+        'blurry': "❌ Image is blurry. Please hold still.",
+    }
+    
+    def __init__(self,
+                 min_brightness: float = QUALITY_MIN_BRIGHTNESS,
+                 max_brightness: float = QUALITY_MAX_BRIGHTNESS,
+                 min_contrast: float = QUALITY_MIN_CONTRAST,
+                 min_face_px: int = QUALITY_MIN_FACE_PX,
+                 max_faces: int = QUALITY_MAX_FACES,
+                 min_sharpness: float = QUALITY_MIN_SHARPNESS):
+        """
+        Rejects live frames that would fail recognition anyway, in a few ms
+        
+        Checks run cheapest first: luminance mean and spread, then a Haar face
+        detection (count and size), then Laplacian variance of the face crop.
+        
+        Args:
+            min_brightness / max_brightness: Allowed mean luminance (0-255)
+            min_contrast: Minimum 5th-95th percentile luminance spread
+            min_face_px: Minimum face width in the original frame
+            max_faces: Maximum faces in the frame
+            min_sharpness: Minimum Laplacian variance of the face crop
+        """
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_contrast = min_contrast
+        self.min_face_px = min_face_px
+        self.max_faces = max_faces
+        self.min_sharpness = min_sharpness
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._rejections: Dict[str, int] = {}
+        self._gate_seconds = 0.0
+        # Moving average of the pipeline time of accepted frames, used to
+        # estimate the time rejected frames would have cost
+        self._pipeline_seconds: Optional[float] = None
+    
+    def measure(self, image_bytes: bytes) -> Tuple[Optional[str], Dict[str, Any]]:
+        """
+        Returns:
+            (rejection reason or None, measurements)
+        """
+        # Header only: the full-size width picks the JPEG DCT reduction (1/2, 1/4
+        # or 1/8) so multi-megapixel captures are never decoded at full size
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as header:
+                full_width = header.size[0]
+        except Exception:
+            return 'unreadable', {}
+        flag = cv2.IMREAD_GRAYSCALE
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                                (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if full_width // factor >= QUALITY_ANALYSIS_WIDTH:
+                flag = reduced
+                break
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+        if gray is None or full_width <= 0:
+            return 'unreadable', {}
+        if gray.shape[1] > QUALITY_ANALYSIS_WIDTH:
+            gray = cv2.resize(gray, (QUALITY_ANALYSIS_WIDTH, max(1, int(gray.shape[0] * QUALITY_ANALYSIS_WIDTH / gray.shape[1]))),
+                              interpolation=cv2.INTER_AREA)
+        # Analysis pixels per pixel of the original capture
+        scale = gray.shape[1] / full_width
+        
+        histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+        cumulative = np.cumsum(histogram) / max(histogram.sum(), 1)
+        brightness = float(np.dot(histogram, np.arange(256)) / max(histogram.sum(), 1))
+        contrast = float(np.searchsorted(cumulative, 0.95) - np.searchsorted(cumulative, 0.05))
+        measurements: Dict[str, Any] = {'brightness': round(brightness, 1), 'contrast': contrast}
+        if brightness < self.min_brightness:
+            return 'too_dark', measurements
+        if brightness > self.max_brightness:
+            return 'too_bright', measurements
+        if contrast < self.min_contrast:
+            return 'low_contrast', measurements
+        
+        min_size = max(12, int(self.min_face_px * scale * 0.5))
+        boxes = detect_face_boxes(gray, min_size=min_size)
+        measurements['faces'] = len(boxes)
+        if not boxes:
+            return 'no_face', measurements
+        if len(boxes) > self.max_faces:
+            return 'multiple_faces', measurements
+        x, y, w, h = max(boxes, key=lambda b: b[2] * b[3])
+        measurements['face_px'] = int(w / scale)
+        if w / scale < self.min_face_px:
+            return 'face_too_small', measurements
+        
+        crop = cv2.resize(gray[y:y + h, x:x + w], (112, 112), interpolation=cv2.INTER_AREA)
+        sharpness = float(cv2.Laplacian(crop, cv2.CV_64F).var())
+        measurements['sharpness'] = round(sharpness, 1)
+        if sharpness < self.min_sharpness:
+            return 'blurry', measurements
+        return None, measurements
+    
+    def check(self, image_bytes: bytes) -> Tuple[bool, Optional[str], Dict[str, Any]]:
+        """
+        Measure a live frame and record the outcome
+        
+        Returns:
+            (accepted, rejection reason, measurements)
+        """
+        start = time.perf_counter()
+        try:
+            reason, measurements = self.measure(image_bytes)
+        except cv2.error as e:
+            # Never block a check-in on a gate failure; the pipeline decides
+            logger.warning(f"⚠️ Quality gate error: {e}")
+            reason, measurements = None, {}
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._checked += 1
+            self._gate_seconds += elapsed
+            if reason is not None:
+                self._rejections[reason] = self._rejections.get(reason, 0) + 1
+        return reason is None, reason, measurements
+    
+    def record_pipeline(self, seconds: float):
+        """Time the models took for an accepted frame"""
+        with self._lock:
+            if self._pipeline_seconds is None:
+                self._pipeline_seconds = seconds
+            else:
+                self._pipeline_seconds = 0.9 * self._pipeline_seconds + 0.1 * seconds
+    
+    def message(self, reason: str) -> str:
+        return self.MESSAGES.get(reason, "❌ Image quality too low. Please try again.")
+    
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            rejected = sum(self._rejections.values())
+            return {
+                'enabled': QUALITY_GATE_ENABLED,
+                'checked': self._checked,
+                'rejected': rejected,
+                'rejection_rate': rejected / self._checked if self._checked else 0.0,
+                'rejections': dict(self._rejections),
+                'avg_gate_ms': self._gate_seconds / self._checked * 1000 if self._checked else None,
+                'avg_pipeline_ms': None if self._pipeline_seconds is None else self._pipeline_seconds * 1000,
+                'estimated_seconds_saved': (
+                    rejected * self._pipeline_seconds - self._gate_seconds
+                    if self._pipeline_seconds is not None else None
+                ),
+            }
+
+
+frame_quality_gate = FrameQualityGate()
+
+
 class FastAttendanceVerifier:
     def __init__(self, 
                  model_name: str = 'Facenet512',
                  distance_metric: str = 'cosine',
                  threshold: float = 0.30,
-                 max_image_size: int = 640):
+                 max_image_size: int = 640,
+                 detector_backend: str = DEFAULT_DETECTOR_BACKEND,
+                 backend: str = INFERENCE_BACKEND,
+                 cache: Optional[EmbeddingCache] = embedding_cache,
+                 warm_up: bool = True):
         """
         Fast Face Verification optimized for attendance systems
         
+        Prefer model_registry.get_verifier() over constructing this directly,
+        so the model is loaded and warmed up once per process.
+        
         Args:
             model_name: Face recognition model ('Facenet512' recommended for speed+accuracy)
             distance_metric: Distance metric ('cosine' recommended)
             threshold: Verification threshold (0.30 for Facenet512 with cosine)
             max_image_size: Maximum image dimension for faster processing
+            detector_backend: Face detector ('opencv', 'yunet' or a DeepFace backend)
+            backend: Embedding runtime ('tensorflow', 'onnx' or 'onnx-int8')
+            cache: Embedding cache consulted before running the model (None disables it)
+            warm_up: Run a dummy inference so the first real request is not slow
         """
         self.model_name = model_name
         self.distance_metric = distance_metric
         self.threshold = threshold
         self.max_image_size = max_image_size
+        self.detector_backend = detector_backend
+        self.backend = backend
+        self._backend = None
+        self._detector = None
+        self.cache = cache
+        # Everything besides the image bytes that determines an embedding
+        self.cache_settings = f"{model_name}|{detector_backend}|{backend}|{max_image_size}|v{EMBEDDING_VERSION}"
         
+        if warm_up:
+            self._warm_up_model()
         
-        self._warm_up_model()
-        
-        logger.info(f"🚀 FastAttendanceVerifier initialized with {model_name}")
+        logger.info(f"🚀 FastAttendanceVerifier initialized with {model_name} ({backend})")
     
     def _warm_up_model(self):
         """Pre-load the model to avoid first-time loading delays"""
         try:
             
             dummy_img = np.ones((100, 100, 3), dtype=np.uint8) * 128
-            DeepFace.represent(
-                img_path=dummy_img,
-                model_name=self.model_name,
-                detector_backend='opencv',
-                enforce_detection=False
-            )
+            self.embed([self.detect(dummy_img)])
             logger.info("✅ Model pre-loaded successfully")
         except Exception as e:
             logger.warning(f"Model pre-loading failed: {e}")
@@ -56,21 +437,32 @@ class FastAttendanceVerifier:
     def fast_preprocess(self, image_data: bytes) -> Optional[np.ndarray]:
         """
         Lightning-fast image preprocessing for attendance (no OpenCV version)
+        
+        JPEGs are decoded at reduced resolution via the decoder's DCT scaling
+        (1/2, 1/4 or 1/8) so large uploads never materialize at full size.
+        
+        Returns:
+            Contiguous HxWx3 uint8 array no larger than max_image_size
         """
         try:
             
-            image = Image.open(io.BytesIO(image_data)).convert("RGB")
-        
+            image = Image.open(io.BytesIO(image_data))
             
             width, height = image.size
-            if max(width, height) > self.max_image_size:
-                scale = self.max_image_size / max(width, height)
-                new_width = int(width * scale)
-                new_height = int(height * scale)
-                image = image.resize((new_width, new_height), Image.BILINEAR)
+            scale = self.max_image_size / max(width, height)
+            target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            
+            if scale < 1 and image.format == 'JPEG':
+                # Picks the smallest DCT scale that still covers target_size
+                image.draft('RGB', target_size)
+            
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            
+            if image.size != target_size and scale < 1:
+                image = image.resize(target_size, Image.BILINEAR)
         
-            img_array = np.array(image)
-            return img_array
+            return np.ascontiguousarray(np.asarray(image, dtype=np.uint8))
 
         except Exception as e:
             logger.error(f"❌ Preprocessing error: {e}")
@@ -78,42 +470,31 @@ class FastAttendanceVerifier:
     
     def verify_attendance(self, 
                          reference_image_bytes: bytes, 
-                         live_image_bytes: bytes) -> Tuple[bool, float, float]:
+                         live_image_bytes: bytes,
+                         threshold: Optional[float] = None) -> Tuple[bool, float, float]:
         """
         Fast attendance verification - optimized for speed
         
         Args:
             reference_image_bytes: Stored reference photo
             live_image_bytes: Live capture for attendance
+            threshold: Per-call override of the verifier threshold
             
         Returns:
             Tuple of (is_verified, distance, processing_time_seconds)
         """
         start_time = time.time()
+        threshold = self.threshold if threshold is None else threshold
         
         try:
+            # decode → detect/crop → embed (one batch, cache-aware) → compare
+            ref_embedding, live_embedding = self.compute_embeddings([reference_image_bytes, live_image_bytes])
             
-            ref_img = self.fast_preprocess(reference_image_bytes)
-            live_img = self.fast_preprocess(live_image_bytes)
-            
-            if ref_img is None or live_img is None:
+            if ref_embedding is None or live_embedding is None:
                 logger.error("❌ Image preprocessing failed")
                 return False, 1.0, time.time() - start_time
             
-            
-            result = DeepFace.verify(
-                img1_path=ref_img,
-                img2_path=live_img,
-                model_name=self.model_name,
-                detector_backend='opencv',  
-                distance_metric=self.distance_metric,
-                enforce_detection=False,    
-                align=False,               
-                normalization='base'
-            )
-            
-            distance = result['distance']
-            is_verified = distance <= self.threshold
+            is_verified, distance = self.compare_embeddings(ref_embedding, live_embedding, threshold)
             processing_time = time.time() - start_time
             
             
@@ -127,6 +508,297 @@ class FastAttendanceVerifier:
             logger.error(f"❌ Verification error: {e} | Time: {processing_time:.2f}s")
             return False, 1.0, processing_time
 
+    def compute_embedding(self, image_bytes: bytes) -> Optional[List[float]]:
+        """
+        Compute the face embedding for an image with the same settings verify_attendance uses
+        
+        Args:
+            image_bytes: Raw uploaded image
+            
+        Returns:
+            Embedding of the largest detected face, or None if it could not be computed
+        """
+        return self.compute_embeddings([image_bytes])[0]
+
+    def decode(self, image_bytes: bytes) -> Optional[np.ndarray]:
+        """
+        Stage 1: decode and downscale an upload (see fast_preprocess)
+        """
+        return self.fast_preprocess(image_bytes)
+
+    def _face_detector(self):
+        if self._detector is None:
+            self._detector = build_detector(self.detector_backend)
+        return self._detector
+
+    def detect_faces(self, img: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Every face the configured detector finds in a decoded image
+        
+        Returns:
+            DeepFace face objects ('face' crop, 'facial_area', 'confidence'); the
+            whole frame is returned when no face is found
+        """
+        return self._face_detector().detect(img)
+
+    def detect(self, img: np.ndarray) -> Dict[str, Any]:
+        """
+        Stage 2: detect and crop the largest face in a decoded image
+        
+        Returns:
+            DeepFace face object ('face' crop, 'facial_area', 'confidence'); the
+            whole frame is returned when no face is found
+        """
+        faces = self.detect_faces(img)
+        return max(faces, key=lambda f: f['facial_area']['w'] * f['facial_area']['h'])
+
+    def _recognition_backend(self):
+        if self._backend is None:
+            self._backend = build_backend(self.backend, self.model_name)
+        return self._backend
+
+    def face_tensor(self, face: Dict[str, Any]) -> np.ndarray:
+        """
+        Shape a detected face exactly as DeepFace.represent does before inference
+        
+        Returns:
+            (1, H, W, 3) float32 model input
+        """
+        from deepface.modules import preprocessing
+
+        target_size = self._recognition_backend().input_shape
+        crop = face['face'][:, :, ::-1]
+        crop = preprocessing.resize_image(img=crop, target_size=(target_size[1], target_size[0]))
+        return preprocessing.normalize_input(img=crop, normalization='base').astype(np.float32)
+
+    def embed(self, faces: Sequence[Dict[str, Any]]) -> List[List[float]]:
+        """
+        Stage 3: embed detected faces with a single forward pass of the configured backend
+        """
+        if not faces:
+            return []
+        batch = np.concatenate([self.face_tensor(face) for face in faces], axis=0)
+        embeddings = self._recognition_backend().forward(batch)
+        return [[float(value) for value in embedding] for embedding in embeddings]
+
+    def compute_embeddings(self, images: Sequence[bytes], require_face: bool = False) -> List[Optional[List[float]]]:
+        """
+        Decode and detect each image, then embed all faces with one forward pass
+        
+        Args:
+            images: Raw uploads
+            require_face: Return None instead of embedding the whole frame when
+                no face is detected (reference photos)
+        
+        Returns:
+            One embedding (or None on failure) per input image, in order
+        """
+        results: List[Optional[List[float]]] = [None] * len(images)
+        faces = []
+        indices = []
+        keys: List[Optional[str]] = [None] * len(images)
+        
+        for i, image_bytes in enumerate(images):
+            if self.cache is not None:
+                keys[i] = self.cache.key(image_bytes, self.cache_settings)
+                # A cached embedding does not say whether a face was detected
+                results[i] = None if require_face else self.cache.get(keys[i])
+                if results[i] is not None:
+                    continue
+            try:
+                img = self.decode(image_bytes)
+                if img is None:
+                    continue
+                face = self.detect(img)
+                # No face: the detector fell back to the whole frame with zero confidence
+                if require_face and not face.get('confidence'):
+                    continue
+                faces.append(face)
+                indices.append(i)
+            except Exception as e:
+                logger.error(f"❌ Face extraction error: {e}")
+        
+        if not faces:
+            return results
+        
+        try:
+            for i, embedding in zip(indices, self.embed(faces)):
+                results[i] = embedding
+                if self.cache is not None:
+                    self.cache.put(keys[i], embedding)
+        except Exception as e:
+            logger.error(f"❌ Embedding error: {e}")
+        
+        return results
+
+    def compare_embeddings(self,
+                           reference_embedding: Sequence[float],
+                           live_embedding: Sequence[float],
+                           threshold: Optional[float] = None) -> Tuple[bool, float]:
+        """
+        Stage 4: compare two precomputed embeddings without running the model
+        
+        Returns:
+            Tuple of (is_verified, distance)
+        """
+        threshold = self.threshold if threshold is None else threshold
+        distance = cosine_distance(reference_embedding, live_embedding)
+        return distance <= threshold, distance
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Process-wide cache of warmed-up verifiers, one per (model, detector, backend)
+        
+        Loading and warming a model is done exactly once; every caller then shares
+        the same FastAttendanceVerifier instance.
+        """
+        self._verifiers: Dict[Tuple[str, str, str], FastAttendanceVerifier] = {}
+        self._lock = threading.Lock()
+    
+    def get_verifier(self,
+                     model_name: str = EMBEDDING_MODEL_NAME,
+                     detector_backend: str = DEFAULT_DETECTOR_BACKEND,
+                     backend: str = INFERENCE_BACKEND) -> FastAttendanceVerifier:
+        """
+        Shared verifier for a (model, detector, backend), loading it on first use
+        """
+        key = (model_name, detector_backend, backend)
+        verifier = self._verifiers.get(key)
+        if verifier is None:
+            with self._lock:
+                verifier = self._verifiers.get(key)
+                if verifier is None:
+                    verifier = FastAttendanceVerifier(
+                        model_name=model_name,
+                        detector_backend=detector_backend,
+                        backend=backend
+                    )
+                    self._verifiers[key] = verifier
+        return verifier
+    
+    def preload(self, pairs: Sequence[Tuple[str, str]] = ((EMBEDDING_MODEL_NAME, DEFAULT_DETECTOR_BACKEND),)):
+        """
+        Load and warm the given (model, detector) pairs up front
+        """
+        for model_name, detector_backend in pairs:
+            self.get_verifier(model_name, detector_backend)
+    
+    def loaded(self) -> List[Tuple[str, str, str]]:
+        return list(self._verifiers.keys())
+    
+    def clear(self):
+        with self._lock:
+            self._verifiers.clear()
+
+
+# Shared by every route and helper in this process; preloaded by the app lifespan
+model_registry = ModelRegistry()
+
+
+class MicroBatchScheduler:
+    def __init__(self,
+                 run_batch: Callable[[List[bytes]], Awaitable[List[Optional[List[float]]]]],
+                 window_ms: float = BATCH_WINDOW_MS,
+                 max_batch_size: int = BATCH_MAX_SIZE):
+        """
+        Collects live frames from concurrent requests and embeds them together
+        
+        Args:
+            run_batch: Coroutine function embedding a list of images (one result per image)
+            window_ms: How long the first frame of a batch waits for company
+            max_batch_size: A batch is dispatched immediately once it reaches this size
+        """
+        self.run_batch = run_batch
+        self.window_ms = window_ms
+        self.max_batch_size = max(1, max_batch_size)
+        
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The loop only holds weak references to tasks; keep in-flight batches alive
+        self._tasks: Set[asyncio.Task] = set()
+        self._batches = 0
+        self._frames = 0
+        self._largest_batch = 0
+    
+    async def embed(self, image_bytes: bytes) -> Optional[List[float]]:
+        """
+        Queue one frame and wait for its embedding
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((image_bytes, future))
+        
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._dispatch_done)
+    
+    def _dispatch_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ Batch dispatch failed: {task.exception()}")
+    
+    async def stop(self):
+        """
+        Dispatch frames still waiting for their window and wait for every batch in flight
+        """
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    async def _dispatch(self, batch: List[Tuple[bytes, asyncio.Future]]):
+        self._batches += 1
+        self._frames += len(batch)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        
+        try:
+            results = await self.run_batch([image for image, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            logger.error(f"❌ Batch embedding failed ({len(batch)} frames): {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        # A short result list must not leave the remaining waiters hanging
+        for _, future in batch[len(results):]:
+            if not future.done():
+                future.set_result(None)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'window_ms': self.window_ms,
+            'max_batch_size': self.max_batch_size,
+            'pending': len(self._pending),
+            'batches': self._batches,
+            'frames': self._frames,
+            'mean_batch_size': self._frames / self._batches if self._batches else 0.0,
+            'largest_batch': self._largest_batch
+        }
+
 
 class AttendanceSystem:
     def __init__(self, confidence_threshold: float = 0.7):
@@ -136,9 +808,10 @@ class AttendanceSystem:
         Args:
             confidence_threshold: Minimum confidence for attendance marking
         """
-        self.verifier = FastAttendanceVerifier()
+        self.verifier = model_registry.get_verifier()
         self.confidence_threshold = confidence_threshold
         self.employee_database = {}  
+        self.gallery = FaceGallery()
         
     def register_employee(self, employee_id: str, name: str, reference_image_bytes: bytes) -> bool:
         """
@@ -151,22 +824,23 @@ class AttendanceSystem:
                 return False
             
             
-            faces = DeepFace.extract_faces(
-                img_path=img,
-                detector_backend='opencv',
-                enforce_detection=False
-            )
+            faces = self.verifier.detect_faces(img)
             
             if len(faces) == 0:
                 logger.error(f"❌ No face detected in reference image for {employee_id}")
                 return False
             
+            embedding = self.verifier.compute_embedding(reference_image_bytes)
+            if embedding is None:
+                logger.error(f"❌ Could not embed reference image for {employee_id}")
+                return False
             
             self.employee_database[employee_id] = {
                 'name': name,
                 'reference_image': reference_image_bytes,
                 'registered_at': time.time()
             }
+            self.gallery.add(employee_id, embedding, {'name': name})
             
             logger.info(f"✅ Employee {employee_id} ({name}) registered successfully")
             return True
@@ -192,29 +866,23 @@ class AttendanceSystem:
             }
         
         best_match = None
-        best_confidence = 0
-        best_distance = 1.0
         
-    
-        for employee_id, employee_data in self.employee_database.items():
-            is_verified, distance, _ = self.verifier.verify_attendance(
-                employee_data['reference_image'],
-                live_image_bytes
-            )
+        live_embedding = self.verifier.compute_embedding(live_image_bytes)
+        match = None
+        if live_embedding is not None:
+            match = self.gallery.best_match(live_embedding, threshold=self.verifier.threshold)
+        
+        if match:
+            employee_id, distance = match
+            confidence = max(0, 1 - (distance / self.verifier.threshold))
             
-            if is_verified:
-                
-                confidence = max(0, 1 - (distance / self.verifier.threshold))
-                
-                if confidence > best_confidence and confidence >= self.confidence_threshold:
-                    best_confidence = confidence
-                    best_distance = distance
-                    best_match = {
-                        'employee_id': employee_id,
-                        'name': employee_data['name'],
-                        'confidence': confidence,
-                        'distance': distance
-                    }
+            if confidence >= self.confidence_threshold:
+                best_match = {
+                    'employee_id': employee_id,
+                    'name': self.employee_database[employee_id]['name'],
+                    'confidence': confidence,
+                    'distance': distance
+                }
         
         processing_time = time.time() - start_time
         
@@ -245,11 +913,585 @@ def quick_face_verify(reference_bytes: bytes,
     Returns:
         (is_match, distance)
     """
-    verifier = FastAttendanceVerifier(threshold=threshold)
-    is_verified, distance, _ = verifier.verify_attendance(reference_bytes, live_bytes)
+    verifier = model_registry.get_verifier()
+    is_verified, distance, _ = verifier.verify_attendance(reference_bytes, live_bytes, threshold=threshold)
     return is_verified, distance
 
 
+def compute_face_embedding(image_bytes: bytes) -> Optional[List[float]]:
+    """
+    Compute the Facenet512 embedding stored on user documents
+    """
+    verifier = model_registry.get_verifier(EMBEDDING_MODEL_NAME)
+    return verifier.compute_embedding(image_bytes)
+
+
+def verify_embeddings(reference_embedding: Sequence[float],
+                      live_embedding: Sequence[float],
+                      threshold: float = 0.30) -> Tuple[bool, float]:
+    """
+    Verify a live embedding against a stored one
+    
+    Returns:
+        (is_match, distance)
+    """
+    distance = cosine_distance(reference_embedding, live_embedding)
+    return distance <= threshold, distance
+
+
+def encode_embedding(embedding: Sequence[float]) -> Binary:
+    """
+    Compact BSON binary form of an embedding (see EMBEDDING_STORAGE_DTYPE)
+    """
+    vector = np.asarray(embedding, dtype='<f4').reshape(-1)
+    if EMBEDDING_STORAGE_DTYPE == 'float16':
+        return Binary(vector.astype('<f2').tobytes(), FLOAT16_SUBTYPE)
+    # Vector subtype layout: dtype byte, padding byte, little-endian values
+    return Binary(BinaryVectorDtype.FLOAT32.value + b'\x00' + vector.tobytes(), VECTOR_SUBTYPE)
+
+
+def decode_embedding(value: Any) -> np.ndarray:
+    """
+    float32 vector from any stored form (vector/float16 binary or array of doubles)
+    """
+    if isinstance(value, Binary):
+        if value.subtype == FLOAT16_SUBTYPE:
+            return np.frombuffer(value, dtype='<f2').astype(np.float32)
+        if value.subtype == VECTOR_SUBTYPE:
+            dtype = value[:1]
+            if dtype == BinaryVectorDtype.FLOAT32.value:
+                return np.frombuffer(value, dtype='<f4', offset=2).copy()
+            if dtype == BinaryVectorDtype.INT8.value:
+                return np.frombuffer(value, dtype=np.int8, offset=2).astype(np.float32)
+        raise ValueError(f"Unsupported embedding binary (subtype {value.subtype})")
+    return np.asarray(value, dtype=np.float32)
+
+
+# Runtime settings that change embeddings besides model and version, with the
+# value that produced documents written before the field was recorded. ONNX
+# parity with TensorFlow is only checked offline, so the backend counts too.
+EMBEDDING_RUNTIME_FIELDS = {
+    'embedding_backend': (INFERENCE_BACKEND, 'tensorflow'),
+    'embedding_detector': (DEFAULT_DETECTOR_BACKEND, 'opencv'),
+}
+
+
+def embedding_pipeline() -> Dict[str, Any]:
+    """
+    Everything that determines a stored embedding, as recorded on user documents
+    """
+    pipeline = {
+        'embedding_model': EMBEDDING_MODEL_NAME,
+        'embedding_version': EMBEDDING_VERSION,
+    }
+    pipeline.update({field: current for field, (current, _) in EMBEDDING_RUNTIME_FIELDS.items()})
+    return pipeline
+
+
+def embedding_fields(embedding: List[float]) -> Dict[str, Any]:
+    """
+    Fields persisted on a user document alongside the face image
+    """
+    return {'face_embedding': encode_embedding(embedding), **embedding_pipeline()}
+
+
+def embedding_centroid(embeddings: Sequence[Sequence[float]]) -> List[float]:
+    """
+    L2-normalized mean of L2-normalized embeddings
+    """
+    matrix = np.asarray(embeddings, dtype=np.float64)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    centroid = (matrix / np.where(norms == 0, 1.0, norms)).mean(axis=0)
+    norm = np.linalg.norm(centroid)
+    return [float(v) for v in (centroid if norm == 0 else centroid / norm)]
+
+
+def template_fields(embeddings: Sequence[List[float]]) -> Dict[str, Any]:
+    """
+    Fields for an employee registered with one or more reference captures
+    
+    face_embedding holds the normalized centroid so single-vector consumers keep
+    working; face_templates holds one embedding per capture.
+    """
+    fields = embedding_fields(embedding_centroid(embeddings))
+    fields['face_templates'] = [encode_embedding(embedding) for embedding in embeddings]
+    return fields
+
+
+def has_current_embedding(user: Dict[str, Any]) -> bool:
+    """
+    True if the user document carries an embedding from the current model,
+    pipeline version, inference backend and detector
+    """
+    return (
+        bool(user.get('face_embedding'))
+        and user.get('embedding_model') == EMBEDDING_MODEL_NAME
+        and user.get('embedding_version') == EMBEDDING_VERSION
+        and all((user.get(field) or default) == current
+                for field, (current, default) in EMBEDDING_RUNTIME_FIELDS.items())
+    )
+
+
+def _runtime_mismatch(field: str, current: str, default: str) -> Dict[str, Any]:
+    # A missing field means the document was written with the default
+    if current == default:
+        return {field: {'$nin': [current, None]}}
+    return {field: {'$ne': current}}
+
+
+# Mongo filter for user documents that still need image-based verification
+# (and that the backfill re-embeds)
+LEGACY_EMBEDDING_QUERY = {
+    '$or': [
+        {'embedding_model': {'$ne': EMBEDDING_MODEL_NAME}},
+        {'embedding_version': {'$ne': EMBEDDING_VERSION}},
+        *(_runtime_mismatch(field, current, default)
+          for field, (current, default) in EMBEDDING_RUNTIME_FIELDS.items())
+    ]
+}
+
+# Seconds between checks for legacy users still waiting on the backfill
+LEGACY_RECHECK_SECONDS = float(os.getenv("LEGACY_RECHECK_SECONDS", 300.0))
+
+
+class LegacyUserGate:
+    def __init__(self, recheck_seconds: float = LEGACY_RECHECK_SECONDS):
+        """
+        Decides whether the image-based legacy fallback can find anyone
+        
+        The fallback embeds up to 100 stored photos for every capture the
+        gallery does not recognize. Once the backfill has given everyone a
+        current embedding it can never match, so whether any legacy user with
+        a photo is left is checked at most every recheck_seconds.
+        
+        Args:
+            recheck_seconds: How long a "none left" (or "some left") answer is trusted
+        """
+        self.recheck_seconds = recheck_seconds
+        self._pending = True
+        self._checked_at: Optional[float] = None
+        self._refresh_lock = asyncio.Lock()
+        self._fallbacks = 0
+        self._skipped = 0
+    
+    async def pending(self, collection) -> bool:
+        """
+        Whether any user document still needs the legacy fallback
+        """
+        if self._checked_at is None or time.monotonic() - self._checked_at >= self.recheck_seconds:
+            async with self._refresh_lock:
+                if self._checked_at is None or time.monotonic() - self._checked_at >= self.recheck_seconds:
+                    try:
+                        self._pending = await collection.find_one(
+                            {'$and': [LEGACY_EMBEDDING_QUERY, {'face_image': {'$exists': True}}]},
+                            {'_id': 1}
+                        ) is not None
+                    except Exception as e:
+                        logger.warning(f"⚠️ Legacy user check failed: {e}")
+                    self._checked_at = time.monotonic()
+        if self._pending:
+            self._fallbacks += 1
+        else:
+            self._skipped += 1
+        return self._pending
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'legacy_users_pending': self._pending,
+            'fallbacks': self._fallbacks,
+            'skipped': self._skipped,
+        }
+
+
+legacy_user_gate = LegacyUserGate()
+
+# Process-wide galleries of registered employees, keyed by user id: Facenet512
+# embeddings, and SFace embeddings used for the cascade shortlist. With
+# GALLERY_SHARDS > 1 the Facenet512 gallery is split across shard processes.
+if GALLERY_SHARDS > 1:
+    employee_gallery = ShardedGallery(GALLERY_SHARDS, scan_dtype=GALLERY_SCAN_DTYPE, rescore_k=GALLERY_RESCORE_K,
+                                      rows_dir=GALLERY_ROWS_DIR)
+else:
+    employee_gallery = FaceGallery(scan_dtype=GALLERY_SCAN_DTYPE, rescore_k=GALLERY_RESCORE_K, rows_dir=GALLERY_ROWS_DIR)
+shortlist_gallery = FaceGallery()
+# Approximate index over employee_gallery for very large galleries (ANN_INDEX);
+# not used with shards, which each scan their own partition
+ann_index_manager = AnnIndexManager(employee_gallery, kind="none" if GALLERY_SHARDS > 1 else ANN_INDEX,
+                                    pipeline=embedding_pipeline())
+
+
+def gallery_metadata(user: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Metadata kept next to each gallery row
+    """
+    return {
+        'name': user.get('name'),
+        'email': user.get('email'),
+        'site': user.get('site'),
+        'department': user.get('department')
+    }
+
+
+def partition_key(value: Optional[str]) -> Optional[str]:
+    """Site/department names compare case- and whitespace-insensitively"""
+    if not value or not value.strip():
+        return None
+    return value.strip().lower()
+
+
+class GalleryPartitions:
+    FIELDS = ('site', 'department')
+    
+    def __init__(self):
+        """
+        Which gallery employees belong to each site and department
+        
+        A kiosk that names its site (and/or department) is searched against
+        that partition first and the whole gallery only on a miss.
+        """
+        self._members: Dict[Tuple[str, str], set] = {}
+        self._tags: Dict[str, List[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+        self._searches = 0
+        self._partition_matches = 0
+        self._widened = 0
+        self._candidates_total = 0
+    
+    def assign(self, user_id: str, user: Dict[str, Any]):
+        """(Re)place an employee in the partitions named by their user document"""
+        with self._lock:
+            self._assign(user_id, user)
+    
+    def _assign(self, user_id: str, user: Dict[str, Any]):
+        self._discard(user_id)
+        tags = []
+        for field in self.FIELDS:
+            value = partition_key(user.get(field))
+            if value is not None:
+                tags.append((field, value))
+                self._members.setdefault((field, value), set()).add(user_id)
+        if tags:
+            self._tags[user_id] = tags
+    
+    def _discard(self, user_id: str):
+        for tag in self._tags.pop(user_id, []):
+            members = self._members.get(tag)
+            if members is not None:
+                members.discard(user_id)
+                if not members:
+                    del self._members[tag]
+    
+    def discard(self, user_id: str):
+        with self._lock:
+            self._discard(user_id)
+    
+    def clear(self):
+        with self._lock:
+            self._members.clear()
+            self._tags.clear()
+    
+    def rebuild(self, gallery):
+        """
+        Re-derive every partition from the gallery's metadata
+
+        The lock is held throughout, so searches never see the partitions half
+        built and an assign racing the rebuild is applied after it.
+        """
+        with self._lock:
+            self._members.clear()
+            self._tags.clear()
+            for user_id in gallery.ids:
+                self._assign(user_id, gallery.get_metadata(user_id) or {})
+    
+    def members(self, site: Optional[str] = None, department: Optional[str] = None) -> Optional[set]:
+        """
+        Employees in the given site and/or department
+        
+        Returns:
+            None if neither was given, else the (possibly empty) intersection
+        """
+        wanted = [(field, partition_key(value)) for field, value in (('site', site), ('department', department))
+                  if partition_key(value) is not None]
+        if not wanted:
+            return None
+        with self._lock:
+            sets = [self._members.get(tag, set()) for tag in wanted]
+            return set.intersection(*sets) if len(sets) > 1 else set(sets[0])
+    
+    def record_search(self, candidates: int, matched: bool):
+        with self._lock:
+            self._searches += 1
+            self._candidates_total += candidates
+            if matched:
+                self._partition_matches += 1
+            else:
+                self._widened += 1
+    
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "partitions": {
+                    f"{field}:{value}": len(members) for (field, value), members in self._members.items()
+                },
+                "searches": self._searches,
+                "partition_matches": self._partition_matches,
+                "widened_to_global": self._widened,
+                "avg_candidates": (self._candidates_total / self._searches) if self._searches else None,
+            }
+
+
+gallery_partitions = GalleryPartitions()
+
+
+def rebuild_partitions():
+    """
+    Re-derive the partitions from gallery metadata, and the cascade's
+    unshortlisted employees, e.g. after mapping a snapshot
+    """
+    gallery_partitions.rebuild(employee_gallery)
+    cascade_matcher.rebuild()
+
+
+def index_employee(user_id: str, user: Dict[str, Any]):
+    """
+    Add or refresh an employee in the in-memory galleries from their user document
+    """
+    if not has_current_embedding(user):
+        return
+    templates = user.get('face_templates')
+    employee_gallery.add(
+        user_id,
+        decode_embedding(user['face_embedding']),
+        gallery_metadata(user),
+        templates=[decode_embedding(template) for template in templates] if templates else None
+    )
+    gallery_partitions.assign(user_id, user)
+    if user.get('sface_embedding'):
+        shortlist_gallery.add(user_id, decode_embedding(user['sface_embedding']))
+    else:
+        # A stale shortlist row would hide the employee from the cascade
+        shortlist_gallery.remove(user_id)
+    cascade_matcher.track(user_id, shortlisted=bool(user.get('sface_embedding')))
+
+
+def unindex_employee(user_id: str):
+    """
+    Drop an employee from the in-memory galleries
+    """
+    employee_gallery.remove(user_id)
+    shortlist_gallery.remove(user_id)
+    gallery_partitions.discard(user_id)
+    cascade_matcher.forget(user_id)
+
+
+async def load_employee_gallery(collection) -> int:
+    """
+    (Re)build the galleries from a users collection
+    
+    Returns:
+        Number of employees loaded
+    """
+    employee_gallery.clear()
+    gallery_partitions.clear()
+    shortlist_gallery.clear()
+    cascade_matcher.rebuild()
+    cursor = collection.find(
+        {'face_embedding': {'$exists': True}},
+        {'face_image': 0}
+    )
+    async for user in cursor:
+        index_employee(str(user['_id']), user)
+    logger.info(f"📚 Face gallery loaded with {len(employee_gallery)} employees "
+                f"({len(shortlist_gallery)} with shortlist embeddings)")
+    return len(employee_gallery)
+
+
+class SFaceShortlistModel:
+    def __init__(self, model_path: str = SFACE_MODEL_PATH):
+        """
+        Lightweight 128-d SFace embedder run through OpenCV's FaceRecognizerSF
+        
+        Args:
+            model_path: face_recognition_sface_2021dec.onnx from the OpenCV model zoo
+        """
+        if not os.path.exists(model_path):
+            raise RuntimeError(f"SFace model not found at {model_path} (set SFACE_MODEL_PATH)")
+        self._recognizer = cv2.FaceRecognizerSF.create(model_path, "")
+        # cv2.dnn networks are not safe to run concurrently
+        self._lock = threading.Lock()
+    
+    def embed(self, faces: Sequence[Dict[str, Any]]) -> List[List[float]]:
+        """
+        Embed face crops produced by FastAttendanceVerifier.detect
+        """
+        embeddings = []
+        for face in faces:
+            # detect() yields RGB in [0, 1]; SFace expects a 112x112 BGR uint8 crop
+            crop = np.clip(face['face'][:, :, ::-1] * 255, 0, 255).astype(np.uint8)
+            crop = cv2.resize(crop, (112, 112))
+            with self._lock:
+                feature = self._recognizer.feature(crop)
+            embeddings.append([float(value) for value in feature.reshape(-1)])
+        return embeddings
+
+
+_shortlist_model: Optional[SFaceShortlistModel] = None
+_shortlist_model_lock = threading.Lock()
+
+
+def get_shortlist_model() -> SFaceShortlistModel:
+    global _shortlist_model
+    if _shortlist_model is None:
+        with _shortlist_model_lock:
+            if _shortlist_model is None:
+                _shortlist_model = SFaceShortlistModel()
+    return _shortlist_model
+
+
+def compute_shortlist_embedding(image_bytes: bytes) -> Optional[List[float]]:
+    """
+    SFace embedding stored next to the Facenet512 one when the cascade is enabled
+    """
+    try:
+        verifier = model_registry.get_verifier(EMBEDDING_MODEL_NAME)
+        img = verifier.decode(image_bytes)
+        if img is None:
+            return None
+        return get_shortlist_model().embed([verifier.detect(img)])[0]
+    except Exception as e:
+        logger.error(f"❌ Shortlist embedding error: {e}")
+        return None
+
+
+class CascadeMatcher:
+    def __init__(self,
+                 gallery: FaceGallery = employee_gallery,
+                 shortlist: FaceGallery = shortlist_gallery,
+                 shortlist_k: int = CASCADE_SHORTLIST_K,
+                 stage1_threshold: float = CASCADE_STAGE1_THRESHOLD,
+                 stage2_threshold: float = MATCH_THRESHOLD,
+                 verifier: Optional[FastAttendanceVerifier] = None,
+                 shortlist_model: Optional[SFaceShortlistModel] = None):
+        """
+        Two-stage identification: SFace shortlist, then Facenet512 re-rank
+        
+        The live frame is decoded and detected once. SFace scores it against the
+        whole shortlist gallery; only if some employee falls within
+        stage1_threshold does Facenet512 run, and then only the shortlisted
+        employees are compared. Employees without an SFace embedding are always
+        passed to stage 2 so they are never silently unmatchable.
+        
+        Args:
+            gallery: Facenet512 gallery used for confirmation
+            shortlist: SFace gallery used for the shortlist
+            shortlist_k: Maximum candidates handed to stage 2
+            stage1_threshold: SFace cosine distance cut-off for the shortlist
+            stage2_threshold: Facenet512 cosine distance cut-off for a match
+        """
+        self.gallery = gallery
+        self.shortlist = shortlist
+        self.shortlist_k = shortlist_k
+        self.stage1_threshold = stage1_threshold
+        self.stage2_threshold = stage2_threshold
+        self._verifier = verifier
+        self._shortlist_model = shortlist_model
+        self._lock = threading.Lock()
+        # Employees in gallery but not in shortlist, kept up to date by
+        # index_employee/unindex_employee instead of diffing both per probe
+        self._unshortlisted: Set[str] = set()
+        self._probes = 0
+        self._stage1_rejects = 0
+        self._stage2_runs = 0
+        self._matches = 0
+    
+    def track(self, user_id: str, shortlisted: bool):
+        """Record whether an indexed employee has a shortlist embedding"""
+        with self._lock:
+            if shortlisted:
+                self._unshortlisted.discard(user_id)
+            else:
+                self._unshortlisted.add(user_id)
+    
+    def forget(self, user_id: str):
+        with self._lock:
+            self._unshortlisted.discard(user_id)
+    
+    def rebuild(self):
+        """Re-derive the unshortlisted employees from both galleries, e.g. after mapping a snapshot"""
+        unshortlisted = set(self.gallery.ids) - set(self.shortlist.ids)
+        with self._lock:
+            self._unshortlisted = unshortlisted
+    
+    def identify(self, image_bytes: bytes) -> Dict[str, Any]:
+        """
+        Identify the face in a live frame
+        
+        Returns:
+            Dict with 'match' ((user_id, distance) or None), 'shortlist' and
+            'embedding' (Facenet512, None when stage 1 rejected the frame)
+        """
+        verifier = self._verifier or model_registry.get_verifier(EMBEDDING_MODEL_NAME)
+        shortlist_model = self._shortlist_model or get_shortlist_model()
+        result = {'match': None, 'shortlist': [], 'embedding': None}
+        with self._lock:
+            self._probes += 1
+        
+        img = verifier.decode(image_bytes)
+        if img is None:
+            return result
+        face = verifier.detect(img)
+        
+        # Stage 1: cheap SFace scan over every employee
+        probe = shortlist_model.embed([face])[0]
+        shortlist = [
+            (user_id, distance)
+            for user_id, distance in self.shortlist.search(probe, top_k=self.shortlist_k)
+            if distance <= self.stage1_threshold
+        ]
+        candidates = [user_id for user_id, _ in shortlist]
+        with self._lock:
+            candidates.extend(self._unshortlisted)
+        result['shortlist'] = shortlist
+        
+        if not candidates:
+            with self._lock:
+                self._stage1_rejects += 1
+            return result
+        
+        # Stage 2: Facenet512 only on the shortlisted employees
+        with self._lock:
+            self._stage2_runs += 1
+        embedding = verifier.embed([face])[0]
+        result['embedding'] = embedding
+        result['match'] = self.gallery.best_match(
+            embedding,
+            threshold=self.stage2_threshold,
+            candidates=candidates,
+            rerank_k=TEMPLATE_RERANK_K
+        )
+        if result['match']:
+            with self._lock:
+                self._matches += 1
+        return result
+    
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'enabled': CASCADE_ENABLED,
+                'probes': self._probes,
+                'stage1_rejects': self._stage1_rejects,
+                'stage2_runs': self._stage2_runs,
+                'matches': self._matches,
+                'unshortlisted': len(self._unshortlisted),
+                'shortlist_k': self.shortlist_k,
+                'stage1_threshold': self.stage1_threshold,
+                'stage2_threshold': self.stage2_threshold
+            }
+
+
+cascade_matcher = CascadeMatcher()
+
+
 def batch_verify_attendance(live_image_bytes: bytes, 
                           reference_images: Dict[str, bytes],
                           threshold: float = 0.30) -> Optional[str]:
@@ -264,19 +1506,20 @@ def batch_verify_attendance(live_image_bytes: bytes,
     Returns:
         employee_id of best match or None
     """
-    verifier = FastAttendanceVerifier(threshold=threshold)
-    
-    best_match = None
-    best_distance = float('inf')
+    verifier = model_registry.get_verifier()
     
+    gallery = FaceGallery()
     for employee_id, ref_bytes in reference_images.items():
-        is_verified, distance, _ = verifier.verify_attendance(ref_bytes, live_image_bytes)
-        
-        if is_verified and distance < best_distance:
-            best_distance = distance
-            best_match = employee_id
+        embedding = verifier.compute_embedding(ref_bytes)
+        if embedding is not None:
+            gallery.add(employee_id, embedding)
+    
+    live_embedding = verifier.compute_embedding(live_image_bytes)
+    if live_embedding is None:
+        return None
     
-    return best_match
+    match = gallery.best_match(live_embedding, threshold=threshold)
+    return match[0] if match else None
 
 
 # Example usage for attendance system
@@ -0,0 +1,199 @@
+"""
+Server-side face tracking for streaming kiosks
+
+A kiosk streams small frames over a WebSocket. Each frame only gets a cheap
+face detection; the largest face is followed from frame to frame by box IoU.
+Embedding and matching run once per track, when the face has stayed put for
+STREAM_STABLE_FRAMES frames and is at least STREAM_MIN_FACE_PX wide. The same
+person standing in front of the kiosk is not identified again until they
+leave (the track is lost) and a new track starts.
+"""
+import itertools
+import os
+import threading
+from typing import Tuple, Optional, Dict, Any, List
+
+import cv2
+import numpy as np
+
+from app.services.face_detectors import DETECTOR_BACKEND, shared_yunet
+
+STREAM_STABLE_FRAMES = int(os.getenv("STREAM_STABLE_FRAMES", 3))
+STREAM_MIN_FACE_PX = int(os.getenv("STREAM_MIN_FACE_PX", 80))
+STREAM_IOU_THRESHOLD = float(os.getenv("STREAM_IOU_THRESHOLD", 0.5))
+# Frames without the tracked face before the track is dropped
+STREAM_LOST_FRAMES = int(os.getenv("STREAM_LOST_FRAMES", 5))
+# Identification attempts per track when the face is not recognized
+STREAM_MAX_ATTEMPTS = int(os.getenv("STREAM_MAX_ATTEMPTS", 3))
+# Larger binary messages are dropped; kiosks send ~320x240 JPEGs
+STREAM_MAX_FRAME_BYTES = int(os.getenv("STREAM_MAX_FRAME_BYTES", 512 * 1024))
+
+# (x, y, width, height)
+Box = Tuple[int, int, int, int]
+
+_cascade: Optional[cv2.CascadeClassifier] = None
+_cascade_lock = threading.Lock()
+
+
+def detect_face_boxes(gray: np.ndarray, min_size: Optional[int] = None) -> List[Box]:
+    """
+    Cheap per-frame face boxes on a grayscale frame (YuNet when it is the
+    configured detector, otherwise OpenCV's Haar cascade)
+    """
+    global _cascade
+    if min_size is None:
+        min_size = max(24, STREAM_MIN_FACE_PX // 2)
+    if DETECTOR_BACKEND == "yunet":
+        return [
+            tuple(int(round(v)) for v in row[:4])
+            for row in shared_yunet().boxes(gray)
+            if row[2] >= min_size
+        ]
+    if _cascade is None:
+        with _cascade_lock:
+            if _cascade is None:
+                _cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    boxes = _cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=5, minSize=(min_size, min_size))
+    return [tuple(int(v) for v in box) for box in boxes]
+
+
+def iou(a: Box, b: Box) -> float:
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    overlap_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    overlap_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    overlap = overlap_w * overlap_h
+    union = aw * ah + bw * bh - overlap
+    return overlap / union if union > 0 else 0.0
+
+
+class FaceTracker:
+    _track_ids = itertools.count(1)
+
+    def __init__(self,
+                 stable_frames: int = STREAM_STABLE_FRAMES,
+                 min_face_px: int = STREAM_MIN_FACE_PX,
+                 iou_threshold: float = STREAM_IOU_THRESHOLD,
+                 lost_frames: int = STREAM_LOST_FRAMES,
+                 max_attempts: int = STREAM_MAX_ATTEMPTS):
+        """
+        Follows the largest face of one kiosk's stream
+
+        Args:
+            stable_frames: Consecutive overlapping detections before a face is ready
+            min_face_px: Minimum face width for identification
+            iou_threshold: Box overlap that counts as the same face
+            lost_frames: Frames without the face before the track ends
+            max_attempts: Identifications per track before giving up on it
+        """
+        self.stable_frames = stable_frames
+        self.min_face_px = min_face_px
+        self.iou_threshold = iou_threshold
+        self.lost_frames = lost_frames
+        self.max_attempts = max_attempts
+        self.track_id: Optional[int] = None
+        self.box: Optional[Box] = None
+        self.hits = 0
+        self.misses = 0
+        self.decided = False
+        self.attempts = 0
+
+    def _start(self, box: Box):
+        self.track_id = next(self._track_ids)
+        self.box = box
+        self.hits = 1
+        self.misses = 0
+        self.decided = False
+        self.attempts = 0
+
+    def update(self, boxes: List[Box]) -> Dict[str, Any]:
+        """
+        Feed one frame's detections
+
+        Returns:
+            Tracking state; 'ready' is True once per track, when it should be identified
+        """
+        if boxes:
+            box = max(boxes, key=lambda b: b[2] * b[3])
+            if self.box is not None and iou(box, self.box) >= self.iou_threshold:
+                self.box = box
+                self.hits += 1
+                self.misses = 0
+            else:
+                self._start(box)
+        elif self.box is not None:
+            self.misses += 1
+            if self.misses >= self.lost_frames:
+                self.track_id, self.box, self.hits, self.decided = None, None, 0, False
+
+        stable = self.box is not None and self.hits >= self.stable_frames
+        large = self.box is not None and self.box[2] >= self.min_face_px
+        return {
+            "faces": len(boxes),
+            "track_id": self.track_id,
+            "stable": stable,
+            "large_enough": large,
+            "ready": stable and large and not self.decided and self.misses == 0,
+        }
+
+    def mark_attempt(self, recognized: bool):
+        """
+        Record an identification of the current track; an unrecognized face is
+        retried (once stable again) up to max_attempts times
+        """
+        self.attempts += 1
+        self.decided = recognized or self.attempts >= self.max_attempts
+        if not self.decided:
+            self.hits = 0
+
+
+def track_frame(tracker: FaceTracker, frame_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Decode a streamed frame and advance the tracker, or None if it is not an image
+    """
+    gray = cv2.imdecode(np.frombuffer(frame_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    return tracker.update(detect_face_boxes(gray))
+
+
+class StreamStats:
+    def __init__(self):
+        """Counters for the streaming kiosk endpoint"""
+        self._lock = threading.Lock()
+        self._active = 0
+        self._connections = 0
+        self._frames = 0
+        self._identifications = 0
+
+    def opened(self):
+        with self._lock:
+            self._active += 1
+            self._connections += 1
+
+    def closed(self):
+        with self._lock:
+            self._active -= 1
+
+    def frame(self):
+        with self._lock:
+            self._frames += 1
+
+    def identified(self):
+        with self._lock:
+            self._identifications += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "active": self._active,
+                "connections": self._connections,
+                "frames": self._frames,
+                "identifications": self._identifications,
+                "frames_per_identification": (
+                    self._frames / self._identifications if self._identifications else None
+                ),
+            }
+
+
+stream_stats = StreamStats()
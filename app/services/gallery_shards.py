@@ -0,0 +1,452 @@
+"""
+Scatter-gather identification over a gallery split across worker processes
+
+With GALLERY_SHARDS=N (N > 1) the employee gallery is partitioned over N local
+shard processes, each holding an ordinary FaceGallery for its share of the
+employees. A probe is sent to every shard (scatter), each shard returns its
+local top-k, and the coordinator merges them (gather), so one search uses N
+cores and N memory spaces instead of one BLAS call over one matrix.
+
+Messages are plain (request id, op, args) tuples of builtins and NumPy arrays
+over a duplex pipe, so the same protocol can later run over a socket to shards
+on other hosts.
+
+New employees go to the least loaded shard. When removals leave the shards
+unbalanced by more than the rebalance slack, employees are copied from the
+largest to the smallest shard and only then removed from the source, so a
+concurrent search never misses them (duplicates are merged by identity).
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Tuple, Optional, Dict, Any, List, Sequence, Iterable
+
+import numpy as np
+
+from app.services.face_gallery import FaceGallery
+
+logger = logging.getLogger(__name__)
+
+GALLERY_SHARDS = int(os.getenv("GALLERY_SHARDS", 0))
+SHARD_TIMEOUT_SECONDS = float(os.getenv("GALLERY_SHARD_TIMEOUT", 5.0))
+# Rebalance once the largest and smallest shard differ by more than
+# max(REBALANCE_MIN_ROWS, REBALANCE_RATIO * average shard size)
+REBALANCE_MIN_ROWS = 64
+REBALANCE_RATIO = 0.1
+
+
+# --- Shard process ---
+
+def _op_add(gallery: FaceGallery, identity: str, embedding: np.ndarray, templates: Optional[np.ndarray]):
+    gallery.add(identity, embedding, templates=templates)
+
+
+def _op_update(gallery: FaceGallery, identity: str, embedding: Optional[np.ndarray], templates: Optional[np.ndarray]):
+    return gallery.update(identity, embedding, templates=templates)
+
+
+def _op_remove(gallery: FaceGallery, identities: List[str]) -> int:
+    return sum(gallery.remove(identity) for identity in identities)
+
+
+def _op_export(gallery: FaceGallery, identities: List[str]):
+    entries = []
+    for identity in identities:
+        entry = gallery.get_embedding(identity)
+        if entry is not None:
+            entries.append((identity, *entry))
+    return entries
+
+
+def _op_put(gallery: FaceGallery, entries: List[Tuple[str, np.ndarray, Optional[np.ndarray]]]):
+    for identity, embedding, templates in entries:
+        gallery.add(identity, embedding, templates=templates)
+
+
+def _op_search(gallery: FaceGallery,
+               probe: np.ndarray,
+               top_k: int,
+               rerank_k: Optional[int],
+               candidates: Optional[List[str]]) -> List[Tuple[str, float]]:
+    if rerank_k is None:
+        return gallery.search(probe, top_k=top_k, candidates=candidates)
+    return gallery.search_templates(probe, top_k=top_k, rerank_k=rerank_k, candidates=candidates)
+
+
+SHARD_OPS = {
+    "add": _op_add,
+    "update": _op_update,
+    "remove": _op_remove,
+    "export": _op_export,
+    "put": _op_put,
+    "clear": lambda gallery: gallery.clear(),
+    "size": lambda gallery: len(gallery),
+    "search": _op_search,
+}
+
+
+def _shard_main(conn, scan_dtype: str, rescore_k: int, rows_dir: Optional[str]):
+    """Serve one gallery partition until the pipe closes or 'stop' arrives"""
+    gallery = FaceGallery(scan_dtype=scan_dtype, rescore_k=rescore_k, rows_dir=rows_dir)
+    while True:
+        try:
+            request_id, op, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        if op == "stop":
+            break
+        try:
+            conn.send((request_id, True, SHARD_OPS[op](gallery, *args)))
+        except Exception as e:
+            conn.send((request_id, False, f"{op} failed: {e!r}"))
+    conn.close()
+
+
+# --- Coordinator side ---
+
+class GalleryShard:
+    def __init__(self, number: int, scan_dtype: str, rescore_k: int, rows_dir: Optional[str] = None):
+        """
+        Handle on one shard process; requests are pipelined and matched to
+        replies by id, so several threads can search concurrently
+        """
+        self.number = number
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=_shard_main,
+            args=(child_conn, scan_dtype, rescore_k, rows_dir),
+            name=f"gallery-shard-{number}",
+            daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, name=f"gallery-shard-{number}-reader", daemon=True)
+        self._reader.start()
+
+    def request(self, op: str, *args) -> Future:
+        future: Future = Future()
+        request_id = next(self._ids)
+        with self._pending_lock:
+            self._pending[request_id] = future
+        try:
+            with self._send_lock:
+                self._conn.send((request_id, op, args))
+        except (OSError, ValueError) as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            future.set_exception(RuntimeError(f"Gallery shard {self.number} is gone: {e}"))
+        return future
+
+    def _read(self):
+        while True:
+            try:
+                request_id, ok, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(f"Gallery shard {self.number}: {payload}"))
+        # Fail whatever was still waiting on the dead shard
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError(f"Gallery shard {self.number} exited"))
+
+    @property
+    def alive(self) -> bool:
+        return self._process.is_alive()
+
+    def stop(self):
+        try:
+            with self._send_lock:
+                self._conn.send((None, "stop", ()))
+        except (OSError, ValueError):
+            pass
+        self._process.join(timeout=SHARD_TIMEOUT_SECONDS)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._conn.close()
+
+
+def _log_failure(future: Future):
+    if future.exception() is not None:
+        logger.error(f"❌ {future.exception()}")
+
+
+class ShardedGallery:
+    def __init__(self,
+                 shards: int,
+                 scan_dtype: str = "float32",
+                 rescore_k: int = 32,
+                 rows_dir: Optional[str] = None,
+                 timeout: float = SHARD_TIMEOUT_SECONDS):
+        """
+        FaceGallery-compatible front end over shard processes
+
+        Writes are sent without waiting (each shard applies its messages in
+        order, so a later search already sees them); searches wait for every
+        involved shard.
+
+        Args:
+            shards: Number of shard processes
+            scan_dtype: Scan precision used inside each shard (see FaceGallery)
+            rescore_k: Rows re-scored exactly after a compact scan, per shard
+            rows_dir: Directory for each shard's float32 rows under a compact scan
+            timeout: Seconds to wait for a shard's reply
+        """
+        self.shard_count = max(1, shards)
+        self.scan_dtype = scan_dtype
+        self.rescore_k = rescore_k
+        self.rows_dir = rows_dir
+        self.timeout = timeout
+        self._shards: List[GalleryShard] = []
+        self._placement: Dict[str, int] = {}
+        self._members: List[set] = [set() for _ in range(self.shard_count)]
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        # Employees written while a rebalance is exporting rows; they stay put
+        self._moving: Optional[set] = None
+
+        self._searches = 0
+        self._search_seconds = 0.0
+        self._moved = 0
+        self._rebalances = 0
+
+    # --- Lifecycle ---
+
+    def start(self):
+        with self._lock:
+            if self._shards:
+                return
+            self._shards = [GalleryShard(n, self.scan_dtype, self.rescore_k, self.rows_dir) for n in range(self.shard_count)]
+        logger.info(f"🧩 Started {self.shard_count} gallery shard processes")
+
+    def stop(self):
+        with self._lock:
+            shards, self._shards = self._shards, []
+        for shard in shards:
+            shard.stop()
+
+    def _shard(self, number: int) -> GalleryShard:
+        if not self._shards:
+            self.start()
+        return self._shards[number]
+
+    # --- FaceGallery interface ---
+
+    def __len__(self) -> int:
+        return len(self._placement)
+
+    def __contains__(self, identity: str) -> bool:
+        return identity in self._placement
+
+    @property
+    def ids(self) -> List[str]:
+        return list(self._placement)
+
+    def get_metadata(self, identity: str) -> Optional[Dict[str, Any]]:
+        return self._metadata.get(identity)
+
+    def add(self,
+            identity: str,
+            embedding: Sequence[float],
+            metadata: Optional[Dict[str, Any]] = None,
+            templates: Optional[Sequence[Sequence[float]]] = None):
+        with self._lock:
+            number = self._placement.get(identity)
+            if number is None:
+                number = min(range(self.shard_count), key=lambda n: len(self._members[n]))
+                self._placement[identity] = number
+                self._members[number].add(identity)
+            self._touch(identity)
+            self._metadata[identity] = dict(metadata or {})
+            self._shard(number).request(
+                "add", identity, np.asarray(embedding, dtype=np.float32),
+                np.asarray(templates, dtype=np.float32) if templates is not None and len(templates) else None
+            ).add_done_callback(_log_failure)
+
+    def update(self,
+               identity: str,
+               embedding: Optional[Sequence[float]] = None,
+               metadata: Optional[Dict[str, Any]] = None,
+               templates: Optional[Sequence[Sequence[float]]] = None) -> bool:
+        with self._lock:
+            number = self._placement.get(identity)
+            if number is None:
+                return False
+            if metadata is not None:
+                self._metadata[identity].update(metadata)
+            if embedding is not None or templates is not None:
+                self._touch(identity)
+                self._shard(number).request(
+                    "update", identity,
+                    None if embedding is None else np.asarray(embedding, dtype=np.float32),
+                    None if templates is None else np.asarray(templates, dtype=np.float32)
+                ).add_done_callback(_log_failure)
+            return True
+
+    def remove(self, identity: str) -> bool:
+        """
+        Remove an employee; may rebalance, which waits for a shard export (call off the event loop)
+        """
+        with self._lock:
+            number = self._placement.pop(identity, None)
+            if number is None:
+                return False
+            self._members[number].discard(identity)
+            self._metadata.pop(identity, None)
+            self._touch(identity)
+            self._shard(number).request("remove", [identity]).add_done_callback(_log_failure)
+            plan = self._plan_rebalance()
+        if plan is not None:
+            self._move(*plan)
+        return True
+
+    def _touch(self, identity: str):
+        # Caller holds the lock
+        if self._moving is not None:
+            self._moving.add(identity)
+
+    def clear(self):
+        with self._lock:
+            self._placement.clear()
+            self._metadata.clear()
+            for number, members in enumerate(self._members):
+                members.clear()
+                self._shard(number).request("clear").add_done_callback(_log_failure)
+
+    def search(self,
+               probe: Sequence[float],
+               top_k: int = 5,
+               candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        return self._scatter(probe, top_k, None, candidates)
+
+    def search_templates(self,
+                         probe: Sequence[float],
+                         top_k: int = 5,
+                         rerank_k: int = 5,
+                         candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        return self._scatter(probe, top_k, rerank_k, candidates)
+
+    def best_match(self,
+                   probe: Sequence[float],
+                   threshold: Optional[float] = None,
+                   candidates: Optional[Iterable[str]] = None,
+                   rerank_k: int = 5) -> Optional[Tuple[str, float]]:
+        results = self.search_templates(probe, top_k=1, rerank_k=rerank_k, candidates=candidates)
+        if not results:
+            return None
+        identity, distance = results[0]
+        if threshold is not None and distance > threshold:
+            return None
+        return identity, distance
+
+    # --- Scatter-gather ---
+
+    def _scatter(self,
+                 probe: Sequence[float],
+                 top_k: int,
+                 rerank_k: Optional[int],
+                 candidates: Optional[Iterable[str]]) -> List[Tuple[str, float]]:
+        if top_k <= 0 or not self._placement:
+            return []
+        start = time.perf_counter()
+        query = np.asarray(probe, dtype=np.float32)
+        with self._lock:
+            if candidates is None:
+                targets = {number: None for number in range(self.shard_count) if self._members[number]}
+            else:
+                # Only the shards owning a candidate are asked, each for its own
+                targets: Dict[int, Optional[List[str]]] = {}
+                for identity in candidates:
+                    number = self._placement.get(identity)
+                    if number is not None:
+                        targets.setdefault(number, []).append(identity)
+            futures = [self._shard(number).request("search", query, top_k, rerank_k, subset)
+                       for number, subset in targets.items()]
+
+        # A row being moved by a rebalance may briefly be on two shards
+        best: Dict[str, float] = {}
+        for future in futures:
+            for identity, distance in future.result(timeout=self.timeout):
+                if distance < best.get(identity, np.inf):
+                    best[identity] = distance
+        merged = sorted(best.items(), key=lambda item: item[1])[:top_k]
+        with self._lock:
+            self._searches += 1
+            self._search_seconds += time.perf_counter() - start
+        return merged
+
+    # --- Rebalancing ---
+
+    def _plan_rebalance(self) -> Optional[Tuple[int, int, List[str]]]:
+        """
+        (source, destination, employees) to move, or None; caller holds the lock
+        """
+        if self._moving is not None:
+            return None  # One rebalance at a time
+        sizes = [len(members) for members in self._members]
+        largest = max(range(self.shard_count), key=lambda n: sizes[n])
+        smallest = min(range(self.shard_count), key=lambda n: sizes[n])
+        slack = max(REBALANCE_MIN_ROWS, REBALANCE_RATIO * len(self._placement) / self.shard_count)
+        if sizes[largest] - sizes[smallest] <= slack:
+            return None
+        self._moving = set()
+        count = (sizes[largest] - sizes[smallest]) // 2
+        return largest, smallest, list(itertools.islice(self._members[largest], count))
+
+    def _move(self, source: int, destination: int, moving: List[str]):
+        """
+        Copy employees to another shard, then drop them from the source
+
+        The export is awaited without the lock, so searches and writes carry on;
+        employees written meanwhile are left on the source shard.
+        """
+        try:
+            entries = self._shard(source).request("export", moving).result(timeout=self.timeout)
+        except Exception as e:
+            logger.warning(f"⚠️ Gallery shard rebalance failed: {e}")
+            with self._lock:
+                self._moving = None
+            return
+        with self._lock:
+            touched, self._moving = self._moving, None
+            entries = [entry for entry in entries
+                       if self._placement.get(entry[0]) == source and entry[0] not in touched]
+            moved = [entry[0] for entry in entries]
+            self._shard(destination).request("put", entries).add_done_callback(_log_failure)
+            self._shard(source).request("remove", moved).add_done_callback(_log_failure)
+            for identity in moved:
+                self._members[source].discard(identity)
+                self._members[destination].add(identity)
+                self._placement[identity] = destination
+            self._moved += len(moved)
+            self._rebalances += 1
+        logger.info(f"⚖️ Moved {len(moved)} employees from gallery shard {source} to {destination}")
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": True,
+                "shards": self.shard_count,
+                "alive": sum(shard.alive for shard in self._shards),
+                "sizes": [len(members) for members in self._members],
+                "searches": self._searches,
+                "avg_search_ms": (self._search_seconds / self._searches * 1000) if self._searches else None,
+                "rebalances": self._rebalances,
+                "moved": self._moved,
+            }
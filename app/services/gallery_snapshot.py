@@ -0,0 +1,313 @@
+"""
+Versioned, memory-mapped gallery snapshots shared by all workers on a host
+
+One worker (whichever holds the publisher lock) writes the galleries to
+GALLERY_SNAPSHOT_DIR whenever they change:
+
+    employees-v000042.npy              L2-normalized embedding matrix, one row per id
+    employees-v000042.templates.npy    per-capture templates, concatenated (optional)
+    employees-v000042.json             ids, metadata, template row ranges
+    CURRENT                            {"version": 42, "published_at": ..., "pipeline": ..., ...}
+
+CURRENT is replaced atomically (write + os.replace), so readers never see a
+half-published version. Every worker maps the .npy files read-only; the page
+cache holds a single copy per host, and booting becomes a file map instead of
+a MongoDB scan. Workers notice a new CURRENT and swap to it under the gallery
+lock; changes they applied in the meantime (gallery_sync) are already part of
+the newer version once the publisher has caught up with them.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Optional, Dict, Any
+
+import numpy as np
+
+from app.services.face_gallery import FaceGallery
+from app.services.face_service import employee_gallery, shortlist_gallery, embedding_pipeline, rebuild_partitions
+
+logger = logging.getLogger(__name__)
+
+GALLERY_SNAPSHOT_DIR = os.getenv("GALLERY_SNAPSHOT_DIR") or None
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("GALLERY_SNAPSHOT_INTERVAL", 5.0))
+# Snapshots older than this are ignored at boot (the change feed may no longer
+# reach back that far) and the gallery is loaded from MongoDB instead
+SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("GALLERY_SNAPSHOT_MAX_AGE", 24 * 3600))
+# A worker keeps its private copy until a version published at least this long
+# after its own last change, so a fresher local change is not rolled back
+SNAPSHOT_SETTLE_SECONDS = 2.0
+KEEP_VERSIONS = 3
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "publisher.lock"
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _save_array(path: str, array: np.ndarray):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def _map_array(path: str) -> np.ndarray:
+    array = np.load(path, mmap_mode="r")
+    return array if array.size else np.load(path)
+
+
+class GallerySnapshotManager:
+    def __init__(self,
+                 directory: Optional[str] = GALLERY_SNAPSHOT_DIR,
+                 galleries: Optional[Dict[str, FaceGallery]] = None,
+                 interval: float = SNAPSHOT_INTERVAL_SECONDS):
+        """
+        Publishes and follows memory-mapped gallery snapshots
+
+        Args:
+            directory: Snapshot directory shared by the host's workers (None disables)
+            galleries: Galleries to snapshot, by file prefix
+            interval: Seconds between publish / new-version checks
+        """
+        if galleries is None and not isinstance(employee_gallery, FaceGallery):
+            # A sharded employee gallery lives in its shard processes; they
+            # load from MongoDB instead
+            directory = None
+        self.directory = directory
+        self.galleries = galleries if galleries is not None else {
+            "employees": employee_gallery,
+            "shortlist": shortlist_gallery,
+        }
+        self.interval = interval
+        self.version = 0
+        self.published_at: Optional[float] = None
+
+        self._lock_file = None
+        self._published_generations: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._publishes = 0
+        self._swaps = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    @property
+    def is_publisher(self) -> bool:
+        return self._lock_file is not None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _try_become_publisher(self) -> bool:
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self._path(LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        # Held (and the lock kept) for the life of the process
+        self._lock_file = lock_file
+        logger.info(f"📝 This worker (pid {os.getpid()}) publishes gallery snapshots")
+        return True
+
+    def read_current(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(CURRENT_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    # --- Reading ---
+
+    def _map_version(self, current: Dict[str, Any], generations: Optional[Dict[str, int]] = None):
+        """
+        Map every gallery of a version, then swap them in
+
+        Args:
+            generations: Skip a gallery that changed locally since this generation
+        """
+        states = {}
+        for name, base in current["galleries"].items():
+            with open(self._path(f"{base}.json")) as f:
+                index = json.load(f)
+            matrix = _map_array(self._path(f"{base}.npy"))
+            templates = {}
+            if index.get("templates"):
+                template_matrix = _map_array(self._path(f"{base}.templates.npy"))
+                templates = {
+                    identity: template_matrix[start:end]
+                    for identity, (start, end) in index["templates"].items()
+                }
+            states[name] = (matrix, index["ids"], index["metadata"], templates)
+        swapped = False
+        for name, state in states.items():
+            gallery = self.galleries.get(name)
+            if gallery is None:
+                continue
+            expected = None if generations is None else generations[name]
+            if gallery.load_state(*state, if_generation=expected):
+                self._published_generations[name] = gallery.generation
+                swapped = True
+        if swapped:
+            # Partitions and the cascade's unshortlisted set are derived from
+            # the galleries and would otherwise still describe the old rows
+            rebuild_partitions()
+        self.version = current["version"]
+        self.published_at = current["published_at"]
+
+    def restore(self) -> Optional[float]:
+        """
+        Map the current snapshot at boot, if there is a recent enough one
+
+        Returns:
+            Publish time (unix seconds) of the mapped version, or None if the
+            gallery must be loaded from the database
+        """
+        if not self.enabled:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        current = self.read_current()
+        if current is None or time.time() - current["published_at"] > SNAPSHOT_MAX_AGE_SECONDS:
+            return None
+        if current.get("pipeline") != embedding_pipeline():
+            # Rows embedded by another model, backend or detector must not be matched
+            logger.info(f"🔄 Ignoring gallery snapshot v{current['version']} from another embedding pipeline")
+            return None
+        try:
+            self._map_version(current)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Could not map gallery snapshot v{current.get('version')}: {e}")
+            return None
+        logger.info(f"🗺️ Mapped gallery snapshot v{self.version} "
+                    f"({len(self.galleries['employees'])} employees)")
+        return self.published_at
+
+    def _maybe_swap(self):
+        current = self.read_current()
+        if current is None or current["version"] <= self.version or current.get("pipeline") != embedding_pipeline():
+            return
+        generations = {name: g.generation for name, g in self.galleries.items()}
+        last_change = max(g.modified_at for g in self.galleries.values())
+        if current["published_at"] < last_change + SNAPSHOT_SETTLE_SECONDS:
+            return
+        self._map_version(current, generations)
+        self._swaps += 1
+        logger.info(f"🔁 Switched to gallery snapshot v{self.version}")
+
+    # --- Publishing ---
+
+    def _dirty(self) -> bool:
+        return any(self._published_generations.get(name) != gallery.generation
+                   for name, gallery in self.galleries.items())
+
+    def publish(self):
+        """
+        Write every gallery as a new version and point CURRENT at it
+        """
+        current = self.read_current()
+        version = max(self.version, current["version"] if current else 0) + 1
+        published_at = time.time()
+        generations = {}
+        bases = {}
+        for name, gallery in self.galleries.items():
+            matrix, ids, metadata, templates, generations[name] = gallery.export_state()
+            base = f"{name}-v{version:06d}"
+            ranges, blocks, offset = {}, [], 0
+            for identity in ids:
+                block = templates.get(identity)
+                if block is not None:
+                    ranges[identity] = (offset, offset + len(block))
+                    blocks.append(np.asarray(block, dtype=np.float32))
+                    offset += len(block)
+            _save_array(self._path(f"{base}.npy"), matrix)
+            if blocks:
+                _save_array(self._path(f"{base}.templates.npy"), np.concatenate(blocks))
+            index = {"ids": ids, "metadata": metadata, "templates": ranges, "published_at": published_at}
+            _write_atomic(self._path(f"{base}.json"), json.dumps(index, default=str).encode())
+            bases[name] = base
+
+        pointer = {"version": version, "published_at": published_at, "galleries": bases,
+                   "pipeline": embedding_pipeline()}
+        _write_atomic(self._path(CURRENT_FILE), json.dumps(pointer).encode())
+        self._published_generations = dict(generations)
+        self._publishes += 1
+        logger.info(f"📦 Published gallery snapshot v{version}")
+
+        # Drop this worker's private copy in favour of the shared map; a gallery
+        # that changed while the files were being written keeps its copy
+        self._map_version(pointer, generations)
+        self._prune(version)
+
+    def _prune(self, version: int):
+        # Workers that still map an older file keep it alive until they swap
+        for filename in os.listdir(self.directory):
+            for name in self.galleries:
+                prefix = f"{name}-v"
+                if filename.startswith(prefix):
+                    try:
+                        file_version = int(filename[len(prefix):len(prefix) + 6])
+                    except ValueError:
+                        continue
+                    if file_version <= version - KEEP_VERSIONS:
+                        os.remove(self._path(filename))
+
+    # --- Background loop ---
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                # A worker takes over publishing if the previous publisher exited
+                if self._try_become_publisher():
+                    if self._dirty() or self.read_current() is None:
+                        await asyncio.to_thread(self.publish)
+                else:
+                    await asyncio.to_thread(self._maybe_swap)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Gallery snapshot error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "publisher": self.is_publisher,
+            "version": self.version,
+            "age_seconds": None if self.published_at is None else time.time() - self.published_at,
+            "publishes": self._publishes,
+            "swaps": self._swaps,
+            "private_copy": any(g.generation != self._published_generations.get(name)
+                                for name, g in self.galleries.items()),
+        }
+
+
+# Restored and started by the app lifespan when GALLERY_SNAPSHOT_DIR is set
+gallery_snapshots = GallerySnapshotManager()
@@ -0,0 +1,306 @@
+"""
+Incremental face gallery sync across worker processes
+
+Every uvicorn worker holds its own copy of the employee galleries. The gallery
+is loaded in full once at startup; afterwards GallerySync applies each
+add/update/remove made by any worker (or the backfill CLI) incrementally:
+
+    change_stream  MongoDB change stream on users (replica sets, incl. a
+                   single-node one: mongod --replSet rs0, then rs.initiate())
+    polling        users.updated_at watermark plus user_tombstones for deletes,
+                   for standalone deployments
+
+GALLERY_SYNC_MODE=auto (default) uses the change stream and falls back to
+polling when the server does not support one. When the oplog no longer holds
+the point the stream should resume from (e.g. a worker booted from a day-old
+gallery snapshot), one polling pass catches up from the watermark and the
+stream is followed again from now.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any
+
+from bson import Timestamp
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.services.db import db
+from app.services.face_service import index_employee, unindex_employee, has_current_embedding
+
+logger = logging.getLogger(__name__)
+
+GALLERY_SYNC_MODE = os.getenv("GALLERY_SYNC_MODE", "auto")  # auto | change_stream | polling | off
+GALLERY_POLL_INTERVAL = float(os.getenv("GALLERY_POLL_INTERVAL", 2.0))
+# Re-read this much history on every poll so writes whose updated_at was taken
+# slightly before an earlier poll finished are not missed (applying is idempotent)
+GALLERY_POLL_OVERLAP = timedelta(seconds=float(os.getenv("GALLERY_POLL_OVERLAP", 5.0)))
+TOMBSTONE_TTL_SECONDS = int(os.getenv("TOMBSTONE_TTL_SECONDS", 7 * 24 * 3600))
+RETRY_DELAY_SECONDS = 5.0
+
+TOMBSTONES_COLLECTION = "user_tombstones"
+# Server error code for "$changeStream is only supported on replica sets"
+CHANGE_STREAM_UNSUPPORTED = 40573
+# ChangeStreamFatalError and ChangeStreamHistoryLost: the resume point has
+# rolled off the oplog
+CHANGE_STREAM_HISTORY_LOST = (280, 286)
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def as_utc(value: datetime) -> datetime:
+    # Motor returns naive datetimes that are already UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+async def record_deletion(db, user_id: str):
+    """
+    Leave a tombstone so polling workers see a delete the users collection no longer shows
+    """
+    await db[TOMBSTONES_COLLECTION].insert_one({"user_id": user_id, "deleted_at": utc_now()})
+
+
+class GallerySync:
+    def __init__(self, db, mode: str = GALLERY_SYNC_MODE, poll_interval: float = GALLERY_POLL_INTERVAL):
+        """
+        Applies user changes to this process' galleries
+
+        Args:
+            db: Motor database holding users and user_tombstones
+            mode: 'auto', 'change_stream', 'polling' or 'off'
+            poll_interval: Seconds between polls in polling mode
+        """
+        if mode not in ("auto", "change_stream", "polling", "off"):
+            raise ValueError(f"Unknown gallery sync mode: {mode}")
+        self.db = db
+        self.mode = mode
+        self.poll_interval = poll_interval
+
+        self._task: Optional[asyncio.Task] = None
+        self._since: Optional[datetime] = None
+        self._operation_time = None
+        self._resume_token = None
+        self._catch_up_pending = False
+        self._active_mode: Optional[str] = None
+
+        self._lock = threading.Lock()
+        self._upserts = 0
+        self._removals = 0
+        self._errors = 0
+        self._last_lag = None
+        self._max_lag = 0.0
+        self._last_applied_at: Optional[float] = None
+
+    async def mark(self, since: Optional[datetime] = None):
+        """
+        Remember the point to sync from: right before the startup full load so
+        nothing written during the load is missed, or the publish time of a
+        mapped gallery snapshot
+        """
+        self._since = since or utc_now()
+        self._operation_time = await self._cluster_time()
+        if since is not None and self._operation_time is not None:
+            self._operation_time = Timestamp(int(since.timestamp()), 0)
+
+    async def _cluster_time(self):
+        try:
+            # operationTime is only reported by replica sets
+            result = await self.db.command("ping")
+            return result.get("operationTime")
+        except PyMongoError:
+            return None
+
+    def start(self):
+        if self.mode == "off" or self._task is not None:
+            return
+        if self._since is None:
+            self._since = utc_now()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        polling = self.mode == "polling"
+        while True:
+            try:
+                if not polling:
+                    try:
+                        await self._watch()
+                        return
+                    except OperationFailure as e:
+                        if self.mode == "change_stream" or e.code != CHANGE_STREAM_UNSUPPORTED:
+                            raise
+                        polling = True
+                        logger.info("ℹ️ Change streams need a replica set; falling back to polling")
+                await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Never give up: a worker that stops syncing serves a stale gallery
+                # until it restarts. Both modes pick up again from the watermark.
+                with self._lock:
+                    self._errors += 1
+                self._active_mode = "retrying"
+                logger.error(f"❌ Gallery sync failed ({e}); retrying in {RETRY_DELAY_SECONDS}s")
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+
+    # --- Applying changes ---
+
+    def _record(self, changed_at: Optional[datetime], removed: bool):
+        with self._lock:
+            if removed:
+                self._removals += 1
+            else:
+                self._upserts += 1
+            self._last_applied_at = time.time()
+            if changed_at is not None:
+                lag = max(0.0, (utc_now() - as_utc(changed_at)).total_seconds())
+                self._last_lag = lag
+                self._max_lag = max(self._max_lag, lag)
+
+    def _apply_upsert(self, user: Dict[str, Any], changed_at: Optional[datetime], record: bool = True):
+        user_id = str(user["_id"])
+        if has_current_embedding(user):
+            index_employee(user_id, user)
+        else:
+            # Embedding dropped or stale: the employee must not stay matchable
+            unindex_employee(user_id)
+        if record:
+            self._record(changed_at, removed=False)
+
+    def _apply_remove(self, user_id: str, changed_at: Optional[datetime], record: bool = True):
+        unindex_employee(user_id)
+        if record:
+            self._record(changed_at, removed=True)
+
+    # --- Change stream ---
+
+    async def _watch(self):
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+            # Never ship photo bytes through the stream
+            {"$project": {"fullDocument.face_image": 0}},
+        ]
+        while True:
+            options = {"full_document": "updateLookup"}
+            if self._resume_token is not None:
+                options["resume_after"] = self._resume_token
+            elif self._operation_time is not None:
+                options["start_at_operation_time"] = self._operation_time
+            try:
+                if self._catch_up_pending:
+                    await self._ensure_indexes()
+                    self._since = await self._catch_up(self._since)
+                    self._catch_up_pending = False
+                async with self.db.users.watch(pipeline, **options) as stream:
+                    if self._active_mode != "change_stream":
+                        self._active_mode = "change_stream"
+                        logger.info("🔄 Gallery sync following the users change stream")
+                    async for event in stream:
+                        self._resume_token = stream.resume_token
+                        # Off the event loop: a sharded gallery may rebalance on removal
+                        changed_at = await asyncio.to_thread(self._apply_event, event)
+                        if changed_at is not None:
+                            self._since = max(self._since, as_utc(changed_at))
+            except OperationFailure as e:
+                if e.code not in CHANGE_STREAM_HISTORY_LOST:
+                    raise
+                with self._lock:
+                    self._errors += 1
+                logger.warning(f"⚠️ Change stream history lost ({e}); catching up from "
+                               f"{self._since.isoformat()} and following the stream from now")
+                # Take the new start point before catching up: changes made
+                # meanwhile are then seen twice rather than not at all
+                self._resume_token = None
+                self._operation_time = await self._cluster_time()
+                self._catch_up_pending = True
+            except PyMongoError as e:
+                with self._lock:
+                    self._errors += 1
+                logger.warning(f"⚠️ Change stream interrupted ({e}); resuming in {RETRY_DELAY_SECONDS}s")
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+
+    def _apply_event(self, event: Dict[str, Any]) -> Optional[datetime]:
+        changed_at = event.get("wallTime")
+        if changed_at is None and event.get("clusterTime") is not None:
+            changed_at = event["clusterTime"].as_datetime()
+        user_id = str(event["documentKey"]["_id"])
+        if event["operationType"] == "delete":
+            self._apply_remove(user_id, changed_at)
+        elif event.get("fullDocument") is not None:
+            self._apply_upsert(event["fullDocument"], changed_at)
+        else:
+            # Updated then deleted before the lookup; the delete event follows
+            self._apply_remove(user_id, changed_at)
+        return changed_at
+
+    # --- Polling fallback ---
+
+    async def _ensure_indexes(self):
+        await self.db.users.create_index("updated_at")
+        await self.db[TOMBSTONES_COLLECTION].create_index("deleted_at", expireAfterSeconds=TOMBSTONE_TTL_SECONDS)
+
+    async def _catch_up(self, watermark: datetime) -> datetime:
+        """
+        Apply every change made since the watermark
+
+        Returns:
+            The new watermark
+        """
+        since = watermark - GALLERY_POLL_OVERLAP
+        newest = watermark
+        cursor = self.db.users.find({"updated_at": {"$gte": since}}, {"face_image": 0}).sort("updated_at", 1)
+        # Changes inside the overlap window are re-applied but only
+        # counted (and measured for lag) the first time they are seen
+        async for user in cursor:
+            changed_at = as_utc(user["updated_at"])
+            await asyncio.to_thread(self._apply_upsert, user, changed_at, changed_at > watermark)
+            newest = max(newest, changed_at)
+        async for tombstone in self.db[TOMBSTONES_COLLECTION].find({"deleted_at": {"$gte": since}}):
+            changed_at = as_utc(tombstone["deleted_at"])
+            await asyncio.to_thread(self._apply_remove, tombstone["user_id"], changed_at, changed_at > watermark)
+            newest = max(newest, changed_at)
+        return newest
+
+    async def _poll(self):
+        await self._ensure_indexes()
+        self._active_mode = "polling"
+        logger.info(f"🔄 Gallery sync polling every {self.poll_interval}s")
+
+        while True:
+            try:
+                self._since = await self._catch_up(self._since)
+            except PyMongoError as e:
+                with self._lock:
+                    self._errors += 1
+                logger.warning(f"⚠️ Gallery poll failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self._active_mode or self.mode,
+                "upserts": self._upserts,
+                "removals": self._removals,
+                "errors": self._errors,
+                "lag_seconds": self._last_lag,
+                "max_lag_seconds": self._max_lag,
+                "seconds_since_last_change": (
+                    None if self._last_applied_at is None else time.time() - self._last_applied_at
+                ),
+            }
+
+
+# Started by the app lifespan once the startup full load is done
+gallery_sync = GallerySync(db)
@@ -0,0 +1,225 @@
+import asyncio
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Tuple, Optional, Dict, Any, List, Union
+
+from app.services.face_service import (
+    model_registry,
+    MicroBatchScheduler,
+    EMBEDDING_MODEL_NAME,
+    DEFAULT_DETECTOR_BACKEND,
+    MATCH_THRESHOLD,
+)
+
+logger = logging.getLogger(__name__)
+
+# "thread" shares the process' warmed-up models (TensorFlow releases the GIL during
+# inference); "process" gives each worker its own interpreter and model copy.
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", os.cpu_count() or 1))
+# Process workers receive uploads at least this large through shared memory
+SHARED_MEMORY_MIN_BYTES = int(os.getenv("INFERENCE_SHM_MIN_BYTES", 64 * 1024))
+
+# Either raw bytes or a (shared memory name, size) handle
+ImagePayload = Union[bytes, Tuple[str, int]]
+
+
+def _process_worker_init(model_name: str, detector_backend: str):
+    """Load and warm the model once per worker process"""
+    model_registry.preload([(model_name, detector_backend)])
+
+
+def _read_payload(payload: ImagePayload) -> bytes:
+    if isinstance(payload, bytes):
+        return payload
+    name, size = payload
+    # The parent owns the block and unlinks it once the call returns
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def _embed(payload: ImagePayload, model_name: str, detector_backend: str) -> Optional[List[float]]:
+    verifier = model_registry.get_verifier(model_name, detector_backend)
+    return verifier.compute_embedding(_read_payload(payload))
+
+
+def _embed_batch(payloads: List[ImagePayload],
+                 model_name: str,
+                 detector_backend: str,
+                 require_face: bool = False) -> List[Optional[List[float]]]:
+    verifier = model_registry.get_verifier(model_name, detector_backend)
+    return verifier.compute_embeddings([_read_payload(payload) for payload in payloads], require_face=require_face)
+
+
+def _verify(reference: ImagePayload,
+            live: ImagePayload,
+            threshold: float,
+            model_name: str,
+            detector_backend: str) -> Tuple[bool, float]:
+    verifier = model_registry.get_verifier(model_name, detector_backend)
+    is_verified, distance, _ = verifier.verify_attendance(
+        _read_payload(reference),
+        _read_payload(live),
+        threshold=threshold
+    )
+    return is_verified, distance
+
+
+class InferenceExecutor:
+    def __init__(self,
+                 mode: str = INFERENCE_EXECUTOR,
+                 workers: int = INFERENCE_WORKERS,
+                 model_name: str = EMBEDDING_MODEL_NAME,
+                 detector_backend: str = DEFAULT_DETECTOR_BACKEND):
+        """
+        Runs CPU-heavy face inference off the asyncio event loop
+
+        Args:
+            mode: 'thread' or 'process'
+            workers: Number of pool workers
+            model_name: Model used by embed/verify
+            detector_backend: Detector used by embed/verify
+        """
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown inference executor mode: {mode}")
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._completed = 0
+        self._failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    # Never fork a process that already loaded TensorFlow
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_process_worker_init,
+                    initargs=(self.model_name, self.detector_backend)
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="face-inference"
+                )
+        logger.info(f"⚙️ Inference executor started ({self.mode}, {self.workers} workers)")
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+            logger.info("⚙️ Inference executor stopped")
+
+    async def run(self, fn, *args):
+        """
+        Await fn(*args) on the pool, tracking queue depth
+        """
+        if self._executor is None:
+            self.start()
+        with self._lock:
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, fn, *args)
+            with self._lock:
+                self._completed += 1
+            return result
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _share(self, data: bytes, blocks: List[shared_memory.SharedMemory]) -> ImagePayload:
+        if self.mode != "process" or len(data) < SHARED_MEMORY_MIN_BYTES:
+            return data
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        blocks.append(shm)
+        return shm.name, len(data)
+
+    @staticmethod
+    def _release(blocks: List[shared_memory.SharedMemory]):
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    async def embed(self, image_bytes: bytes) -> Optional[List[float]]:
+        """
+        Compute a face embedding on the pool
+        """
+        blocks: List[shared_memory.SharedMemory] = []
+        try:
+            payload = self._share(image_bytes, blocks)
+            return await self.run(_embed, payload, self.model_name, self.detector_backend)
+        finally:
+            self._release(blocks)
+
+    async def embed_batch(self, images: List[bytes], require_face: bool = False) -> List[Optional[List[float]]]:
+        """
+        Embed a batch of images with one model call on the pool
+        
+        Args:
+            images: Raw uploads
+            require_face: None for images without a detected face, instead of a whole-frame embedding
+        """
+        blocks: List[shared_memory.SharedMemory] = []
+        try:
+            payloads = [self._share(image, blocks) for image in images]
+            return await self.run(_embed_batch, payloads, self.model_name, self.detector_backend, require_face)
+        finally:
+            self._release(blocks)
+
+    async def verify(self,
+                     reference_bytes: bytes,
+                     live_bytes: bytes,
+                     threshold: float = MATCH_THRESHOLD) -> Tuple[bool, float]:
+        """
+        Image-to-image verification on the pool (legacy users without embeddings)
+        """
+        blocks: List[shared_memory.SharedMemory] = []
+        try:
+            reference = self._share(reference_bytes, blocks)
+            live = self._share(live_bytes, blocks)
+            return await self.run(_verify, reference, live, threshold, self.model_name, self.detector_backend)
+        finally:
+            self._release(blocks)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "queue_depth": max(0, self._in_flight - self.workers),
+                "peak_in_flight": self._peak_in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+            }
+
+
+# Shared by the routes; started and stopped by the app lifespan
+inference_executor = InferenceExecutor()
+
+# Check-in frames go through the scheduler so concurrent kiosks share forward passes
+embedding_scheduler = MicroBatchScheduler(inference_executor.embed_batch)
@@ -0,0 +1,126 @@
+"""
+Recent identities: per-kiosk memory of the last few identification results
+
+People tap check-in two or three times and kiosks resend a capture when the
+response is slow. Each repeat would run 1:N matching and the attendance lookup
+only to land on the same answer. For RECENT_IDENTITY_TTL_SECONDS after a face
+is identified at a kiosk, a capture from the same kiosk, for the same action,
+whose embedding is within RECENT_IDENTITY_MAX_DISTANCE of the remembered one
+gets the remembered response back instead. The distance guard is much tighter
+than MATCH_THRESHOLD, so a different person stepping up is never answered from
+the cache.
+"""
+import os
+import threading
+import time
+from typing import Optional, Dict, Any, List, Tuple
+
+import numpy as np
+
+RECENT_IDENTITY_TTL_SECONDS = float(os.getenv("RECENT_IDENTITY_TTL_SECONDS", 5.0))
+RECENT_IDENTITY_MAX_DISTANCE = float(os.getenv("RECENT_IDENTITY_MAX_DISTANCE", 0.15))
+# Identities remembered per kiosk (a queue of people checking in one after another)
+RECENT_IDENTITY_PER_KIOSK = int(os.getenv("RECENT_IDENTITY_PER_KIOSK", 4))
+
+# (expires_at, action, normalized embedding, response)
+Entry = Tuple[float, str, np.ndarray, Dict[str, Any]]
+
+
+class RecentIdentityCache:
+    def __init__(self,
+                 ttl: float = RECENT_IDENTITY_TTL_SECONDS,
+                 max_distance: float = RECENT_IDENTITY_MAX_DISTANCE,
+                 per_kiosk: int = RECENT_IDENTITY_PER_KIOSK):
+        """
+        Short-lived cache of identification responses, keyed by kiosk
+
+        Args:
+            ttl: Seconds a response is reused for; 0 disables the cache
+            max_distance: Cosine distance under which a capture counts as the same face
+            per_kiosk: Responses remembered per kiosk
+        """
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.per_kiosk = per_kiosk
+        self._entries: Dict[str, List[Entry]] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stored = 0
+
+    @staticmethod
+    def _normalize(embedding) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def _live(self, kiosk: str, now: float) -> List[Entry]:
+        # Caller holds the lock
+        entries = [entry for entry in self._entries.get(kiosk, ()) if entry[0] > now]
+        if entries:
+            self._entries[kiosk] = entries
+        else:
+            self._entries.pop(kiosk, None)
+        return entries
+
+    def active(self, kiosk: Optional[str]) -> bool:
+        """
+        Whether the kiosk has unexpired responses, i.e. whether embedding the
+        capture up front to look it up can pay off
+        """
+        if not self.ttl or kiosk is None:
+            return False
+        with self._lock:
+            return bool(self._live(kiosk, time.monotonic()))
+
+    def lookup(self, kiosk: str, action: str, embedding) -> Optional[Dict[str, Any]]:
+        """
+        Returns:
+            The remembered response for a near-identical capture, or None
+        """
+        vector = None if embedding is None else self._normalize(embedding)
+        with self._lock:
+            best, best_distance = None, self.max_distance
+            if vector is not None:
+                for _, entry_action, entry_vector, response in self._live(kiosk, time.monotonic()):
+                    distance = 1.0 - float(np.dot(vector, entry_vector))
+                    if entry_action == action and distance <= best_distance:
+                        best, best_distance = response, distance
+            if best is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return dict(best)
+
+    def remember(self, kiosk: Optional[str], action: str, embedding, response: Dict[str, Any]):
+        """Remember the response given to an identified face at a kiosk"""
+        if not self.ttl or kiosk is None or embedding is None:
+            return
+        vector = self._normalize(embedding)
+        if vector is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            # Forget kiosks that went quiet so the dict does not grow with sessions
+            for stale in [key for key, entries in self._entries.items() if entries[-1][0] <= now]:
+                del self._entries[stale]
+            entries = self._live(kiosk, now)
+            entries.append((now + self.ttl, action, vector, dict(response)))
+            self._entries[kiosk] = entries[-self.per_kiosk:]
+            self._stored += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "ttl_seconds": self.ttl,
+                "kiosks": len(self._entries),
+                "stored": self._stored,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits / lookups) if lookups else None,
+            }
+
+
+# Answers repeated captures of the same face at the same kiosk
+recent_identities = RecentIdentityCache()
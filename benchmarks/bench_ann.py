@@ -0,0 +1,104 @@
+"""
+ANN benchmark: exact gallery scan vs IVF (and HNSW, if hnswlib is installed)
+
+Builds a synthetic gallery of clustered embeddings (one centroid per identity,
+probes are noisy captures of random identities) and reports, per method:
+
+    build s     time to train/populate the index
+    median ms   FaceGallery.search latency (index candidates + exact re-score)
+    p95 ms      95th percentile latency
+    recall@1    top-1 identical to the exact float32 scan
+
+A 1M-identity gallery at 512-d needs ~2 GB for the gallery plus ~2 GB for the
+IVF lists, so use --dimension to shrink it on small machines.
+
+Usage:
+    python -m benchmarks.bench_ann
+    python -m benchmarks.bench_ann --sizes 1000000 --dimension 128 --probes 200
+    python -m benchmarks.bench_ann --sizes 100000 --nprobe 4 8 16 32
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from app.services.face_gallery import FaceGallery
+from app.services.face_index import IVFIndex, HnswIndex, INDEX_TYPES
+
+
+def synthetic_gallery(size: int, dimension: int, probes: int, noise: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((size, dimension), dtype=np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    targets = rng.integers(0, size, probes)
+    spread = noise / np.sqrt(dimension)
+    captures = centroids[targets] + spread * rng.standard_normal((probes, dimension), dtype=np.float32)
+    return centroids, captures
+
+
+def hnsw_available() -> bool:
+    try:
+        import hnswlib  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def timed_search(gallery: FaceGallery, captures: np.ndarray):
+    gallery.search(captures[0], top_k=1)  # warm caches
+    timings, top1 = [], []
+    for probe in captures:
+        start = time.perf_counter()
+        hits = gallery.search(probe, top_k=1)
+        timings.append(time.perf_counter() - start)
+        top1.append(hits[0][0] if hits else None)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.95)] * 1000, top1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--dimension", type=int, default=512)
+    parser.add_argument("--probes", type=int, default=300)
+    parser.add_argument("--noise", type=float, default=0.6, help="Capture noise relative to identity spread")
+    parser.add_argument("--nprobe", nargs="+", type=int, default=[8, 16, 32])
+    parser.add_argument("--ef", nargs="+", type=int, default=[32, 64, 128])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        centroids, captures = synthetic_gallery(size, args.dimension, args.probes, args.noise)
+        ids = [str(i) for i in range(size)]
+        gallery = FaceGallery(dimension=args.dimension, initial_capacity=size)
+        gallery.load_state(centroids, ids, {})
+
+        print(f"\n{size} identities, {args.dimension}-d, {args.probes} probes")
+        print(f"{'method':>14} {'build s':>8} {'median ms':>10} {'p95 ms':>8} {'recall@1':>9}")
+        median, p95, reference = timed_search(gallery, captures)
+        print(f"{'exact':>14} {'-':>8} {median:>10.2f} {p95:>8.2f} {1:>9.2%}")
+
+        kinds = ["ivf"] + (["hnsw"] if hnsw_available() else [])
+        for kind in kinds:
+            start = time.perf_counter()
+            index = INDEX_TYPES[kind](args.dimension)
+            index.train(centroids, ids)
+            build = time.perf_counter() - start
+            gallery.attach_index(index, min_size=0)
+            for setting in (args.nprobe if isinstance(index, IVFIndex) else args.ef):
+                if isinstance(index, HnswIndex):
+                    index.ef = setting
+                else:
+                    index.nprobe = setting
+                median, p95, top1 = timed_search(gallery, captures)
+                recall = sum(a == b for a, b in zip(top1, reference)) / len(reference)
+                label = f"{kind} {'ef' if kind == 'hnsw' else 'nprobe'}={setting}"
+                print(f"{label:>14} {build:>8.1f} {median:>10.2f} {p95:>8.2f} {recall:>9.2%}")
+            gallery._index = None
+            del index
+        if not hnsw_available():
+            print(f"{'hnsw':>14} skipped (pip install hnswlib)")
+
+
+if __name__ == "__main__":
+    main()
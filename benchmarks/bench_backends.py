@@ -0,0 +1,98 @@
+"""
+Embedding backend benchmark: latency, throughput and memory per runtime
+
+Each backend is measured in its own fresh process so model weights and runtime
+imports do not leak between runs. Inputs are random face-sized tensors; use
+`python -m app.services.face_backends parity` to check embedding agreement.
+
+Usage:
+    python -m benchmarks.bench_backends
+    python -m benchmarks.bench_backends --backends tensorflow onnx-int8 --batch-size 32
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+
+import numpy as np
+
+from app.services.face_backends import BACKENDS
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _measure(backend_name: str, model_name: str, repeat: int, batch_size: int, queue):
+    from app.services.face_backends import build_backend
+
+    try:
+        start = time.perf_counter()
+        backend = build_backend(backend_name, model_name)
+        load_s = time.perf_counter() - start
+    except Exception as e:
+        queue.put({"backend": backend_name, "error": str(e)})
+        return
+
+    width, height = backend.input_shape
+    rng = np.random.default_rng(0)
+    single = rng.random((1, height, width, 3), dtype=np.float32)
+    batch = rng.random((batch_size, height, width, 3), dtype=np.float32)
+    backend.forward(single)
+    backend.forward(batch)
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        backend.forward(single)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(max(1, repeat // 4)):
+        backend.forward(batch)
+    batched_s = time.perf_counter() - start
+
+    queue.put({
+        "backend": backend_name,
+        "load_s": load_s,
+        "latency_ms": statistics.median(latencies) * 1000,
+        "throughput": max(1, repeat // 4) * batch_size / batched_s,
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def measure(backend_name: str, model_name: str, repeat: int, batch_size: int) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(backend_name, model_name, repeat, batch_size, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--model", default="Facenet512")
+    parser.add_argument("--repeat", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"{'backend':>11} {'load s':>7} {'b=1 ms':>8} {f'b={args.batch_size} img/s':>11} {'RSS MB':>8} {'peak MB':>8}")
+    for backend_name in args.backends:
+        result = measure(backend_name, args.model, args.repeat, args.batch_size)
+        if "error" in result:
+            print(f"{backend_name:>11} skipped: {result['error']}")
+            continue
+        print(f"{backend_name:>11} {result['load_s']:>7.2f} {result['latency_ms']:>8.2f} "
+              f"{result['throughput']:>11.1f} {result['rss_mb']:>8.0f} {result['peak_rss_mb']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Cascade benchmark: Facenet512 over the full gallery vs SFace shortlist + re-rank
+
+Expects a labeled directory with one sub-directory per person. The first image
+of each person (sorted by name) is enrolled; every other image is a probe. For
+both strategies the script reports per-probe latency and the rate of correct,
+wrong and missed identifications, plus how often the cascade skipped Facenet512.
+
+Usage:
+    python -m benchmarks.bench_cascade --images data/faces
+    python -m benchmarks.bench_cascade --images data/faces --shortlist-k 10 --stage1-threshold 0.8
+"""
+import argparse
+import os
+import statistics
+import time
+
+from app.services.face_gallery import FaceGallery
+from app.services.face_service import (
+    CascadeMatcher,
+    FastAttendanceVerifier,
+    SFaceShortlistModel,
+    CASCADE_SHORTLIST_K,
+    CASCADE_STAGE1_THRESHOLD,
+    MATCH_THRESHOLD,
+)
+
+
+def load_dataset(directory: str):
+    enroll, probes = {}, []
+    for person in sorted(os.listdir(directory)):
+        person_dir = os.path.join(directory, person)
+        if not os.path.isdir(person_dir):
+            continue
+        for i, filename in enumerate(sorted(os.listdir(person_dir))):
+            with open(os.path.join(person_dir, filename), "rb") as f:
+                data = f.read()
+            if i == 0:
+                enroll[person] = data
+            else:
+                probes.append((person, data))
+    return enroll, probes
+
+
+def summarize(name: str, outcomes, timings):
+    total = len(outcomes)
+    correct = sum(1 for o in outcomes if o == "correct")
+    wrong = sum(1 for o in outcomes if o == "wrong")
+    missed = total - correct - wrong
+    print(f"{name:>8} {statistics.median(timings) * 1000:>10.1f} {statistics.mean(timings) * 1000:>9.1f} "
+          f"{correct / total:>8.1%} {wrong / total:>7.1%} {missed / total:>7.1%}")
+
+
+def outcome(person: str, match) -> str:
+    if match is None:
+        return "missed"
+    return "correct" if match[0] == person else "wrong"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="Directory with one sub-directory per person")
+    parser.add_argument("--shortlist-k", type=int, default=CASCADE_SHORTLIST_K)
+    parser.add_argument("--stage1-threshold", type=float, default=CASCADE_STAGE1_THRESHOLD)
+    parser.add_argument("--threshold", type=float, default=MATCH_THRESHOLD)
+    args = parser.parse_args()
+
+    enroll, probes = load_dataset(args.images)
+    if not probes:
+        raise SystemExit("Need at least two images for some person")
+
+    # The cache would turn repeated probes into lookups
+    verifier = FastAttendanceVerifier(cache=None)
+    sface = SFaceShortlistModel()
+    gallery, shortlist = FaceGallery(), FaceGallery()
+    for person, data in enroll.items():
+        img = verifier.decode(data)
+        if img is None:
+            continue
+        face = verifier.detect(img)
+        gallery.add(person, verifier.embed([face])[0])
+        shortlist.add(person, sface.embed([face])[0])
+    print(f"Enrolled {len(gallery)} people, {len(probes)} probes")
+
+    full_outcomes, full_timings = [], []
+    for person, data in probes:
+        start = time.perf_counter()
+        embedding = verifier.compute_embedding(data)
+        match = gallery.best_match(embedding, threshold=args.threshold) if embedding else None
+        full_timings.append(time.perf_counter() - start)
+        full_outcomes.append(outcome(person, match))
+
+    matcher = CascadeMatcher(
+        gallery=gallery,
+        shortlist=shortlist,
+        shortlist_k=args.shortlist_k,
+        stage1_threshold=args.stage1_threshold,
+        stage2_threshold=args.threshold,
+        verifier=verifier,
+        shortlist_model=sface
+    )
+    cascade_outcomes, cascade_timings = [], []
+    for person, data in probes:
+        start = time.perf_counter()
+        match = matcher.identify(data)["match"]
+        cascade_timings.append(time.perf_counter() - start)
+        cascade_outcomes.append(outcome(person, match))
+
+    print(f"{'strategy':>8} {'median ms':>10} {'mean ms':>9} {'correct':>8} {'wrong':>7} {'missed':>7}")
+    summarize("full", full_outcomes, full_timings)
+    summarize("cascade", cascade_outcomes, cascade_timings)
+    changed = sum(1 for a, b in zip(full_outcomes, cascade_outcomes) if a != b)
+    print(f"Outcome changed for {changed}/{len(probes)} probes; {matcher.metrics()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Compact embedding benchmark: float32 vs float16 vs int8 gallery scans
+
+Builds a synthetic gallery of clustered 512-d embeddings (one centroid per
+identity, probes are noisy captures of random identities) and reports, per
+scan precision:
+
+    resident MB growth of the process' resident set (anonymous plus mapped
+                file pages, Linux /proc) from building the gallery and
+                running every probe, i.e. everything the gallery keeps in
+                memory: float32 rows, compact copy, scales, paged-in rows
+    median ms   best_match latency (compact scan + exact float32 re-score)
+    agreement   top-1 identical to the exact float32 scan
+    distance    largest |distance| difference on agreeing matches
+
+Every precision runs in a fresh process so the measurements do not overlap.
+
+plus the BSON size of one embedding stored as an array of doubles vs binary.
+
+Usage:
+    python -m benchmarks.bench_compact
+    python -m benchmarks.bench_compact --sizes 10000 100000 --probes 500 --rescore-k 32
+"""
+import argparse
+import multiprocessing
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bson
+import numpy as np
+
+from app.services.face_gallery import FaceGallery, SCAN_DTYPES
+from app.services import face_service
+
+DIMENSION = 512
+
+
+def resident_bytes() -> int:
+    resident = 0
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile"):
+                resident += int(value.split()[0]) * 1024
+    return resident
+
+
+def build(dtype: str, size: int, probes: int, noise: float, rescore_k: int, seed: int = 0, block: int = 4096):
+    """
+    Add identities one by one, as the startup load does, generating them in
+    blocks so the source data never counts towards the gallery's footprint
+
+    Returns:
+        (gallery, probe captures)
+    """
+    rng = np.random.default_rng(seed)
+    targets = rng.integers(0, size, probes)
+    captures = np.empty((probes, DIMENSION), dtype=np.float32)
+    gallery = FaceGallery(dimension=DIMENSION, initial_capacity=size, scan_dtype=dtype, rescore_k=rescore_k)
+    for start in range(0, size, block):
+        centroids = rng.standard_normal((min(block, size - start), DIMENSION)).astype(np.float32)
+        for offset, centroid in enumerate(centroids):
+            gallery.add(str(start + offset), centroid)
+        hits = (targets >= start) & (targets < start + len(centroids))
+        captures[hits] = centroids[targets[hits] - start]
+    captures += noise * rng.standard_normal((probes, DIMENSION)).astype(np.float32)
+    return gallery, captures
+
+
+def measure(dtype: str, size: int, probes: int, noise: float, rescore_k: int):
+    baseline = resident_bytes()
+    gallery, captures = build(dtype, size, probes, noise, rescore_k)
+    gallery.best_match(captures[0])  # warm caches, build the compact copy
+    timings, matches = [], []
+    for probe in captures:
+        start = time.perf_counter()
+        matches.append(gallery.best_match(probe))
+        timings.append(time.perf_counter() - start)
+    resident = resident_bytes() - baseline - captures.nbytes
+    return resident / 2 ** 20, statistics.median(timings) * 1000, matches
+
+
+def storage_sizes():
+    embedding = np.random.default_rng(1).standard_normal(DIMENSION).astype(np.float32)
+    sizes = {"array of doubles": len(bson.encode({"face_embedding": [float(v) for v in embedding]}))}
+    for dtype in ("float32", "float16"):
+        face_service.EMBEDDING_STORAGE_DTYPE = dtype
+        encoded = face_service.encode_embedding(embedding)
+        decoded = face_service.decode_embedding(encoded)
+        error = float(np.max(np.abs(decoded - embedding)))
+        sizes[f"binary {dtype} (max err {error:.1e})"] = len(bson.encode({"face_embedding": encoded}))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--probes", type=int, default=300)
+    parser.add_argument("--noise", type=float, default=0.6, help="Capture noise relative to identity spread")
+    parser.add_argument("--rescore-k", type=int, default=32)
+    args = parser.parse_args()
+
+    print("BSON bytes per stored embedding:")
+    for name, size in storage_sizes().items():
+        print(f"  {name:<32} {size:>6}")
+
+    for size in args.sizes:
+        reference = None
+        print(f"\n{size} identities, {args.probes} probes")
+        print(f"{'dtype':>8} {'resident MB':>12} {'median ms':>10} {'agreement':>10} {'distance':>9}")
+        for dtype in SCAN_DTYPES:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                megabytes, median_ms, matches = pool.submit(
+                    measure, dtype, size, args.probes, args.noise, args.rescore_k
+                ).result()
+            if reference is None:
+                reference = matches
+            agree = [a[0] == b[0] for a, b in zip(matches, reference)]
+            drift = max((abs(a[1] - b[1]) for a, b, same in zip(matches, reference, agree) if same), default=0.0)
+            print(f"{dtype:>8} {megabytes:>12.1f} {median_ms:>10.2f} "
+                  f"{sum(agree) / len(agree):>10.2%} {drift:>9.1e}")
+
+
+if __name__ == "__main__":
+    main()
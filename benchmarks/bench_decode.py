@@ -0,0 +1,125 @@
+"""
+Decode micro-benchmark: full-resolution decode vs DCT-scaled draft decode
+
+Compares the original fast_preprocess (decode at native size, convert to RGB,
+then downsize) with the current one (JPEG draft mode) on synthetic camera-like
+JPEGs. Peak memory is the growth of the process' max RSS, measured in a fresh
+child process per (size, method) so runs do not share a high-water mark.
+
+Usage:
+    python -m benchmarks.bench_decode
+    python -m benchmarks.bench_decode --sizes 1280x720 1920x1080 --repeat 50
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+MAX_IMAGE_SIZE = 640
+
+
+def make_jpeg(width: int, height: int, quality: int = 90) -> bytes:
+    """Smooth gradient plus sensor-like noise, roughly what a webcam produces"""
+    rng = np.random.default_rng(width * height)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    noisy = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(noisy).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def legacy_preprocess(image_data: bytes) -> np.ndarray:
+    """fast_preprocess as it was before draft decoding"""
+    image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    width, height = image.size
+    if max(width, height) > MAX_IMAGE_SIZE:
+        scale = MAX_IMAGE_SIZE / max(width, height)
+        image = image.resize((int(width * scale), int(height * scale)), Image.BILINEAR)
+    return np.array(image)
+
+
+def build(method: str):
+    if method == "legacy":
+        return legacy_preprocess
+    from app.services.face_service import FastAttendanceVerifier
+
+    return FastAttendanceVerifier(max_image_size=MAX_IMAGE_SIZE, warm_up=False).fast_preprocess
+
+
+METHODS = ("legacy", "draft")
+
+
+def _measure(method: str, path: str, repeat: int, queue):
+    fn = build(method)
+    with open(path, "rb") as f:
+        image_data = f.read()
+    # Baseline after imports but before any decode, so the first decode's
+    # working set counts towards the peak
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        array = fn(image_data)
+        timings.append(time.perf_counter() - start)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "median_ms": statistics.median(timings) * 1000,
+        "peak_delta_mb": max(0, peak_kb - baseline_kb) / 1024,
+        "shape": array.shape,
+    })
+
+
+def _write_jpegs(sizes, directory: str):
+    for width, height in sizes:
+        with open(os.path.join(directory, f"{width}x{height}.jpg"), "wb") as f:
+            f.write(make_jpeg(width, height))
+
+
+def run_child(target, *args):
+    # Linux keeps ru_maxrss across fork+exec, so anything memory-hungry (image
+    # synthesis included) must happen in a child, never in this process
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=target, args=(*args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _generate(sizes, directory, queue):
+    _write_jpegs(sizes, directory)
+    queue.put(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1280x720", "1920x1080", "3840x2160"])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.lower().split("x")) for size in args.sizes]
+    with tempfile.TemporaryDirectory() as directory:
+        run_child(_generate, sizes, directory)
+
+        print(f"{'size':>10} {'method':>7} {'median ms':>10} {'peak +MB':>9} {'output':>14}")
+        for width, height in sizes:
+            path = os.path.join(directory, f"{width}x{height}.jpg")
+            for method in METHODS:
+                result = run_child(_measure, method, path, args.repeat)
+                shape = "x".join(str(v) for v in result["shape"])
+                print(f"{f'{width}x{height}':>10} {method:>7} {result['median_ms']:>10.2f} "
+                      f"{result['peak_delta_mb']:>9.1f} {shape:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Face detector benchmark: latency and miss rate per detector backend
+
+Runs every image of a local directory through each detector exactly as the
+verifier sees it (decoded and downscaled by fast_preprocess) and reports, per
+backend:
+
+    load s      time to build the detector and run the first frame
+    median ms   per-frame detection latency
+    p95 ms      95th percentile latency
+    miss rate   frames where no face was found
+    multi       frames where more than one face was found
+
+Every image is expected to hold exactly one face (e.g. registration photos
+and kiosk captures), so misses and multiple detections are both errors.
+Backends that cannot be built here (DeepFace not installed, YuNet model not
+downloaded) are reported and skipped.
+
+Usage:
+    python -m benchmarks.bench_detectors --images data/faces
+    python -m benchmarks.bench_detectors --images data/faces --backends opencv yunet ssd --repeat 3
+"""
+import argparse
+import os
+import statistics
+import time
+
+from app.services.face_detectors import build_detector, DETECTORS
+from app.services.face_service import FastAttendanceVerifier
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def load_frames(directory: str, max_image_size: int):
+    verifier = FastAttendanceVerifier(max_image_size=max_image_size, warm_up=False)
+    frames = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(directory, filename), "rb") as f:
+            img = verifier.decode(f.read())
+        if img is not None:
+            frames.append(img)
+    return frames
+
+
+def measure(name: str, frames, repeat: int):
+    start = time.perf_counter()
+    detector = build_detector(name)
+    detector.detect(frames[0])
+    load_s = time.perf_counter() - start
+
+    timings, missed, multiple = [], 0, 0
+    for _ in range(repeat):
+        for frame in frames:
+            start = time.perf_counter()
+            faces = detector.detect(frame)
+            timings.append(time.perf_counter() - start)
+            found = [face for face in faces if face.get("confidence")]
+            missed += not found
+            multiple += len(found) > 1
+    timings.sort()
+    total = len(frames) * repeat
+    return {
+        "load_s": load_s,
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+        "miss_rate": missed / total,
+        "multi_rate": multiple / total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="Directory of single-face photos")
+    parser.add_argument("--backends", nargs="+", default=list(DETECTORS))
+    parser.add_argument("--repeat", type=int, default=1, help="Passes over the image set")
+    parser.add_argument("--max-image-size", type=int, default=640)
+    args = parser.parse_args()
+
+    frames = load_frames(args.images, args.max_image_size)
+    if not frames:
+        raise SystemExit(f"No readable images in {args.images}")
+
+    print(f"{len(frames)} images, {args.repeat} pass(es), frames up to {args.max_image_size} px")
+    print(f"{'backend':>12} {'load s':>7} {'median ms':>10} {'p95 ms':>8} {'miss rate':>10} {'multi':>7}")
+    for name in args.backends:
+        try:
+            result = measure(name, frames, args.repeat)
+        except Exception as e:
+            print(f"{name:>12} skipped ({e})")
+            continue
+        print(f"{name:>12} {result['load_s']:>7.2f} {result['median_ms']:>10.2f} {result['p95_ms']:>8.2f} "
+              f"{result['miss_rate']:>10.2%} {result['multi_rate']:>7.2%}")
+
+
+if __name__ == "__main__":
+    main()
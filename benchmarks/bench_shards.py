@@ -0,0 +1,81 @@
+"""
+Scatter-gather benchmark: one FaceGallery vs ShardedGallery with N shard processes
+
+Builds a synthetic gallery of clustered 512-d embeddings and reports, per
+layout, the median / p95 best_match latency, top-1 agreement with the
+single-process gallery, and how long removing 20% of the employees (with the
+resulting rebalancing) takes. Shards only pay off with at least as many free
+cores as shards.
+
+Usage:
+    python -m benchmarks.bench_shards
+    python -m benchmarks.bench_shards --size 200000 --shards 2 4 8
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from app.services.face_gallery import FaceGallery
+from app.services.gallery_shards import ShardedGallery
+
+DIMENSION = 512
+
+
+def timed_matches(gallery, captures: np.ndarray):
+    gallery.best_match(captures[0])  # warm caches
+    timings, matches = [], []
+    for probe in captures:
+        start = time.perf_counter()
+        matches.append(gallery.best_match(probe))
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.95)] * 1000, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--shards", nargs="+", type=int, default=[2, 4])
+    parser.add_argument("--probes", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.6)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centroids = rng.standard_normal((args.size, DIMENSION), dtype=np.float32)
+    targets = rng.integers(0, args.size, args.probes)
+    captures = centroids[targets] + args.noise * rng.standard_normal((args.probes, DIMENSION), dtype=np.float32)
+    ids = [str(i) for i in range(args.size)]
+    removed = ids[::5]
+
+    print(f"{args.size} identities, {args.probes} probes")
+    print(f"{'layout':>10} {'median ms':>10} {'p95 ms':>8} {'agreement':>10} {'remove 20% s':>13} {'sizes after'}")
+    single = FaceGallery(dimension=DIMENSION, initial_capacity=args.size)
+    for identity, embedding in zip(ids, centroids):
+        single.add(identity, embedding)
+    median, p95, reference = timed_matches(single, captures)
+    print(f"{'single':>10} {median:>10.2f} {p95:>8.2f} {1:>10.2%}")
+
+    for shards in args.shards:
+        gallery = ShardedGallery(shards)
+        gallery.start()
+        try:
+            for identity, embedding in zip(ids, centroids):
+                gallery.add(identity, embedding)
+            median, p95, matches = timed_matches(gallery, captures)
+            agree = sum(a is not None and b is not None and a[0] == b[0]
+                        for a, b in zip(matches, reference)) / len(reference)
+            start = time.perf_counter()
+            for identity in removed:
+                gallery.remove(identity)
+            gallery.search(captures[0], top_k=1)  # wait for the shards to drain
+            removal = time.perf_counter() - start
+            print(f"{f'{shards} shards':>10} {median:>10.2f} {p95:>8.2f} {agree:>10.2%} {removal:>13.2f} "
+                  f"{gallery.metrics()['sizes']}")
+        finally:
+            gallery.stop()
+
+
+if __name__ == "__main__":
+    main()